@@ -2,140 +2,2030 @@
 
 import argparse
 import code
+import io
 import json
+import multiprocessing
 import os
+import random
+import re
 import readline
+import resource
 import signal
+import subprocess
 import sys
+import tempfile
+import time
+import tracemalloc
 import datetime
+import hashlib
 import xml.etree.ElementTree
 
 C_STRUCT = ['typedef struct XXX {', '}XXX;']
-HEADER_GUARD = ['\n#ifndef _XXX_H\n#define _XXX_H\n', '#endif //end of inclusion guard\n\n']
-EXTERN_C = ['#ifdef __cplusplus\nextern "C" {\n#endif\n', '#ifdef __cplusplus\n}\n#endif //end of extern c\n']
 BEGIN_NOTE = "//Generated Automatically by luatablegen."
-HEADER_LIST = ['#include "HHHlua.h"\n', '#include "HHHlauxlib.h"\n',
-               '#include "HHHlualib.h"\n', '#include <inttypes.h>\n',
-               '#include <stdbool.h>\n']
-CONVERT = ['static XXX* convert_XXX (lua_State* __ls, int index) {\n',
-           '\tXXX* dummy = (XXX*)lua_touserdata(__ls, index);\n',
-           '\tif (dummy == NULL) printf("XXX:bad user data type.\\n");\n',
-           '\treturn dummy;\n}\n']
-CHECK = ['static XXX* check_XXX(lua_State* __ls, int index) {\n',
-        '\tXXX* dummy;\n',
-        '\tdummy = (XXX*)luaL_checkudata(__ls, index, "XXX");\n',
-        '\tif (dummy == NULL) printf("XXX:bad user data type.\\n");\n',
-        '\treturn dummy;\n}\n']
-#CHECK = ['static XXX* check_XXX(lua_State* __ls, int index) {\n',
-#        '\tXXX* dummy;\n',
-#        '\tluaL_checktype(__ls, index, LUA_TUSERDATA);\n'
-#        '\tdummy = (XXX*)luaL_checkudata(__ls, index, "XXX");\n',
-#        '\tif (dummy == NULL) printf("XXX:bad user data type.\\n");\n',
-#        '\treturn dummy;\n}\n']
-PUSH_SELF = [ 'XXX* push_XXX(lua_State* __ls) {\n',
-            '\tlua_checkstack(__ls, 3);\n',
-            '\tXXX* dummy = lua_newuserdata(__ls, sizeof(XXX));\n',
-            '\tluaL_getmetatable(__ls, "XXX");\n',
-            '\tlua_setmetatable(__ls, -2);\n',
-            '\tlua_pushlightuserdata(__ls, dummy);\n',
-            '\tlua_pushvalue(__ls, -2);\n',
-            '\tlua_settable(__ls, LUA_REGISTRYINDEX);\n',
-            '\treturn dummy;\n}\n']
-PUSH_ARGS = ['int XXX_push_args(lua_State* __ls, XXX* _st) {\n',
-             '\tlua_checkstack(__ls, NNN);\n', '\treturn NNN;\n}\n']
-NEW = ['int new_XXX(lua_State* __ls) {\n', '\tlua_checkstack(__ls, NNN);\n',
-       '\tXXX* dummy = push_XXX(__ls);\n', '\treturn 1;\n}\n']
-GETTER_GEN = ['static int getter_XXX_YYY(lua_State* __ls) {\n',
-              '\tXXX* dummy = check_XXX(__ls, 1);\n',
-              '\tlua_pop(__ls, -1);\n',
-              '\treturn 1;\n}\n']
-SETTER_GEN = ['static int setter_XXX_YYY(lua_State* __ls) {\n',
-              '\tXXX* dummy = check_XXX(__ls, 1);\n',
-              '\tlua_settop(__ls, 1);\n',
-              '\treturn 1;\n}\n']
-REGISTER_TABLE_METHODS = ['static const luaL_Reg XXX_methods[] = {\n',
-                          '\t{0,0}\n};\n']
-REGISTER_META = ['static const luaL_Reg XXX_meta[] = {\n',
-                 '\t{0, 0}\n};\n']
-# table register for global lua tables
-TABLE_REGISTER_G =  ['int XXX_register(lua_State* __ls, char* reg_str) {\n',
-  'lua_checkstack(__ls, 4);\n'
-  'lua_newtable(__ls);\n',
-  'luaL_setfuncs(__ls, XXX_methods, 0);\n',
-  'lua_setglobal(__ls, "XXX");\n',
-  'luaL_newmetatable(__ls, reg_str);\n',
-  'luaL_setfuncs(__ls, XXX_meta, 0);\n',
-  'lua_pushliteral(__ls, "__index");\n',
-  'lua_pushvalue(__ls, -3);\n',
-  'lua_rawset(__ls, -3);\n',
-  'lua_pushliteral(__ls, "__metatable");\n',
-  'lua_pushvalue(__ls, -3);\n',
-  'lua_rawset(__ls, -3);\n',
-  'lua_setglobal(__ls , "XXX");\n'
-  'return 0;\n}\n']
-# table register function for anonymous lua tables
-TABLE_REGISTER =  ['int XXX_register(lua_State* __ls, char* reg_str) {\n',
-  'lua_checkstack(__ls, 4);\n'
-  'lua_newtable(__ls);\n',
-  'luaL_setfuncs(__ls, XXX_methods, 0);\n',
-  'luaL_newmetatable(__ls, reg_str);\n',
-  'luaL_setfuncs(__ls, XXX_methods, 0);\n',
-  'luaL_setfuncs(__ls, XXX_meta, 0);\n',
-  'lua_pushliteral(__ls, "__index");\n',
-  'lua_pushvalue(__ls, -3);\n',
-  'lua_rawset(__ls, -3);\n',
-  'lua_pushliteral(__ls, "__metatable");\n',
-  'lua_pushvalue(__ls, -3);\n',
-  'lua_rawset(__ls, -3);\n',
-  'lua_setglobal(__ls , "XXX");\n'
-  'return 0;\n}\n']
 SOURCE_FILE_NAME='XXX_luatablegen.c'
 HEADER_FILE_NAME='XXX_luatablegen.h'
-LUA_PUSH_TABLE = """
-int pushluatable_YYY(lua_State* ls, XXX array, uint64_t count) {
-  if (!lua_checkstack(ls, 3)) {
+MANIFEST_FILE_NAME = "tablegen_manifest.json"
+MANIFEST_VERSION = 1
+TEMPLATE_SUFFIX = ".tmpl"
+# element kinds array views know how to read and write
+VIEW_KINDS = {"int8": "TABLEGEN_INT8", "uint8": "TABLEGEN_UINT8", "int16": "TABLEGEN_INT16", "uint16": "TABLEGEN_UINT16",
+              "int32": "TABLEGEN_INT32", "uint32": "TABLEGEN_UINT32", "int64": "TABLEGEN_INT64", "uint64": "TABLEGEN_UINT64",
+              "float": "TABLEGEN_FLOAT", "double": "TABLEGEN_DOUBLE", "bool": "TABLEGEN_UINT8", "varuint1": "TABLEGEN_UINT8", "uchar": "TABLEGEN_UINT8",
+              "schar": "TABLEGEN_INT8", "string": "TABLEGEN_STRING"}
+# size and alignment of the C types struct fields are declared with, as on
+# LP64. pointers are 8 bytes, anything else is unknown and its struct is left
+# alone by --layout.
+# fields narrower than a byte. --bitfields packs them, a bits attribute on an
+# integer field gives the width of any other type.
+SUB_BYTE_TYPES = {"bool": 1, "varuint1": 1}
+C_TYPE_SIZES = {"int8_t": 1, "uint8_t": 1, "int16_t": 2, "uint16_t": 2, "int32_t": 4, "uint32_t": 4,
+                "int64_t": 8, "uint64_t": 8, "int128_t": 16, "uint128_t": 16, "float": 4, "double": 8}
+# the C, lua and make snippets everything is generated from. ${name} is a
+# placeholder. any of these can be overridden by a file called name.tmpl in
+# one of the directories passed with --templates.
+DEFAULT_TEMPLATES = {
+"lua_includes": """#include "${luaheader}lua.h"
+#include "${luaheader}lauxlib.h"
+#include "${luaheader}lualib.h"
+#include <inttypes.h>
+#include <limits.h>
+""",
+"include": """#include "${path}"
+""",
+"source_prologue": """
+// automatically generated by luatablegen
+// ${time}
+${lua_includes}#include <stdbool.h>
+#include <stdlib.h>
+#include <string.h>
+#include "./tabledefs.h"
+#include "./${header}"
+
+${pre}
+""",
+"header_prologue": """
+// automatically generated by luatablegen
+// ${time}
+${lua_includes}#include <stdbool.h>
+#include <stdlib.h>
+#include "./tabledefs.h"
+
+#ifndef _${struct}_H
+#define _${struct}_H
+#ifdef __cplusplus
+extern "C" {
+#endif
+
+${pre}
+""",
+"source_epilogue": """${post}
+
+""",
+"header_epilogue": """${post}
+#ifdef __cplusplus
+}
+#endif //end of extern c
+#endif //end of inclusion guard
+
+
+""",
+"convert": """static ${struct}* convert_${struct} (lua_State* __ls, int index) {
+\t${struct}* dummy = (${struct}*)lua_touserdata(__ls, index);
+\tif (dummy == NULL) printf("${struct}:bad user data type.\\n");
+\treturn dummy;
+}
+
+""",
+# every method and metamethod is registered with the metatables of the struct,
+# its element references and its arrays as upvalues 1 to 3, so checking the type
+# is an identity comparison instead of a registry lookup by name.
+"check": """static ${struct}* check_${struct}(lua_State* __ls, int index) {
+\tvoid* dummy = lua_touserdata(__ls, index);
+\tif (dummy != NULL && lua_getmetatable(__ls, index)) {
+\t\tint same = lua_rawequal(__ls, -1, lua_upvalueindex(1));
+\t\tint ref = !same && lua_rawequal(__ls, -1, lua_upvalueindex(2));
+\t\tlua_pop(__ls, 1);
+\t\tif (same) return dummy;
+\t\tif (ref) return ((tablegen_ref*)dummy)->ptr;
+\t}
+\tluaL_argerror(__ls, index, "${struct} expected");
+\treturn NULL;
+}
+
+""",
+# ownership flags live right behind the struct inside its userdata, one byte
+# per pointer field the binding allocates itself. elements of an array keep
+# theirs in the array block.
+"owned": """static uint8_t* owned_${struct}(lua_State* __ls, int index) {
+\tvoid* dummy = lua_touserdata(__ls, index);
+\tlua_getmetatable(__ls, index);
+\tint ref = lua_rawequal(__ls, -1, lua_upvalueindex(2));
+\tlua_pop(__ls, 1);
+\tif (ref) return ((tablegen_ref*)dummy)->owned;
+\treturn (uint8_t*)((${struct}*)dummy + 1);
+}
+
+""",
+"push_self": """${linkage}${struct}* push_${struct}(lua_State* __ls) {
+\tlua_checkstack(__ls, 3);
+\t${struct}* dummy = lua_newuserdata(__ls, sizeof(${struct})${owned});
+${init}${metatable}\tlua_setmetatable(__ls, -2);
+\ttablegen_cache_set(__ls, dummy);
+\treturn dummy;
+}
+
+""",
+"push_args": """${linkage}int ${struct}_push_args(lua_State* __ls, ${struct}* _st) {
+${probe}if (_st == NULL) return 0;
+\tlua_checkstack(__ls, ${stack});
+${body}\treturn ${count};
+}
+
+""",
+"new": """${linkage}int new_${struct}(lua_State* __ls) {
+${probe}\tlua_checkstack(__ls, ${stack});
+${locals}\t${struct}* dummy = push_${struct}(__ls);
+${anchors}\tlua_replace(__ls, -${count}-1);
+\tlua_pop(__ls, ${count}-1);
+${assignments}\treturn 1;
+}
+
+""",
+"getter": """static int getter_${struct}_${field}(lua_State* __ls) {
+${probe}\t${receiver}check_${struct}(__ls, 1);
+\tlua_settop(__ls, 1);
+${body}\treturn 1;
+}
+""",
+"setter": """static int setter_${struct}_${field}(lua_State* __ls) {
+${probe}\t${struct}* dummy = check_${struct}(__ls, 1);
+${body}\tlua_settop(__ls, 1);
+\treturn 1;
+}
+""",
+# a count field and the arrays the binding allocated for it change together.
+# views are bounded by the count, so it must never exceed what was allocated.
+# shrinking keeps the old block if realloc fails, only growing can fail. skip
+# is an array its setter has just replaced with one of the new length.
+"resize": """static void resize_${struct}_${count}(lua_State* __ls, ${struct}* dummy, lua_Integer value, int skip) {
+\tuint8_t* owned = owned_${struct}(__ls, 1);
+\tluaL_argcheck(__ls, value >= 0, 2, "negative count");
+\tuint64_t old = dummy->${count};
+\tdummy->${count} = value;
+\tuint64_t length = dummy->${count};
+${body}}
+
+""",
+"resize_array": """\tif (skip != ${index} && owned[${index}] && length != old) {
+\t\tvoid* items = length <= SIZE_MAX / sizeof(*dummy->${field}) ? realloc(dummy->${field}, length ? length * sizeof(*dummy->${field}) : 1) : NULL;
+\t\tif (items == NULL && length > old) {
+\t\t\tdummy->${count} = old;
+\t\t\tluaL_error(__ls, "not enough memory for ${field}");
+\t\t}
+\t\tif (items != NULL) {
+\t\t\tdummy->${field} = items;
+\t\t\tif (length > old) memset(dummy->${field} + old, 0, (length - old) * sizeof(*dummy->${field}));
+\t\t}
+\t}
+""",
+"gc": """static int gc_${struct}(lua_State* __ls) {
+\t${struct}* dummy = check_${struct}(__ls, 1);
+${body}\treturn 0;
+}
+
+""",
+# plain obj.field access. keys that are not fields fall through to the
+# metatable, which holds the methods.
+"index": """static int index_${struct}(lua_State* __ls) {
+\tsize_t length;
+\tconst char* key = lua_type(__ls, 2) == LUA_TSTRING ? lua_tolstring(__ls, 2, &length) : NULL;
+\tif (key != NULL) {
+${dispatch}\t}
+\tlua_settop(__ls, 2);
+\tlua_rawget(__ls, lua_upvalueindex(1));
+\treturn 1;
+}
+
+""",
+"newindex": """static int newindex_${struct}(lua_State* __ls) {
+\tsize_t length;
+\tconst char* key = lua_type(__ls, 2) == LUA_TSTRING ? lua_tolstring(__ls, 2, &length) : NULL;
+\tif (key != NULL) {
+${dispatch}\t}
+\treturn luaL_error(__ls, "${struct} has no field %s", key != NULL ? key : "?");
+}
+
+""",
+# XXX.new_array(n [, init]) allocates n structs in one block. indexing the
+# block hands out references to its elements instead of one userdata each.
+"array": """typedef struct {
+\t${struct}* items;
+\tuint64_t length;
+\tuint8_t* owned;
+} ${struct}_array;
+
+static ${struct}_array* check_${struct}_array(lua_State* __ls, int index) {
+\t${struct}_array* dummy = lua_touserdata(__ls, index);
+\tif (dummy != NULL && lua_getmetatable(__ls, index)) {
+\t\tint same = lua_rawequal(__ls, -1, lua_upvalueindex(3));
+\t\tlua_pop(__ls, 1);
+\t\tif (same) return dummy;
+\t}
+\tluaL_argerror(__ls, index, "${struct}_array expected");
+\treturn NULL;
+}
+
+static ${struct}* push_ref_${struct}(lua_State* __ls, int array, uint64_t i) {
+\t${struct}_array* block = lua_touserdata(__ls, array);
+\t${struct}* item = block->items + i;
+\ttablegen_cache_get(__ls, item);
+\tif (!lua_isnil(__ls, -1)) return item;
+\tlua_pop(__ls, 1);
+\ttablegen_ref* ref = lua_newuserdata(__ls, sizeof(tablegen_ref));
+\tref->ptr = item;
+\tref->owned = block->owned != NULL ? block->owned + i * ${owned} : NULL;
+\tlua_pushvalue(__ls, lua_upvalueindex(2));
+\tlua_setmetatable(__ls, -2);
+\ttablegen_cache_set(__ls, item);
+\ttablegen_anchor(__ls, -1, "array", array);
+\treturn item;
+}
+
+static const char* ${struct}_setters[] = {
+${setters}\tNULL
+};
+
+static int new_array_${struct}(lua_State* __ls) {
+\tlua_Integer count = luaL_checkinteger(__ls, 1);
+\tluaL_argcheck(__ls, count >= 0, 1, "negative length");
+\tuint64_t length = (uint64_t)count;
+\tluaL_argcheck(__ls, length <= (SIZE_MAX - sizeof(${struct}_array)) / (sizeof(${struct}) + ${owned}), 1, "length too large");
+\tlua_checkstack(__ls, 6);
+\t${struct}_array* dummy = lua_newuserdata(__ls, sizeof(${struct}_array) + length * (sizeof(${struct}) + ${owned}));
+\tdummy->items = (${struct}*)(dummy + 1);
+\tdummy->length = length;
+\tdummy->owned = ${owned_items};
+\tmemset(dummy->items, 0, length * (sizeof(${struct}) + ${owned}));
+\tlua_pushvalue(__ls, lua_upvalueindex(3));
+\tlua_setmetatable(__ls, -2);
+\tint array = lua_gettop(__ls);
+\tif (lua_istable(__ls, 2)) {
+\t\tfor (uint64_t i = 0; i < length; ++i) {
+\t\t\tlua_rawgeti(__ls, 2, i + 1);
+\t\t\tif (lua_istable(__ls, -1)) {
+\t\t\t\tint init = lua_gettop(__ls);
+\t\t\t\tpush_ref_${struct}(__ls, array, i);
+\t\t\t\tfor (int j = 0; ${struct}_setters[j] != NULL; ++j) {
+\t\t\t\t\tlua_getfield(__ls, init, ${struct}_setters[j] + 4);
+\t\t\t\t\tif (lua_isnil(__ls, -1)) {
+\t\t\t\t\t\tlua_pop(__ls, 1);
+\t\t\t\t\t\tcontinue;
+\t\t\t\t\t}
+\t\t\t\t\tlua_getfield(__ls, lua_upvalueindex(1), ${struct}_setters[j]);
+\t\t\t\t\tlua_insert(__ls, -2);
+\t\t\t\t\tlua_pushvalue(__ls, init + 1);
+\t\t\t\t\tlua_insert(__ls, -2);
+\t\t\t\t\tlua_call(__ls, 2, 0);
+\t\t\t\t}
+\t\t\t}
+\t\t\tlua_settop(__ls, array);
+\t\t}
+\t}
+\treturn 1;
+}
+
+${linkage}void wrap_${struct}_array(lua_State* __ls, ${struct}* items, uint64_t length) {
+${wrap_check}\tlua_checkstack(__ls, 3);
+\t${struct}_array* dummy = lua_newuserdata(__ls, sizeof(${struct}_array) + length * ${owned});
+\tdummy->items = items;
+\tdummy->length = length;
+\tdummy->owned = ${owned_block};
+\tmemset(dummy + 1, 0, length * ${owned});
+${metatable}\tlua_setmetatable(__ls, -2);
+}
+
+static int array_index_${struct}(lua_State* __ls) {
+\t${struct}_array* dummy = check_${struct}_array(__ls, 1);
+\tint isnum;
+\tlua_Integer i = lua_tointegerx(__ls, 2, &isnum);
+\tif (!isnum || i < 1 || (uint64_t)i > dummy->length) {
+\t\tlua_pushnil(__ls);
+\t\treturn 1;
+\t}
+\tpush_ref_${struct}(__ls, 1, i - 1);
+\treturn 1;
+}
+
+static int array_len_${struct}(lua_State* __ls) {
+\t${struct}_array* dummy = check_${struct}_array(__ls, 1);
+\tlua_pushinteger(__ls, (lua_Integer)dummy->length);
+\treturn 1;
+}
+
+${gc}static const luaL_Reg ${struct}_array_meta[] = {
+\t{"__index", array_index_${struct}},
+\t{"__len", array_len_${struct}},
+${gc_entry}\t{0, 0}
+};
+
+""",
+"array_gc": """static int array_gc_${struct}(lua_State* __ls) {
+\t${struct}_array* block = check_${struct}_array(__ls, 1);
+\tfor (uint64_t i = 0; i < block->length; ++i) {
+\t\t${struct}* dummy = block->items + i;
+\t\tuint8_t* owned = block->owned + i * ${owned};
+${body}\t}
+\treturn 0;
+}
+
+""",
+"method_entry": """\t{"${name}", ${func}},
+""",
+"methods": """static const luaL_Reg ${struct}_methods[] = {
+${entries}\t{0,0}
+};
+
+""",
+"meta": """static const luaL_Reg ${struct}_meta[] = {
+${entries}\t{0, 0}
+};
+
+""",
+# table register function for anonymous lua tables
+"table_register": """${linkage}int ${struct}_register(lua_State* __ls, char* reg_str) {
+int base = lua_gettop(__ls);
+lua_checkstack(__ls, 10);
+luaL_newmetatable(__ls, reg_str);
+luaL_newmetatable(__ls, "${struct}_ref");
+luaL_newmetatable(__ls, "${struct}_array");
+lua_newtable(__ls);
+tablegen_setfuncs(__ls, base + 4, base + 1, ${struct}_methods);
+${metatables}tablegen_setfuncs(__ls, base + 3, base + 1, ${struct}_array_meta);
+lua_pushvalue(__ls, base + 1);
+lua_setglobal(__ls , "${struct}");
+lua_replace(__ls, base + 1);
+lua_settop(__ls, base + 1);
+return 0;
+}
+""",
+# table register for global lua tables
+"table_register_global": """${linkage}int ${struct}_register(lua_State* __ls, char* reg_str) {
+int base = lua_gettop(__ls);
+lua_checkstack(__ls, 10);
+luaL_newmetatable(__ls, reg_str);
+luaL_newmetatable(__ls, "${struct}_ref");
+luaL_newmetatable(__ls, "${struct}_array");
+lua_newtable(__ls);
+tablegen_setfuncs(__ls, base + 4, base + 1, ${struct}_methods);
+lua_pushvalue(__ls, base + 4);
+lua_setglobal(__ls, "${struct}");
+${metatables}tablegen_setfuncs(__ls, base + 3, base + 1, ${struct}_array_meta);
+lua_settop(__ls, base + 1);
+return 0;
+}
+""",
+# the struct's own metatable and the one for references to array elements
+# share the methods. references own nothing so they get no __gc.
+"register_metatable": """tablegen_setfuncs(__ls, base + ${index}, base + 1, ${struct}_methods);
+lua_pushvalue(__ls, base + 4);
+lua_setfield(__ls, base + ${index}, "__index");
+lua_pushvalue(__ls, base + 4);
+lua_setfield(__ls, base + ${index}, "__metatable");
+tablegen_setfuncs(__ls, base + ${index}, base + 1, ${struct}_meta);
+""",
+"register_ref_metatable": """lua_pushnil(__ls);
+lua_setfield(__ls, base + 2, "__gc");
+tablegen_mark_ref(__ls, base + 2, "${struct}");
+""",
+"header_decls": """static ${struct}* convert_${struct} (lua_State* __ls, int index);
+static ${struct}* check_${struct}(lua_State* __ls, int index);
+${linkage}${struct}* push_${struct}(lua_State* __ls);
+${linkage}int ${struct}_push_args(lua_State* __ls, ${struct}* _st);
+${linkage}int new_${struct}(lua_State* __ls);
+${getters}${setters}${linkage}void wrap_${struct}_array(lua_State* __ls, ${struct}* items, uint64_t length);
+${linkage}void pack_${struct}_body(luaL_Buffer* b, ${struct}* _st, int depth);
+${linkage}void unpack_${struct}_body(lua_State* __ls, tablegen_reader* r, int self, int depth);
+${linkage}int ${struct}_register(lua_State* __ls, char* reg_str);
+${loader_decl}""",
+"getter_decl": """static int getter_${struct}_${field}(lua_State* __ls);
+""",
+"setter_decl": """static int setter_${struct}_${field}(lua_State* __ls);
+""",
+"tabledefs_prologue": """// automatically generated by luatablegen
+//${time}
+${lua_includes}#include <stdlib.h>
+#include <string.h>
+#include "./structs.h"
+""",
+# per-state object cache. maps the address of every userdata made by a push_
+# function back to the userdata. values are weak so the cache alone never keeps
+# an object alive; anchors are what a struct holds on to through raw pointers.
+"object_cache": """
+static const char tablegen_cache_key = 0;
+static const char tablegen_anchor_key = 0;
+
+static void tablegen_weak_table(lua_State* ls, const void* key, const char* mode) {
+  lua_rawgetp(ls, LUA_REGISTRYINDEX, key);
+  if (lua_istable(ls, -1)) return;
+  lua_pop(ls, 1);
+  lua_newtable(ls);
+  lua_createtable(ls, 0, 1);
+  lua_pushstring(ls, mode);
+  lua_setfield(ls, -2, "__mode");
+  lua_setmetatable(ls, -2);
+  lua_pushvalue(ls, -1);
+  lua_rawsetp(ls, LUA_REGISTRYINDEX, key);
+}
+
+// registers funcs into table with the three metatables starting at index
+// metatables as upvalues
+void tablegen_setfuncs(lua_State* ls, int table, int metatables, const luaL_Reg* funcs) {
+  lua_checkstack(ls, 4);
+  lua_pushvalue(ls, table);
+  lua_pushvalue(ls, metatables);
+  lua_pushvalue(ls, metatables + 1);
+  lua_pushvalue(ls, metatables + 2);
+  luaL_setfuncs(ls, funcs, 3);
+  lua_pop(ls, 1);
+}
+
+static const char tablegen_ref_key = 0;
+
+void tablegen_mark_ref(lua_State* ls, int metatable, const char* name) {
+  lua_pushstring(ls, name);
+  lua_rawsetp(ls, metatable, &tablegen_ref_key);
+}
+
+// the struct behind a userdata, whether it is the struct itself or a
+// reference to an element of an array
+void* tablegen_toobject(lua_State* ls, int index) {
+  void* p = lua_touserdata(ls, index);
+  if (p == NULL || !lua_getmetatable(ls, index)) return p;
+  lua_rawgetp(ls, -1, &tablegen_ref_key);
+  int ref = !lua_isnil(ls, -1);
+  lua_pop(ls, 2);
+  return ref ? ((tablegen_ref*)p)->ptr : p;
+}
+
+void* tablegen_checkobject(lua_State* ls, int index, const char* name) {
+  void* p = luaL_testudata(ls, index, name);
+  if (p != NULL) return p;
+  p = lua_touserdata(ls, index);
+  if (p != NULL && lua_getmetatable(ls, index)) {
+    lua_rawgetp(ls, -1, &tablegen_ref_key);
+    int same = lua_isstring(ls, -1) && strcmp(lua_tostring(ls, -1), name) == 0;
+    lua_pop(ls, 2);
+    if (same) return ((tablegen_ref*)p)->ptr;
+  }
+  luaL_argerror(ls, index, name);
+  return NULL;
+}
+
+void tablegen_cache_set(lua_State* ls, void* ptr) {
+  lua_checkstack(ls, 4);
+  tablegen_weak_table(ls, &tablegen_cache_key, "v");
+  lua_pushvalue(ls, -2);
+  lua_rawsetp(ls, -2, ptr);
+  lua_pop(ls, 1);
+}
+
+void tablegen_cache_get(lua_State* ls, void* ptr) {
+  lua_checkstack(ls, 4);
+  tablegen_weak_table(ls, &tablegen_cache_key, "v");
+  lua_rawgetp(ls, -1, ptr);
+  lua_remove(ls, -2);
+}
+
+static void tablegen_anchors(lua_State* ls, int owner) {
+  owner = lua_absindex(ls, owner);
+  lua_checkstack(ls, 5);
+  tablegen_weak_table(ls, &tablegen_anchor_key, "k");
+  lua_pushvalue(ls, owner);
+  lua_rawget(ls, -2);
+  if (!lua_istable(ls, -1)) {
+    lua_pop(ls, 1);
+    lua_newtable(ls);
+    lua_pushvalue(ls, owner);
+    lua_pushvalue(ls, -2);
+    lua_rawset(ls, -4);
+  }
+  lua_remove(ls, -2);
+}
+
+void tablegen_anchor(lua_State* ls, int owner, const char* field, int value) {
+  value = lua_absindex(ls, value);
+  tablegen_anchors(ls, owner);
+  lua_pushvalue(ls, value);
+  lua_setfield(ls, -2, field);
+  lua_pop(ls, 1);
+}
+
+void tablegen_anchor_element(lua_State* ls, int owner, const char* field, uint64_t index, int value) {
+  value = lua_absindex(ls, value);
+  tablegen_anchors(ls, owner);
+  lua_getfield(ls, -1, field);
+  if (!lua_istable(ls, -1)) {
+    lua_pop(ls, 1);
+    lua_newtable(ls);
+    lua_pushvalue(ls, -1);
+    lua_setfield(ls, -3, field);
+  }
+  lua_pushvalue(ls, value);
+  lua_rawseti(ls, -2, index + 1);
+  lua_pop(ls, 2);
+}
+""",
+# array fields are handed to lua as views that read the c array on demand. the
+# view asks its resolver for the current pointer and length on every access so
+# it stays valid when a setter replaces the array.
+"array_view": """
+static const char tablegen_view_key = 0;
+static const uint8_t tablegen_view_size[] = {
+  1, 1, 2, 2, 4, 4, 8, 8, sizeof(float), sizeof(double), sizeof(char*), sizeof(void*)
+};
+
+static tablegen_view* tablegen_check_view(lua_State* ls, int index) {
+  tablegen_view* view = lua_touserdata(ls, index);
+  if (view != NULL && lua_getmetatable(ls, index)) {
+    int same = lua_rawequal(ls, -1, lua_upvalueindex(1));
+    lua_pop(ls, 1);
+    if (same) return view;
+  }
+  luaL_argerror(ls, index, "array view expected");
+  return NULL;
+}
+
+// the part of the owner's array a view covers. slices are an offset and a
+// limit on top of whatever the resolver currently returns.
+static void tablegen_view_data(tablegen_view* view, void** data, uint64_t* length) {
+  view->resolve(view->owner, data, length);
+  if (view->offset >= *length) {
+    *length = 0;
+    return;
+  }
+  *length -= view->offset;
+  if (*length > view->limit) *length = view->limit;
+  *data = (char*)*data + view->offset * tablegen_view_size[view->kind];
+}
+
+// string.sub style range in arguments arg and arg + 1
+static void tablegen_view_range(lua_State* ls, int arg, uint64_t length, uint64_t* first, uint64_t* count) {
+  lua_Integer i = luaL_optinteger(ls, arg, 1);
+  lua_Integer j = luaL_optinteger(ls, arg + 1, -1);
+  if (i < 0) i += (lua_Integer)length + 1;
+  if (j < 0) j += (lua_Integer)length + 1;
+  if (i < 1) i = 1;
+  if (j > (lua_Integer)length) j = (lua_Integer)length;
+  *first = i <= j ? (uint64_t)i - 1 : 0;
+  *count = i <= j ? (uint64_t)(j - i + 1) : 0;
+}
+
+static void tablegen_view_push(lua_State* ls, int kind, void* data, uint64_t i) {
+  switch (kind) {
+  case TABLEGEN_INT8: lua_pushinteger(ls, ((int8_t*)data)[i]); break;
+  case TABLEGEN_UINT8: lua_pushinteger(ls, ((uint8_t*)data)[i]); break;
+  case TABLEGEN_INT16: lua_pushinteger(ls, ((int16_t*)data)[i]); break;
+  case TABLEGEN_UINT16: lua_pushinteger(ls, ((uint16_t*)data)[i]); break;
+  case TABLEGEN_INT32: lua_pushinteger(ls, ((int32_t*)data)[i]); break;
+  case TABLEGEN_UINT32: lua_pushinteger(ls, ((uint32_t*)data)[i]); break;
+  case TABLEGEN_INT64: lua_pushinteger(ls, ((int64_t*)data)[i]); break;
+  case TABLEGEN_UINT64: lua_pushinteger(ls, (lua_Integer)((uint64_t*)data)[i]); break;
+  case TABLEGEN_FLOAT: lua_pushnumber(ls, ((float*)data)[i]); break;
+  case TABLEGEN_DOUBLE: lua_pushnumber(ls, ((double*)data)[i]); break;
+  case TABLEGEN_STRING: lua_pushstring(ls, ((char**)data)[i]); break;
+  case TABLEGEN_OBJECT: tablegen_cache_get(ls, ((void**)data)[i]); break;
+  default: lua_pushnil(ls);
+  }
+}
+
+static int tablegen_view_index(lua_State* ls) {
+  tablegen_view* view = tablegen_check_view(ls, 1);
+  void* data;
+  uint64_t length;
+  int isnum;
+  lua_Integer i;
+  if (lua_type(ls, 2) == LUA_TSTRING) {
+    lua_pushvalue(ls, 2);
+    lua_rawget(ls, lua_upvalueindex(2));
+    return 1;
+  }
+  i = lua_tointegerx(ls, 2, &isnum);
+  tablegen_view_data(view, &data, &length);
+  if (!isnum || i < 1 || (uint64_t)i > length) {
+    lua_pushnil(ls);
+    return 1;
+  }
+  tablegen_view_push(ls, view->kind, data, i - 1);
+  return 1;
+}
+
+static int tablegen_view_newindex(lua_State* ls) {
+  tablegen_view* view = tablegen_check_view(ls, 1);
+  void* data;
+  uint64_t length;
+  lua_Integer i = luaL_checkinteger(ls, 2);
+  tablegen_view_data(view, &data, &length);
+  luaL_argcheck(ls, i >= 1 && (uint64_t)i <= length, 2, "index out of range");
+  switch (view->kind) {
+  case TABLEGEN_INT8: ((int8_t*)data)[i - 1] = luaL_checkinteger(ls, 3); return 0;
+  case TABLEGEN_UINT8: ((uint8_t*)data)[i - 1] = luaL_checkinteger(ls, 3); return 0;
+  case TABLEGEN_INT16: ((int16_t*)data)[i - 1] = luaL_checkinteger(ls, 3); return 0;
+  case TABLEGEN_UINT16: ((uint16_t*)data)[i - 1] = luaL_checkinteger(ls, 3); return 0;
+  case TABLEGEN_INT32: ((int32_t*)data)[i - 1] = luaL_checkinteger(ls, 3); return 0;
+  case TABLEGEN_UINT32: ((uint32_t*)data)[i - 1] = luaL_checkinteger(ls, 3); return 0;
+  case TABLEGEN_INT64: ((int64_t*)data)[i - 1] = luaL_checkinteger(ls, 3); return 0;
+  case TABLEGEN_UINT64: ((uint64_t*)data)[i - 1] = luaL_checkinteger(ls, 3); return 0;
+  case TABLEGEN_FLOAT: ((float*)data)[i - 1] = luaL_checknumber(ls, 3); return 0;
+  case TABLEGEN_DOUBLE: ((double*)data)[i - 1] = luaL_checknumber(ls, 3); return 0;
+  case TABLEGEN_STRING: ((const char**)data)[i - 1] = luaL_checkstring(ls, 3); break;
+  case TABLEGEN_OBJECT:
+    luaL_checktype(ls, 3, LUA_TUSERDATA);
+    ((void**)data)[i - 1] = tablegen_toobject(ls, 3);
+    break;
+  default: return luaL_error(ls, "array view is read-only");
+  }
+  // strings and objects are referenced from c, keep them alive with the owner
+  tablegen_anchors(ls, 1);
+  lua_getfield(ls, -1, "owner");
+  tablegen_anchor_element(ls, -1, view->field, view->offset + i - 1, 3);
+  lua_pop(ls, 2);
+  return 0;
+}
+
+static int tablegen_view_len(lua_State* ls) {
+  tablegen_view* view = tablegen_check_view(ls, 1);
+  void* data;
+  uint64_t length;
+  tablegen_view_data(view, &data, &length);
+  lua_pushinteger(ls, (lua_Integer)length);
+  return 1;
+}
+
+static int tablegen_view_next(lua_State* ls) {
+  tablegen_view* view = tablegen_check_view(ls, 1);
+  void* data;
+  uint64_t length;
+  lua_Integer i = luaL_checkinteger(ls, 2) + 1;
+  tablegen_view_data(view, &data, &length);
+  if (i < 1 || (uint64_t)i > length) return 0;
+  lua_pushinteger(ls, i);
+  tablegen_view_push(ls, view->kind, data, i - 1);
+  return 2;
+}
+
+static int tablegen_view_pairs(lua_State* ls) {
+  tablegen_check_view(ls, 1);
+  lua_pushvalue(ls, lua_upvalueindex(1));
+  lua_pushcclosure(ls, tablegen_view_next, 1);
+  lua_pushvalue(ls, 1);
+  lua_pushinteger(ls, 0);
+  return 3;
+}
+
+static tablegen_view* tablegen_new_view(lua_State* ls, const tablegen_view* from);
+
+// view:sub(i [, j]), a view of part of the array sharing the same memory
+static int tablegen_view_sub(lua_State* ls) {
+  tablegen_view* view = tablegen_check_view(ls, 1);
+  tablegen_view* slice;
+  void* data;
+  uint64_t length, first, count;
+  tablegen_view_data(view, &data, &length);
+  tablegen_view_range(ls, 2, length, &first, &count);
+  slice = tablegen_new_view(ls, view);
+  slice->offset = view->offset + first;
+  slice->limit = count;
+  tablegen_anchors(ls, 1);
+  lua_getfield(ls, -1, "owner");
+  tablegen_anchor(ls, -3, "owner", -1);
+  lua_pop(ls, 2);
+  return 1;
+}
+
+// view:bytes([i [, j]]), the raw elements as a lua string
+static int tablegen_view_bytes(lua_State* ls) {
+  tablegen_view* view = tablegen_check_view(ls, 1);
+  void* data;
+  uint64_t length, first, count;
+  if (view->kind == TABLEGEN_STRING || view->kind == TABLEGEN_OBJECT)
+    return luaL_error(ls, "array view has no byte representation");
+  tablegen_view_data(view, &data, &length);
+  tablegen_view_range(ls, 2, length, &first, &count);
+  lua_pushlstring(ls, (const char*)data + first * tablegen_view_size[view->kind],
+                  count * tablegen_view_size[view->kind]);
+  return 1;
+}
+
+static const luaL_Reg tablegen_view_meta[] = {
+  {"__index", tablegen_view_index},
+  {"__newindex", tablegen_view_newindex},
+  {"__len", tablegen_view_len},
+  {"__pairs", tablegen_view_pairs},
+  {"__ipairs", tablegen_view_pairs},
+  {0, 0}
+};
+
+static const luaL_Reg tablegen_view_methods[] = {
+  {"sub", tablegen_view_sub},
+  {"bytes", tablegen_view_bytes},
+  {0, 0}
+};
+
+// the metatable is upvalue 1 of every view function, the methods table
+// upvalue 2 of the metamethods
+static void tablegen_view_metatable(lua_State* ls) {
+  lua_rawgetp(ls, LUA_REGISTRYINDEX, &tablegen_view_key);
+  if (lua_istable(ls, -1)) return;
+  lua_pop(ls, 1);
+  lua_newtable(ls);
+  lua_newtable(ls);
+  lua_pushvalue(ls, -2);
+  luaL_setfuncs(ls, tablegen_view_methods, 1);
+  lua_pushvalue(ls, -2);
+  lua_insert(ls, -2);
+  luaL_setfuncs(ls, tablegen_view_meta, 2);
+  lua_pushvalue(ls, -1);
+  lua_rawsetp(ls, LUA_REGISTRYINDEX, &tablegen_view_key);
+}
+
+static tablegen_view* tablegen_new_view(lua_State* ls, const tablegen_view* from) {
+  tablegen_view* view = lua_newuserdata(ls, sizeof(tablegen_view));
+  *view = *from;
+  tablegen_view_metatable(ls);
+  lua_setmetatable(ls, -2);
+  return view;
+}
+
+// the elements of a view of the given kind, or of a string holding them
+// back to back. NULL if the value at index is neither.
+const void* tablegen_buffer(lua_State* ls, int index, int kind, uint64_t* length) {
+  void* data;
+  if (lua_type(ls, index) == LUA_TSTRING) {
+    size_t size;
+    const char* bytes = lua_tolstring(ls, index, &size);
+    if (kind == TABLEGEN_STRING || kind == TABLEGEN_OBJECT || size % tablegen_view_size[kind] != 0) return NULL;
+    *length = size / tablegen_view_size[kind];
+    return bytes;
+  }
+  if (!lua_getmetatable(ls, index)) return NULL;
+  tablegen_view_metatable(ls);
+  if (!lua_rawequal(ls, -1, -2) || ((tablegen_view*)lua_touserdata(ls, index))->kind != kind) {
+    lua_pop(ls, 2);
+    return NULL;
+  }
+  lua_pop(ls, 2);
+  tablegen_view_data(lua_touserdata(ls, index), &data, length);
+  return data;
+}
+
+void tablegen_push_view(lua_State* ls, int owner, tablegen_resolve resolve, int kind, const char* field) {
+  tablegen_view view = {NULL, resolve, kind, field, 0, UINT64_MAX};
+  owner = lua_absindex(ls, owner);
+  lua_checkstack(ls, 6);
+  // one view per owner and field, found through the resolver's address
+  tablegen_anchors(ls, owner);
+  lua_rawgetp(ls, -1, (const void*)resolve);
+  if (lua_isuserdata(ls, -1)) {
+    lua_remove(ls, -2);
+    return;
+  }
+  lua_pop(ls, 1);
+  view.owner = tablegen_toobject(ls, owner);
+  tablegen_new_view(ls, &view);
+  tablegen_anchor(ls, -1, "owner", owner);
+  lua_pushvalue(ls, -1);
+  lua_rawsetp(ls, -3, (const void*)resolve);
+  lua_remove(ls, -2);
+}
+""",
+"object_cache_decl": """typedef struct {
+  void* ptr;
+  uint8_t* owned;
+} tablegen_ref;
+void tablegen_setfuncs(lua_State* ls, int table, int metatables, const luaL_Reg* funcs);
+void tablegen_mark_ref(lua_State* ls, int metatable, const char* name);
+void* tablegen_toobject(lua_State* ls, int index);
+void* tablegen_checkobject(lua_State* ls, int index, const char* name);
+void tablegen_cache_set(lua_State* ls, void* ptr);
+void tablegen_cache_get(lua_State* ls, void* ptr);
+void tablegen_anchor(lua_State* ls, int owner, const char* field, int value);
+void tablegen_anchor_element(lua_State* ls, int owner, const char* field, uint64_t index, int value);
+""",
+"array_view_decl": """enum {
+  TABLEGEN_INT8, TABLEGEN_UINT8, TABLEGEN_INT16, TABLEGEN_UINT16,
+  TABLEGEN_INT32, TABLEGEN_UINT32, TABLEGEN_INT64, TABLEGEN_UINT64,
+  TABLEGEN_FLOAT, TABLEGEN_DOUBLE, TABLEGEN_STRING, TABLEGEN_OBJECT
+};
+typedef void (*tablegen_resolve)(void* owner, void** data, uint64_t* length);
+typedef struct {
+  void* owner;
+  tablegen_resolve resolve;
+  int kind;
+  const char* field;
+  uint64_t offset;
+  uint64_t limit;
+} tablegen_view;
+void tablegen_push_view(lua_State* ls, int owner, tablegen_resolve resolve, int kind, const char* field);
+const void* tablegen_buffer(lua_State* ls, int index, int kind, uint64_t* length);
+""",
+"view_resolve": """static void view_${struct}_${field}(void* owner, void** data, uint64_t* length) {
+	${struct}* dummy = owner;
+	*data = (void*)dummy->${field};
+	*length = dummy->${field} != NULL ? ${count} : 0;
+}
+""",
+# binary pack/unpack. a packed struct is "TBG", the format version, the struct
+# name and then its fields in schema order. integers are leb128 where the
+# schema says so and little endian otherwise, strings and arrays are prefixed
+# with their length and nested structs with a presence byte.
+"pack_runtime": """
+void tablegen_pack_uleb(luaL_Buffer* b, uint64_t value) {
+  do {
+    uint8_t byte = value & 0x7f;
+    value >>= 7;
+    luaL_addchar(b, (char)(value != 0 ? byte | 0x80 : byte));
+  } while (value != 0);
+}
+
+void tablegen_pack_sleb(luaL_Buffer* b, int64_t value) {
+  for (;;) {
+    uint8_t byte = value & 0x7f;
+    value >>= 7;
+    if ((value == 0 && !(byte & 0x40)) || (value == -1 && (byte & 0x40))) {
+      luaL_addchar(b, (char)byte);
+      return;
+    }
+    luaL_addchar(b, (char)(byte | 0x80));
+  }
+}
+
+void tablegen_pack_fixed(luaL_Buffer* b, uint64_t value, int width) {
+  for (int i = 0; i < width; ++i) luaL_addchar(b, (char)((value >> (8 * i)) & 0xff));
+}
+
+void tablegen_pack_float(luaL_Buffer* b, float value) {
+  uint32_t bits;
+  memcpy(&bits, &value, sizeof(bits));
+  tablegen_pack_fixed(b, bits, 4);
+}
+
+void tablegen_pack_double(luaL_Buffer* b, double value) {
+  uint64_t bits;
+  memcpy(&bits, &value, sizeof(bits));
+  tablegen_pack_fixed(b, bits, 8);
+}
+
+// 0 for NULL, otherwise the length plus one and the bytes
+void tablegen_pack_string(luaL_Buffer* b, const char* value) {
+  if (value == NULL) {
+    tablegen_pack_uleb(b, 0);
+    return;
+  }
+  size_t length = strlen(value);
+  tablegen_pack_uleb(b, (uint64_t)length + 1);
+  luaL_addlstring(b, value, length);
+}
+
+int tablegen_pack_present(luaL_Buffer* b, const void* value, int depth) {
+  if (depth > TABLEGEN_PACK_DEPTH) luaL_error(b->L, "structs nested too deep to pack");
+  luaL_addchar(b, value != NULL ? 1 : 0);
+  return value != NULL;
+}
+
+void tablegen_pack_header(luaL_Buffer* b, const char* name) {
+  luaL_addlstring(b, "TBG", 3);
+  luaL_addchar(b, TABLEGEN_PACK_VERSION);
+  tablegen_pack_string(b, name);
+}
+
+static void tablegen_unpack_truncated(tablegen_reader* r) {
+  luaL_error(r->ls, "packed data ends at byte %d", (int)r->length);
+}
+
+uint8_t tablegen_unpack_byte(tablegen_reader* r) {
+  if (r->pos >= r->length) tablegen_unpack_truncated(r);
+  return r->data[r->pos++];
+}
+
+uint64_t tablegen_unpack_uleb(tablegen_reader* r) {
+  uint64_t value = 0;
+  for (int shift = 0; shift < 64; shift += 7) {
+    uint8_t byte = tablegen_unpack_byte(r);
+    value |= (uint64_t)(byte & 0x7f) << shift;
+    if (!(byte & 0x80)) return value;
+  }
+  luaL_error(r->ls, "leb128 longer than 64 bits at byte %d", (int)r->pos);
+  return 0;
+}
+
+int64_t tablegen_unpack_sleb(tablegen_reader* r) {
+  uint64_t value = 0;
+  int shift = 0;
+  uint8_t byte;
+  do {
+    if (shift >= 64) luaL_error(r->ls, "leb128 longer than 64 bits at byte %d", (int)r->pos);
+    byte = tablegen_unpack_byte(r);
+    value |= (uint64_t)(byte & 0x7f) << shift;
+    shift += 7;
+  } while (byte & 0x80);
+  if (shift < 64 && (byte & 0x40)) value |= ~(uint64_t)0 << shift;
+  return (int64_t)value;
+}
+
+uint64_t tablegen_unpack_fixed(tablegen_reader* r, int width) {
+  if (r->length - r->pos < (size_t)width) tablegen_unpack_truncated(r);
+  uint64_t value = 0;
+  for (int i = 0; i < width; ++i) value |= (uint64_t)r->data[r->pos + i] << (8 * i);
+  r->pos += width;
+  return value;
+}
+
+float tablegen_unpack_float(tablegen_reader* r) {
+  uint32_t bits = (uint32_t)tablegen_unpack_fixed(r, 4);
+  float value;
+  memcpy(&value, &bits, sizeof(value));
+  return value;
+}
+
+double tablegen_unpack_double(tablegen_reader* r) {
+  uint64_t bits = tablegen_unpack_fixed(r, 8);
+  double value;
+  memcpy(&value, &bits, sizeof(value));
+  return value;
+}
+
+// the string is anchored to owner under field, or under field[index + 1] when
+// index is not negative
+const char* tablegen_unpack_string(tablegen_reader* r, int owner, const char* field, int64_t index) {
+  uint64_t length = tablegen_unpack_uleb(r);
+  if (length-- == 0) return NULL;
+  if (r->length - r->pos < length) tablegen_unpack_truncated(r);
+  lua_pushlstring(r->ls, (const char*)r->data + r->pos, (size_t)length);
+  r->pos += length;
+  if (index < 0) tablegen_anchor(r->ls, owner, field, -1);
+  else tablegen_anchor_element(r->ls, owner, field, (uint64_t)index, -1);
+  const char* value = lua_tostring(r->ls, -1);
+  lua_pop(r->ls, 1);
+  return value;
+}
+
+int tablegen_unpack_present(tablegen_reader* r, int depth) {
+  if (depth > TABLEGEN_PACK_DEPTH) luaL_error(r->ls, "structs nested too deep to unpack");
+  if (!lua_checkstack(r->ls, 8)) luaL_error(r->ls, "stack overflow");
+  return tablegen_unpack_byte(r) != 0;
+}
+
+// every element takes at least a byte, which bounds what a length can ask for
+void* tablegen_unpack_array(tablegen_reader* r, uint64_t* length, size_t size) {
+  *length = tablegen_unpack_uleb(r);
+  if (*length > r->length - r->pos) tablegen_unpack_truncated(r);
+  if (*length == 0) return NULL;
+  void* array = calloc((size_t)*length, size);
+  if (array == NULL) luaL_error(r->ls, "not enough memory");
+  return array;
+}
+
+// reads the string at argument 1 from the offset at argument 2
+void tablegen_unpack_header(lua_State* ls, tablegen_reader* r, const char* name) {
+  size_t length;
+  r->ls = ls;
+  r->data = (const uint8_t*)luaL_checklstring(ls, 1, &length);
+  r->length = length;
+  lua_Integer offset = luaL_optinteger(ls, 2, 1);
+  luaL_argcheck(ls, offset >= 1 && (size_t)offset <= length + 1, 2, "offset out of range");
+  r->pos = (size_t)offset - 1;
+  if (r->length - r->pos < 4 || memcmp(r->data + r->pos, "TBG", 3) != 0) luaL_error(ls, "not a packed %s", name);
+  if (r->data[r->pos + 3] != TABLEGEN_PACK_VERSION) luaL_error(ls, "packed with format version %d, this is version %d", r->data[r->pos + 3], TABLEGEN_PACK_VERSION);
+  r->pos += 4;
+  uint64_t name_length = tablegen_unpack_uleb(r);
+  if (name_length == 0 || r->length - r->pos < name_length - 1 || strlen(name) != name_length - 1 ||
+      memcmp(r->data + r->pos, name, name_length - 1) != 0) luaL_error(ls, "not a packed %s", name);
+  r->pos += name_length - 1;
+}
+""",
+"pack_runtime_decl": """#define TABLEGEN_PACK_VERSION 1
+#define TABLEGEN_PACK_DEPTH 200
+typedef struct {
+  lua_State* ls;
+  const uint8_t* data;
+  size_t length;
+  size_t pos;
+} tablegen_reader;
+void tablegen_pack_uleb(luaL_Buffer* b, uint64_t value);
+void tablegen_pack_sleb(luaL_Buffer* b, int64_t value);
+void tablegen_pack_fixed(luaL_Buffer* b, uint64_t value, int width);
+void tablegen_pack_float(luaL_Buffer* b, float value);
+void tablegen_pack_double(luaL_Buffer* b, double value);
+void tablegen_pack_string(luaL_Buffer* b, const char* value);
+int tablegen_pack_present(luaL_Buffer* b, const void* value, int depth);
+void tablegen_pack_header(luaL_Buffer* b, const char* name);
+uint8_t tablegen_unpack_byte(tablegen_reader* r);
+uint64_t tablegen_unpack_uleb(tablegen_reader* r);
+int64_t tablegen_unpack_sleb(tablegen_reader* r);
+uint64_t tablegen_unpack_fixed(tablegen_reader* r, int width);
+float tablegen_unpack_float(tablegen_reader* r);
+double tablegen_unpack_double(tablegen_reader* r);
+const char* tablegen_unpack_string(tablegen_reader* r, int owner, const char* field, int64_t index);
+int tablegen_unpack_present(tablegen_reader* r, int depth);
+void* tablegen_unpack_array(tablegen_reader* r, uint64_t* length, size_t size);
+void tablegen_unpack_header(lua_State* ls, tablegen_reader* r, const char* name);
+""",
+# the fields are packed by functions that take the struct itself so nested
+# structs of other types are packed without going through lua
+"pack": """${refs}${linkage}void pack_${struct}_body(luaL_Buffer* b, ${struct}* _st, int depth) {
+${pack}}
+
+${linkage}void unpack_${struct}_body(lua_State* __ls, tablegen_reader* r, int self, int depth) {
+\t${struct}* dummy = lua_touserdata(__ls, self);
+\tuint8_t* owned = (uint8_t*)(dummy + 1);
+\t(void)owned;
+${unpack}}
+
+static int pack_${struct}(lua_State* __ls) {
+${probe}\t${struct}* dummy = check_${struct}(__ls, 1);
+\tluaL_Buffer b;
+\tluaL_buffinit(__ls, &b);
+\ttablegen_pack_header(&b, "${struct}");
+\tpack_${struct}_body(&b, dummy, 0);
+\tluaL_pushresult(&b);
+\treturn 1;
+}
+
+static int unpack_${struct}(lua_State* __ls) {
+${probe_unpack}\ttablegen_reader r;
+\ttablegen_unpack_header(__ls, &r, "${struct}");
+\tpush_${struct}(__ls);
+\tunpack_${struct}_body(__ls, &r, lua_gettop(__ls), 0);
+\tlua_pushinteger(__ls, (lua_Integer)r.pos + 1);
+\treturn 2;
+}
+
+""",
+"pack_ref_decl": """${linkage}${struct}* push_${struct}(lua_State* __ls);
+${linkage}void pack_${struct}_body(luaL_Buffer* b, ${struct}* _st, int depth);
+${linkage}void unpack_${struct}_body(lua_State* __ls, tablegen_reader* r, int self, int depth);
+""",
+# --decoder. reads the binary format the <Read> section describes straight into
+# the structs. everything decoded lives in an arena the decoder frees at once.
+"decoder_header": """// automatically generated by luatablegen
+// ${time}
+
+#ifndef _${name}_DECODER_H
+#define _${name}_DECODER_H
+#ifdef __cplusplus
+extern "C" {
+#endif
+${structs}
+typedef struct ${name}_decoder {
+  const uint8_t* data;
+  uint64_t length;
+  uint64_t pos;
+  // why and at which byte decoding stopped, NULL while the input is fine
+  const char* error;
+  uint64_t error_pos;
+  void* arena;
+  void* mapping;
+} ${name}_decoder;
+
+typedef struct {
+${fields}} ${name}_decoded;
+
+// maps the file at path, NULL if it can not be opened or mapped
+${name}_decoder* ${name}_decoder_open(const char* path);
+// decodes length bytes at data, which have to outlive the decoder
+${name}_decoder* ${name}_decoder_memory(const void* data, uint64_t length);
+// NULL if the input is malformed. strings and byte arrays point into the
+// input, everything else is freed with the decoder.
+${name}_decoded* ${name}_decode(${name}_decoder* d);
+void ${name}_decoder_close(${name}_decoder* d);
+#ifdef __cplusplus
+}
+#endif //end of extern c
+#endif //end of inclusion guard
+
+""",
+"decoder_source": """// automatically generated by luatablegen
+// ${time}
+
+#include <fcntl.h>
+#include <stdlib.h>
+#include <string.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include <unistd.h>
+#include "${header}"
+
+#define TABLEGEN_DECODE_DEPTH 200
+#define TABLEGEN_ARENA_BLOCK (64 * 1024)
+
+typedef struct tablegen_arena_block {
+  struct tablegen_arena_block* next;
+  size_t used;
+  size_t size;
+} tablegen_arena_block;
+
+#define TABLEGEN_ARENA_HEADER ((sizeof(tablegen_arena_block) + 15) & ~(size_t)15)
+
+// the first error sticks. the input is treated as used up after it so every
+// later read fails right away and the loops end.
+static void tablegen_decode_fail(${name}_decoder* d, const char* message) {
+  if (d->error == NULL) {
+    d->error = message;
+    d->error_pos = d->pos;
+  }
+  d->pos = d->length;
+}
+
+// zeroed and 16 byte aligned. large allocations get a block of their own
+// behind the current one so it keeps being filled.
+static void* tablegen_decode_alloc(${name}_decoder* d, uint64_t size) {
+  size = (size + 15) & ~(uint64_t)15;
+  tablegen_arena_block* block = d->arena;
+  if (block != NULL && block->size - block->used >= size) {
+    void* p = (char*)block + TABLEGEN_ARENA_HEADER + block->used;
+    block->used += size;
+    return p;
+  }
+  if (size > SIZE_MAX - TABLEGEN_ARENA_HEADER - TABLEGEN_ARENA_BLOCK) {
+    tablegen_decode_fail(d, "not enough memory");
+    return NULL;
+  }
+  size_t block_size = size > TABLEGEN_ARENA_BLOCK / 4 ? size : TABLEGEN_ARENA_BLOCK;
+  tablegen_arena_block* fresh = calloc(1, TABLEGEN_ARENA_HEADER + block_size);
+  if (fresh == NULL) {
+    tablegen_decode_fail(d, "not enough memory");
+    return NULL;
+  }
+  fresh->used = size;
+  fresh->size = block_size;
+  if (block != NULL && block_size == size) {
+    fresh->next = block->next;
+    block->next = fresh;
+  } else {
+    fresh->next = block;
+    d->arena = fresh;
+  }
+  return (char*)fresh + TABLEGEN_ARENA_HEADER;
+}
+
+static inline uint64_t tablegen_decode_uleb(${name}_decoder* d) {
+  if (d->pos < d->length && d->data[d->pos] < 0x80) return d->data[d->pos++];
+  uint64_t value = 0;
+  for (int shift = 0; shift < 64; shift += 7) {
+    if (d->pos >= d->length) {
+      tablegen_decode_fail(d, "input ends inside a leb128");
+      return 0;
+    }
+    uint8_t byte = d->data[d->pos++];
+    value |= (uint64_t)(byte & 0x7f) << shift;
+    if (!(byte & 0x80)) return value;
+  }
+  tablegen_decode_fail(d, "leb128 longer than 64 bits");
+  return 0;
+}
+
+static inline int64_t tablegen_decode_sleb(${name}_decoder* d) {
+  uint64_t value = 0;
+  int shift = 0;
+  uint8_t byte;
+  do {
+    if (shift >= 64) {
+      tablegen_decode_fail(d, "leb128 longer than 64 bits");
+      return 0;
+    }
+    if (d->pos >= d->length) {
+      tablegen_decode_fail(d, "input ends inside a leb128");
+      return 0;
+    }
+    byte = d->data[d->pos++];
+    value |= (uint64_t)(byte & 0x7f) << shift;
+    shift += 7;
+  } while (byte & 0x80);
+  if (shift < 64 && (byte & 0x40)) value |= ~(uint64_t)0 << shift;
+  return (int64_t)value;
+}
+
+static inline uint64_t tablegen_decode_fixed(${name}_decoder* d, int width) {
+  if (d->length - d->pos < (uint64_t)width) {
+    tablegen_decode_fail(d, "input ends inside a field");
+    return 0;
+  }
+  uint64_t value = 0;
+  for (int i = 0; i < width; ++i) value |= (uint64_t)d->data[d->pos + i] << (8 * i);
+  d->pos += width;
+  return value;
+}
+
+static inline float tablegen_decode_float(${name}_decoder* d) {
+  uint32_t bits = (uint32_t)tablegen_decode_fixed(d, 4);
+  float value;
+  memcpy(&value, &bits, sizeof(value));
+  return value;
+}
+
+static inline double tablegen_decode_double(${name}_decoder* d) {
+  uint64_t bits = tablegen_decode_fixed(d, 8);
+  double value;
+  memcpy(&value, &bits, sizeof(value));
+  return value;
+}
+
+// length bytes of the input, not copied
+static inline const uint8_t* tablegen_decode_bytes(${name}_decoder* d, uint64_t length) {
+  if (d->length - d->pos < length) {
+    tablegen_decode_fail(d, "input ends inside a field");
+    return NULL;
+  }
+  const uint8_t* p = d->data + d->pos;
+  d->pos += length;
+  return p;
+}
+
+// the bytes up to and including the delimiter, not copied
+static inline const uint8_t* tablegen_decode_delimited(${name}_decoder* d, uint8_t delimiter) {
+  const uint8_t* end = memchr(d->data + d->pos, delimiter, d->length - d->pos);
+  if (end == NULL) {
+    tablegen_decode_fail(d, "input ends before a delimiter");
+    return NULL;
+  }
+  return tablegen_decode_bytes(d, end - (d->data + d->pos) + 1);
+}
+
+// strings that are not nul terminated in the input are copied into the arena
+// and terminated there, so that they can be handed to lua_pushstring
+static inline char* tablegen_decode_copy(${name}_decoder* d, const uint8_t* bytes, uint64_t length) {
+  if (bytes == NULL) return NULL;
+  char* string = tablegen_decode_alloc(d, length + 1);
+  if (string != NULL) memcpy(string, bytes, length);
+  return string;
+}
+
+static inline char* tablegen_decode_string(${name}_decoder* d, uint64_t length) {
+  return tablegen_decode_copy(d, tablegen_decode_bytes(d, length), length);
+}
+
+static inline char* tablegen_decode_delimited_string(${name}_decoder* d, uint8_t delimiter) {
+  uint64_t start = d->pos;
+  const uint8_t* bytes = tablegen_decode_delimited(d, delimiter);
+  return tablegen_decode_copy(d, bytes, d->pos - start);
+}
+
+// every element takes at least a byte, which bounds what a count can ask for
+static inline void* tablegen_decode_array(${name}_decoder* d, uint64_t* length, size_t size) {
+  if (*length > d->length - d->pos) {
+    tablegen_decode_fail(d, "count larger than the rest of the input");
+    *length = 0;
+  }
+  if (*length == 0) return NULL;
+  void* array = tablegen_decode_alloc(d, *length * size);
+  if (array == NULL) *length = 0;
+  return array;
+}
+
+// room for one more entry of a repeated element, the list doubles when full
+static inline void** tablegen_decode_append(${name}_decoder* d, void** list, uint64_t count) {
+  if (count != 0 && (count < 4 || (count & (count - 1)) != 0)) return list;
+  void** grown = tablegen_decode_alloc(d, (count < 4 ? 4 : count * 2) * sizeof(void*));
+  if (grown != NULL && count != 0) memcpy(grown, list, count * sizeof(void*));
+  return grown;
+}
+
+static int tablegen_decode_depth(${name}_decoder* d, int depth) {
+  if (depth <= TABLEGEN_DECODE_DEPTH) return 1;
+  tablegen_decode_fail(d, "structs nested too deep");
+  return 0;
+}
+
+${name}_decoder* ${name}_decoder_memory(const void* data, uint64_t length) {
+  ${name}_decoder* d = calloc(1, sizeof(${name}_decoder));
+  if (d == NULL) return NULL;
+  d->data = data;
+  d->length = length;
+  return d;
+}
+
+// the mapping is private and writable, a setter writing to a string or byte
+// array of a decoded struct gets its own copy of the page
+${name}_decoder* ${name}_decoder_open(const char* path) {
+  int fd = open(path, O_RDONLY);
+  if (fd < 0) return NULL;
+  struct stat st;
+  if (fstat(fd, &st) != 0 || (uint64_t)st.st_size > SIZE_MAX) {
+    close(fd);
+    return NULL;
+  }
+  void* mapping = NULL;
+  if (st.st_size > 0) {
+    mapping = mmap(NULL, (size_t)st.st_size, PROT_READ | PROT_WRITE, MAP_PRIVATE, fd, 0);
+    if (mapping == MAP_FAILED) {
+      close(fd);
+      return NULL;
+    }
+#ifdef MADV_SEQUENTIAL
+    madvise(mapping, (size_t)st.st_size, MADV_SEQUENTIAL);
+#endif
+  }
+  close(fd);
+  ${name}_decoder* d = ${name}_decoder_memory(mapping, (uint64_t)st.st_size);
+  if (d == NULL) {
+    if (mapping != NULL) munmap(mapping, (size_t)st.st_size);
+    return NULL;
+  }
+  d->mapping = mapping;
+  return d;
+}
+
+void ${name}_decoder_close(${name}_decoder* d) {
+  if (d == NULL) return;
+  tablegen_arena_block* block = d->arena;
+  while (block != NULL) {
+    tablegen_arena_block* next = block->next;
+    free(block);
+    block = next;
+  }
+  if (d->mapping != NULL) munmap(d->mapping, (size_t)d->length);
+  free(d);
+}
+
+${decls}
+${functions}${name}_decoded* ${name}_decode(${name}_decoder* d) {
+\td->pos = 0;
+\td->error = NULL;
+\t${name}_decoded* _st = tablegen_decode_alloc(d, sizeof(${name}_decoded));
+\tif (_st == NULL) return NULL;
+${body}\tif (d->error == NULL && d->pos != d->length) tablegen_decode_fail(d, "bytes left after the last element");
+\treturn d->error == NULL ? _st : NULL;
+}
+""",
+"decoder_struct_decl": """static ${struct}* decode_${struct}(${name}_decoder* d, int depth);
+""",
+"decoder_struct": """static ${struct}* decode_${struct}(${name}_decoder* d, int depth) {
+\tif (!tablegen_decode_depth(d, depth)) return NULL;
+\t${struct}* _st = tablegen_decode_alloc(d, sizeof(${struct}));
+\tif (_st == NULL) return NULL;
+${body}\treturn _st;
+}
+
+""",
+# unordered elements follow each other in any order, the value of their
+# discriminator field tells which one comes next
+"decoder_group": """\twhile (d->pos < d->length && d->error == NULL) {
+\t\tuint64_t start = d->pos;
+\t\tuint64_t id = ${id};
+\t\td->pos = start;
+\t\tif (d->error != NULL) break;
+\t\tswitch (id) {
+${cases}\t\tdefault:
+${default}\t\t}
+\t}
+${label}""",
+"decoder_case": """\t\tcase ${id}:
+\t\t\tif (_st->${field} != NULL) tablegen_decode_fail(d, "${tag} appears more than once");
+\t\t\telse _st->${field} = decode_${struct}(d, 0);
+\t\t\tbreak;
+""",
+"decoder_case_list": """\t\tcase ${id}: {
+${append}\t\t\tbreak;
+\t\t}
+""",
+"decoder_append": """\t\t\tvoid** list = tablegen_decode_append(d, (void**)_st->${field}, _st->${field}_count);
+\t\t\tif (list == NULL) break;
+\t\t\t_st->${field} = (${struct}**)list;
+\t\t\t_st->${field}[_st->${field}_count++] = decode_${struct}(d, 0);
+""",
+# --lazy. tables are registered the first time a script reads their global,
+# requires them or an object of theirs is made, instead of all at startup.
+"get_metatable": """\tluaL_getmetatable(__ls, "${name}");
+""",
+"lazy_metatable": """\ttablegen_lazy_metatable(__ls, "${name}", luaopen_${struct});
+""",
+"lazy_loader": """${linkage}int luaopen_${struct}(lua_State* __ls) {
+\tluaL_getmetatable(__ls, "${struct}");
+\tint registered = !lua_isnil(__ls, -1);
+\tlua_pop(__ls, 1);
+\tif (!registered) {
+\t\tint top = lua_gettop(__ls);
+\t\t${struct}_register(__ls, "${struct}");
+\t\tlua_settop(__ls, top);
+\t}
+\tlua_pushglobaltable(__ls);
+\tlua_getfield(__ls, -1, "${struct}");
+\tlua_remove(__ls, -2);
+\tif (!registered) tablegen_lazy_loaded(__ls, "${struct}", -1);
+\treturn 1;
+}
+
+""",
+"lazy_loader_decl": """${linkage}int luaopen_${struct}(lua_State* __ls);
+""",
+"lazy_registrations": """\tstatic const luaL_Reg loaders[] = {
+${loaders}\t\t{NULL, NULL}
+\t};
+\ttablegen_lazy_register(__ls, loaders);
+""",
+"lazy_loader_entry": """\t\t{"${struct}", luaopen_${struct}},
+""",
+"lazy_runtime": """
+static const char tablegen_onload_key = 0;
+
+// tablegen_onload(f), f(name, table) is called for every table registered
+// from then on. this is how lua code gets at tables without loading them all.
+static int tablegen_onload(lua_State* ls) {
+  luaL_checktype(ls, 1, LUA_TFUNCTION);
+  lua_rawgetp(ls, LUA_REGISTRYINDEX, &tablegen_onload_key);
+  if (!lua_istable(ls, -1)) {
+    lua_pop(ls, 1);
+    lua_newtable(ls);
+    lua_pushvalue(ls, -1);
+    lua_rawsetp(ls, LUA_REGISTRYINDEX, &tablegen_onload_key);
+  }
+  lua_pushvalue(ls, 1);
+  lua_rawseti(ls, -2, (lua_Integer)lua_rawlen(ls, -2) + 1);
+  return 0;
+}
+
+// runs the tablegen_onload functions for the table at index
+void tablegen_lazy_loaded(lua_State* ls, const char* name, int table) {
+  table = lua_absindex(ls, table);
+  lua_checkstack(ls, 5);
+  lua_rawgetp(ls, LUA_REGISTRYINDEX, &tablegen_onload_key);
+  if (lua_istable(ls, -1)) {
+    for (lua_Integer i = 1; lua_rawgeti(ls, -1, i) == LUA_TFUNCTION; ++i) {
+      lua_pushstring(ls, name);
+      lua_pushvalue(ls, table);
+      lua_call(ls, 2, 0);
+    }
+    lua_pop(ls, 1);
+  }
+  lua_pop(ls, 1);
+}
+
+// pushes the metatable called name, loading its table first if it is missing
+void tablegen_lazy_metatable(lua_State* ls, const char* name, lua_CFunction load) {
+  luaL_getmetatable(ls, name);
+  if (!lua_isnil(ls, -1)) return;
+  lua_pop(ls, 1);
+  load(ls);
+  lua_pop(ls, 1);
+  luaL_getmetatable(ls, name);
+}
+
+// __index of the globals. upvalue 1 maps names to loaders, upvalue 2 is the
+// __index the globals had before, which gets every other name.
+static int tablegen_lazy_index(lua_State* ls) {
+  lua_pushvalue(ls, 2);
+  lua_rawget(ls, lua_upvalueindex(1));
+  if (!lua_isnil(ls, -1)) {
+    lua_pushvalue(ls, 2);
+    lua_call(ls, 1, 1);
+    return 1;
+  }
+  if (lua_type(ls, lua_upvalueindex(2)) == LUA_TFUNCTION) {
+    lua_pushvalue(ls, lua_upvalueindex(2));
+    lua_pushvalue(ls, 1);
+    lua_pushvalue(ls, 2);
+    lua_call(ls, 2, 1);
+  } else if (lua_istable(ls, lua_upvalueindex(2))) {
+    lua_pushvalue(ls, 2);
+    lua_gettable(ls, lua_upvalueindex(2));
+  } else {
+    lua_pushnil(ls);
+  }
+  return 1;
+}
+
+// puts the loaders into package.preload and behind the globals' __index.
+// called again it adds to the loaders the hook already has.
+void tablegen_lazy_register(lua_State* ls, const luaL_Reg* loaders) {
+  lua_checkstack(ls, 6);
+  int top = lua_gettop(ls);
+  luaL_getsubtable(ls, LUA_REGISTRYINDEX, "_PRELOAD");
+  luaL_setfuncs(ls, loaders, 0);
+  lua_pushglobaltable(ls);
+  if (!lua_getmetatable(ls, -1)) {
+    lua_newtable(ls);
+    lua_pushvalue(ls, -1);
+    lua_setmetatable(ls, -3);
+  }
+  lua_pushliteral(ls, "__index");
+  lua_rawget(ls, -2);
+  if (lua_tocfunction(ls, -1) == tablegen_lazy_index) {
+    lua_getupvalue(ls, -1, 1);
+    luaL_setfuncs(ls, loaders, 0);
+  } else {
+    lua_newtable(ls);
+    luaL_setfuncs(ls, loaders, 0);
+    lua_insert(ls, -2);
+    lua_pushcclosure(ls, tablegen_lazy_index, 2);
+    lua_setfield(ls, -2, "__index");
+  }
+  lua_settop(ls, top);
+  lua_register(ls, "tablegen_onload", tablegen_onload);
+}
+""",
+"lazy_runtime_decl": """void tablegen_lazy_metatable(lua_State* ls, const char* name, lua_CFunction load);
+void tablegen_lazy_loaded(lua_State* ls, const char* name, int table);
+void tablegen_lazy_register(lua_State* ls, const luaL_Reg* loaders);
+""",
+"pushluatable": """
+int pushluatable_${name}(lua_State* ls, ${array_type} array, uint64_t count) {
+${probe}  if (!lua_checkstack(ls, 3)) {
     printf("Not enough space on the lua stack.");
     return -1;
   }
-  lua_newtable(ls);
-  uint64_t i = 0U;
-  for (int j = 0; j < count; ++j) {
-    lua_pushinteger(ls, i+1);
-    WWW_push_args(ls, array[i]);
-    new_WWW(ls);
-    lua_settable(ls, -3);
-    i++;
+  lua_createtable(ls, count > INT_MAX ? 0 : (int)count, 0);
+  for (uint64_t i = 0; i < count; ++i) {
+    if (array[i] == NULL) continue;
+    ${struct}_push_args(ls, array[i]);
+    new_${struct}(ls);
+    lua_rawseti(ls, -2, i + 1);
   }
   return 0;
 }
-"""
-LUA_PUSH_TABLE_SIMPLE_TYPE = """
-int pushluatable_YYY(lua_State* ls, XXX array, uint64_t count) {
-  if (!lua_checkstack(ls, 3)) {
+""",
+"pushluatable_simple": """
+int pushluatable_${name}(lua_State* ls, ${array_type} array, uint64_t count) {
+${probe}  if (!lua_checkstack(ls, 3)) {
     printf("Not enough space on the lua stack.");
     return -1;
   }
+  lua_createtable(ls, count > INT_MAX ? 0 : (int)count, 0);
+  for (uint64_t i = 0; i < count; ++i) {
+    lua_push${lua_type}(ls, array[i]);
+    lua_rawseti(ls, -2, i + 1);
+  }
+  return 0;
+}
+""",
+# --instrument. every entry point starts with TABLEGEN_PROBE which counts calls
+# and cycles when TABLEGEN_STATS is defined and is empty otherwise. the probe
+# ends through a cleanup attribute so every return is covered, that needs gcc
+# or clang and the probe is empty elsewhere. a lua error longjmps past the
+# cleanup, so a call is only counted once it returns, together with its cycles.
+"stats": """
+#ifdef TABLEGEN_STATS
+#include <time.h>
+#if defined(__x86_64__) || defined(__i386__)
+#include <x86intrin.h>
+#define TABLEGEN_CLOCK "tsc"
+#else
+#define TABLEGEN_CLOCK "ns"
+#endif
+
+static tablegen_counter* tablegen_counters = NULL;
+
+static uint64_t tablegen_cycles(void) {
+#if defined(__x86_64__) || defined(__i386__)
+  return __rdtsc();
+#else
+  struct timespec now;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  return (uint64_t)now.tv_sec * 1000000000u + (uint64_t)now.tv_nsec;
+#endif
+}
+
+tablegen_probe tablegen_probe_begin(tablegen_counter* counter) {
+  tablegen_probe probe;
+  if (!counter->linked) {
+    counter->linked = 1;
+    counter->next = tablegen_counters;
+    tablegen_counters = counter;
+  }
+  probe.counter = counter;
+  probe.start = tablegen_cycles();
+  return probe;
+}
+
+void tablegen_probe_end(tablegen_probe* probe) {
+  probe->counter->calls++;
+  probe->counter->cycles += tablegen_cycles() - probe->start;
+}
+
+// tablegen_stats([reset]) returns {name = {calls = n, cycles = n}} for every
+// entry point called so far and the unit of the cycles, "tsc" or "ns"
+int tablegen_stats(lua_State* ls) {
+  int reset = lua_toboolean(ls, 1);
   lua_newtable(ls);
-  uint64_t i = 1U;
-  for (int j = 0; j < count; ++j) {
-    lua_pushinteger(ls, i+1);
-    lua_pushZZZ(ls, array[i]);
-    lua_settable(ls, -3);
-    i++;
+  for (tablegen_counter* counter = tablegen_counters; counter != NULL; counter = counter->next) {
+    lua_createtable(ls, 0, 2);
+    lua_pushinteger(ls, (lua_Integer)counter->calls);
+    lua_setfield(ls, -2, "calls");
+    lua_pushinteger(ls, (lua_Integer)counter->cycles);
+    lua_setfield(ls, -2, "cycles");
+    lua_setfield(ls, -2, counter->name);
+    if (reset) counter->calls = counter->cycles = 0;
   }
+  lua_pushstring(ls, TABLEGEN_CLOCK);
+  return 2;
+}
+#endif
+""",
+"stats_decl": """#ifdef TABLEGEN_STATS
+typedef struct tablegen_counter {
+  const char* name;
+  uint64_t calls;
+  uint64_t cycles;
+  struct tablegen_counter* next;
+  int linked;
+} tablegen_counter;
+typedef struct {
+  tablegen_counter* counter;
+  uint64_t start;
+} tablegen_probe;
+tablegen_probe tablegen_probe_begin(tablegen_counter* counter);
+void tablegen_probe_end(tablegen_probe* probe);
+int tablegen_stats(lua_State* ls);
+#endif
+#if defined(TABLEGEN_STATS) && defined(__GNUC__)
+#define TABLEGEN_PROBE(name) \\
+  static tablegen_counter tablegen_counter_ = {name, 0, 0, NULL, 0}; \\
+  tablegen_probe tablegen_probe_ __attribute__((cleanup(tablegen_probe_end))) = tablegen_probe_begin(&tablegen_counter_)
+#else
+#define TABLEGEN_PROBE(name)
+#endif
+""",
+"stats_probe": """\tTABLEGEN_PROBE("${name}");
+""",
+"register_stats": """#ifdef TABLEGEN_STATS
+\tlua_register(__ls, "tablegen_stats", tablegen_stats);
+#endif
+""",
+"pushluatable_decl": """int pushluatable_${name}(lua_State* ls, ${array_type} array, uint64_t count);
+""",
+"pushluatable_call": """pushluatable_${name}(lua_State* ls, ${arg}, ${array_type} array, ${count});
+""",
+"aggregate_source": """// automatically generated by luatablegen
+// ${time}
+
+${includes}#include ".${header}"
+
+#pragma weak reg_tablegen_tables_${name}
+void reg_tablegen_tables_${name}(lua_State* __ls) {
+${registrations}}
+
+""",
+"aggregate_header": """// automatically generated by luatablegen
+// ${time}
+
+#ifndef _WASM_TABLES_AGGR_H
+#define _WASM_TABLES_AGGR_H
+#ifdef __cplusplus
+extern "C" {
+#endif
+${includes}void reg_tablegen_tables_${name}(lua_State* __ls);
+#ifdef __cplusplus
+}
+#endif //end of extern c
+#endif //end of inclusion guard
+
+""",
+# --singlefile. structs, tabledefs and every table in one translation unit. the
+# per-struct functions are declared up front with TABLEGEN_API linkage.
+"unity_prologue": """// automatically generated by luatablegen
+// ${time}
+${lua_includes}#include <stdbool.h>
+#include <stdlib.h>
+#include <string.h>
+
+// the per-struct functions are static so they can be inlined across tables.
+// define TABLEGEN_API as empty to call them from other translation units.
+#ifndef TABLEGEN_API
+#if defined(__GNUC__)
+#define TABLEGEN_API static __attribute__((unused))
+#else
+#define TABLEGEN_API static
+#endif
+#endif
+
+${structs}
+${tabledefs_decl}
+${pre}
+${decls}
+${tabledefs}
+""",
+"unity_register": """void reg_tablegen_tables_${name}(lua_State* __ls) {
+${registrations}}
+
+""",
+"register_call": """\t${struct}_register(__ls,"${struct}");
+""",
+"register_call_global": """\t${struct}_register(__ls,"${struct}");
+\tlua_pop(__ls, 1);
+""",
+"lua_module_prologue": """-- automatically generated by luatablegen
+-- ${time}
+local ${name} = {}
+
+""",
+"lua_module_epilogue": """return ${name}
+""",
+"lua_lazy_constructor": """setmetatable(${struct}, {__call =
+\tfunction(self${params})
+\t\tlocal t = self.new(${args})
+\t\treturn t
+\tend
+\t}
+)
+""",
+# with --lazy, reading the globals above would register every table. the
+# constructors wait for their table to be registered instead.
+"lua_onload_prologue": """local constructors = {}
+
+""",
+"lua_onload_constructor": """constructors.${struct} = function(self${params})
+\tlocal t = self.new(${args})
+\treturn t
+end
+""",
+"lua_onload_epilogue": """tablegen_onload(function(name, t)
+\tif constructors[name] ~= nil then setmetatable(t, {__call = constructors[name]}) end
+end)
+for name, constructor in pairs(constructors) do
+\tlocal t = rawget(_G, name)
+\tif t ~= nil then setmetatable(t, {__call = constructor}) end
+end
+
+""",
+# --bench. a driver that runs the generated lua scripts with an allocator that
+# counts, and the scripts themselves. bench.lua writes its results as json,
+# --benchcompare diffs two of those.
+"bench_driver": """// automatically generated by luatablegen
+// ${time}
+#include <stdio.h>
+#include <stdlib.h>
+#include <time.h>
+#include "${header}"
+
+static size_t bench_alloc_count = 0;
+static size_t bench_alloc_bytes = 0;
+
+static void* bench_alloc(void* ud, void* ptr, size_t osize, size_t nsize) {
+  (void)ud;
+  if (nsize == 0) {
+    free(ptr);
+    return NULL;
+  }
+  if (ptr == NULL) {
+    bench_alloc_count++;
+    bench_alloc_bytes += nsize;
+  } else if (nsize > osize) {
+    bench_alloc_bytes += nsize - osize;
+  }
+  return realloc(ptr, nsize);
+}
+
+static int bench_now(lua_State* ls) {
+  struct timespec now;
+  clock_gettime(CLOCK_MONOTONIC, &now);
+  lua_pushnumber(ls, (lua_Number)now.tv_sec * 1e9 + (lua_Number)now.tv_nsec);
+  return 1;
+}
+
+static int bench_allocs(lua_State* ls) {
+  lua_pushinteger(ls, (lua_Integer)bench_alloc_count);
+  lua_pushinteger(ls, (lua_Integer)bench_alloc_bytes);
+  return 2;
+}
+
+${push_args}static const luaL_Reg bench_funcs[] = {
+  {"now", bench_now},
+  {"allocs", bench_allocs},
+  {0, 0}
+};
+
+static const luaL_Reg bench_push_args[] = {
+${registrations}  {0, 0}
+};
+
+int main(int argc, char** argv) {
+  lua_State* ls;
+  if (argc < 2) {
+    fprintf(stderr, "usage: %s bench.lua [out.json] [min seconds per case] [name filter]\\n", argv[0]);
+    return 1;
+  }
+  ls = lua_newstate(bench_alloc, NULL);
+  luaL_openlibs(ls);
+  reg_tablegen_tables_${name}(ls);
+  lua_settop(ls, 0);
+  luaL_newlib(ls, bench_funcs);
+  luaL_newlib(ls, bench_push_args);
+  lua_setfield(ls, -2, "push_args");
+  lua_setglobal(ls, "bench");
+  lua_createtable(ls, argc, 0);
+  for (int i = 1; i < argc; ++i) {
+    lua_pushstring(ls, argv[i]);
+    lua_rawseti(ls, -2, i - 1);
+  }
+  lua_setglobal(ls, "arg");
+  if (luaL_dofile(ls, argv[1])) {
+    fprintf(stderr, "%s\\n", lua_tostring(ls, -1));
+    lua_close(ls);
+    return 1;
+  }
+  lua_close(ls);
   return 0;
 }
-"""
+""",
+"bench_push_args": """static int bench_push_args_${struct}(lua_State* ls) {
+  ${struct}* st = tablegen_toobject(ls, 1);
+  lua_Integer n = luaL_checkinteger(ls, 2);
+  int top = lua_gettop(ls);
+  for (lua_Integer i = 0; i < n; ++i) {
+    ${struct}_push_args(ls, st);
+    lua_settop(ls, top);
+  }
+  return 0;
+}
+
+""",
+"bench_push_args_reg": """  {"${struct}", bench_push_args_${struct}},
+""",
+"bench_runner": """-- automatically generated by luatablegen
+-- ${time}
+-- usage: bench bench.lua [out.json] [min seconds per case] [name filter]
+local out_path, min_time, filter = arg[1], tonumber(arg[2]) or 0.05, arg[3]
+local dir = arg[0]:match("^(.*[/\\\\])") or ""
+local results = {}
+
+-- every case is run with a doubling iteration count until one run takes at
+-- least min_time, that run is the one reported.
+local function measure(name, setup, run)
+  if filter and not name:find(filter, 1, true) then return end
+  local ok, state = pcall(setup or function() end)
+  local err = state
+  if ok then ok, err = pcall(run, state, 1) end
+  if not ok then
+    results[#results + 1] = {name = name, error = tostring(err)}
+    return
+  end
+  local n = 1
+  while true do
+    collectgarbage()
+    local count, bytes = bench.allocs()
+    local start = bench.now()
+    run(state, n)
+    local elapsed = bench.now() - start
+    local count2, bytes2 = bench.allocs()
+    if elapsed >= min_time * 1e9 or n >= 2^30 then
+      results[#results + 1] = {name = name, iterations = n, ns_per_op = elapsed / n,
+                               allocs_per_op = (count2 - count) / n, bytes_per_op = (bytes2 - bytes) / n}
+      return
+    end
+    n = math.floor(math.min(n * 100, math.max(n * 2, n * min_time * 1.2e9 / math.max(elapsed, 1))))
+  end
+end
+
+local function list(make, count)
+  local t = {}
+  for i = 1, count do t[i] = make(i) end
+  return t
+end
+
+local make = {}
+${constructors}
+for _, name in ipairs({${scripts}}) do
+  dofile(dir .. "bench_" .. name .. ".lua")(measure, make, list)
+end
 
-LUA_PUSH_TABLE_SIMPLE_TYPE_SIG = 'int pushluatable_YYY(lua_State* ls, XXX array, uint64_t count);\n'
-LUA_PUSH_TABLE_SIG = "int pushluatable_YYY(lua_State* ls, XXX array, uint64_t count);\n"
-LUA_PUSH_TABLE_CALL = "pushluatable_YYY(lua_State* ls, WWW, XXX array, ZZZ);\n"
+local function json_string(s)
+  return '"' .. s:gsub('[%c"\\\\]', function(c) return string.format("\\\\u%04x", c:byte()) end) .. '"'
+end
 
-LUA_LIB = ["local XXX = {}\n\n", "return XXX\n"]
-LUA_SETMETA_NEW = ["setmetatable(XXX, {__call =\n", "\tfunction(selfAAA)\n",
-                   "\t\tlocal t = self.new(AAA)\n", "\t\treturn t\n\tend\n\t}\n)\n"]
-LUA_TO_GENERIC = "lua_to_YYY(__ls, ZZZ);\n"
-LUA_TO_GENERIC_DEF = "YYY lua_to_YYY(lua_State* ls, XXX array, ZZZ) {}\n"
+local lines = {}
+for i, result in ipairs(results) do
+  local fields = {"\\"name\\": " .. json_string(result.name)}
+  if result.error then
+    fields[#fields + 1] = "\\"error\\": " .. json_string(result.error)
+  else
+    fields[#fields + 1] = string.format("\\"iterations\\": %d", result.iterations)
+    for _, key in ipairs({"ns_per_op", "allocs_per_op", "bytes_per_op"}) do
+      fields[#fields + 1] = string.format("\\"%s\\": %.3f", key, result[key])
+    end
+  end
+  lines[i] = "  {" .. table.concat(fields, ", ") .. "}"
+end
+local text = string.format("{\\"version\\": 1, \\"lua\\": %s, \\"results\\": [\\n%s\\n]}\\n", json_string(_VERSION), table.concat(lines, ",\\n"))
+if out_path and out_path ~= "-" then
+  local out = assert(io.open(out_path, "w"))
+  out:write(text)
+  out:close()
+else
+  io.write(text)
+end
+""",
+"bench_constructor": """make.${struct} = function() return ${struct}.new(${args}) end
+""",
+"bench_struct": """-- automatically generated by luatablegen
+-- ${time}
+-- benchmarks for ${struct}, loaded by bench.lua
+return function(measure, make, list)
+  local T = ${struct}
+  local function fixture()
+    local obj = make.${struct}()
+${populate}    return obj
+  end
+  measure("${struct}.new", nil, function(_, n) for i = 1, n do make.${struct}() end end)
+  measure("${struct}.new_array[64]", nil, function(_, n) for i = 1, n do T.new_array(64) end end)
+  measure("${struct}.push_args", fixture, function(obj, n) bench.push_args.${struct}(obj, n) end)
+  measure("${struct}:pack()", fixture, function(obj, n) for i = 1, n do obj:pack() end end)
+  measure("${struct}.unpack", function() return fixture():pack() end, function(packed, n) local unpack = T.unpack for i = 1, n do unpack(packed) end end)
+${cases}end
+""",
+"bench_getter": """  measure("${struct}:${getter}()", fixture, function(obj, n) local get = T.${getter} for i = 1, n do get(obj) end end)
+""",
+"bench_setter": """  measure("${struct}:set_${field}(${label})", fixture, function(obj, n) local set, value = T.set_${field}, ${value} for i = 1, n do set(obj, value) end end)
+""",
+"bench_view": """  measure("${struct}:${getter}()[i]", fixture, function(obj, n) local view = T.${getter}(obj) local length = #view for i = 1, n do local _ = view[(i - 1) % length + 1] end end)
+""",
+# --makemacro. the object rules only list prerequisites, the objects are built
+# by the including makefile's %.o rule so make -j can schedule them freely.
+# the default goal is put back so the rules do not become the including
+# makefile's default target.
+"make_macro": """# automatically generated by luatablegen
+# ${time}
+TABLEGEN_SAVED_GOAL_${name}:=$(.DEFAULT_GOAL)
+ifndef TABLEGEN_DIR_${name}
+TABLEGEN_DIR_${name}:=$(patsubst %/,%,$(dir $(lastword $(MAKEFILE_LIST))))
+endif
+TABLEGEN_OBJS_${name}:=${objects}
+TABLEGEN_SRCS_${name}:=$(TABLEGEN_OBJS_${name}:.o=.c)
+
+${rules}
+-include ${depfile}
+.DEFAULT_GOAL:=$(TABLEGEN_SAVED_GOAL_${name})
+""",
+"make_rule": """${target}:${prerequisites}
+""",
+# --layout. the offsets are computed for LP64 so they are only checked there
+"layout_asserts": """#if !defined(__cplusplus) && UINTPTR_MAX == UINT64_MAX
+_Static_assert(sizeof(${struct}) == ${size}, "${struct} is not ${size} bytes");
+${offsets}#endif
+
+""",
+"layout_offset": """_Static_assert(offsetof(${struct}, ${field}) == ${offset}, "${struct}.${field} is not at ${offset}");
+""",
+"bench_makefile": """# automatically generated by luatablegen
+# ${time}
+LUA_DIR?=${lua_dir}
+CC?=cc
+CFLAGS?=-O2
+SRCS:=bench_main.c ${sources}
+
+.PHONY:all run clean
+
+all:bench
+
+bench:$(SRCS)
+	$(CC) $(CFLAGS) -I$(LUA_DIR) $^ $(LUA_DIR)/liblua.a -lm -ldl -o $@
+
+run:bench
+	./bench bench.lua bench.json
+
+clean:
+	rm -f bench bench.json
+""",
+}
+
+class Template(object):
+    """a snippet with ${name} placeholders. the text is split into literals and
+    placeholder names once so that rendering is a single join."""
+    placeholder = re.compile(r"\$\{([A-Za-z_][A-Za-z0-9_]*)\}")
+
+    def __init__(self, text, name):
+        self.text = text
+        self.name = name
+        self.literals = []
+        self.names = []
+        pos = 0
+        for match in self.placeholder.finditer(text):
+            self.literals.append(text[pos:match.start()])
+            self.names.append(match.group(1))
+            pos = match.end()
+        self.literals.append(text[pos:])
+
+    def render(self, **values):
+        parts = [self.literals[0]]
+        for name, literal in zip(self.names, self.literals[1:]):
+            parts.append(values[name])
+            parts.append(literal)
+        return "".join(parts)
+
+def load_templates(template_dirs):
+    templates = {}
+    for name, text in DEFAULT_TEMPLATES.items():
+        templates[name] = Template(text, name)
+    # later directories take precedence over earlier ones
+    for template_dir in template_dirs or []:
+        for name in DEFAULT_TEMPLATES:
+            path = os.path.join(template_dir, name + TEMPLATE_SUFFIX)
+            if not os.path.exists(path): continue
+            template = Template(read_text_file(path), name)
+            unknown = set(template.names) - set(templates[name].names)
+            if unknown:
+                print("template " + path + " uses unknown placeholders: " + ", ".join(sorted(unknown)))
+                sys.exit(1)
+            templates[name] = template
+    return templates
 
 def lua_type_resolver(type_str):
     if type_str == "int8":
@@ -164,6 +2054,8 @@ def lua_type_resolver(type_str):
         return "number"
     elif type_str == "bool":
         return "integer"
+    elif type_str == "varuint1":
+        return "integer"
     elif type_str == "uchar":
         return "integer"
     elif type_str == "schar":
@@ -199,6 +2091,8 @@ def simple_type_resovler(type_str):
         return "double"
     elif type_str == "bool":
         return "uint8_t"
+    elif type_str == "varuint1":
+        return "uint8_t"
     elif type_str == "uchar":
         return "uint8_t"
     elif type_str == "schar":
@@ -236,6 +2130,8 @@ def get_eq_lua_type(type_str):
         return "number"
     elif type_str == "bool":
         return "integer"
+    elif type_str == "varuint1":
+        return "integer"
     elif type_str == "uchar":
         return "integer"
     elif type_str == "schar":
@@ -246,7 +2142,7 @@ def get_eq_lua_type(type_str):
         return "lightuserdata"
     else: return None
 
-def type_resolver(elem, elem_list):
+def type_resolver(elem, schema):
     if "isaggregate" in elem.attrib:
         type_str = elem.attrib["name"]
     else:
@@ -278,6 +2174,8 @@ def type_resolver(elem, elem_list):
         return "double"
     elif type_str == "bool":
         return "uint8_t"
+    elif type_str == "varuint1":
+        return "uint8_t"
     elif type_str == "uchar":
         return "uint8_t"
     elif type_str == "schar":
@@ -287,24 +2185,108 @@ def type_resolver(elem, elem_list):
     elif type_str == "FT::conditional":
         return "void*"
     elif type_str.find("self::") == 0:
-        for node in elem_list:
-            if elem.attrib["type"][6:] == node.tag:
-                return node.attrib["name"]
+        node = schema.by_tag.get(elem.attrib["type"][6:])
+        if node is not None:
+            return node.attrib["name"]
     else: return type_str
 
 def get_full_path(path, name):
     if path[-1] == "/": return path + name
     else: return path + "/" + name
 
-def get_def_node(type_str, elem_list):
-    for node in elem_list:
-        if type_str == node.attrib["name"]:
-            return node
+class SchemaNode(object):
+    """compact copy of a schema element. keeps only what the generator reads
+    and quacks like the parts of ElementTree.Element that are used."""
+    __slots__ = ("tag", "attrib", "text", "children")
+
+    def __init__(self, tag, attrib, text, children):
+        self.tag = tag
+        self.attrib = attrib
+        self.text = text
+        self.children = children
+
+    @classmethod
+    def from_element(cls, elem):
+        # attribute names and values repeat across thousands of fields, intern
+        # them so every record shares the same string objects. whitespace-only
+        # text is layout, not data.
+        text = elem.text
+        if text is not None and not text.strip(): text = None
+        attrib = {sys.intern(k): sys.intern(v) for k, v in elem.attrib.items()}
+        children = tuple(cls.from_element(child) for child in elem)
+        return cls(sys.intern(elem.tag), attrib, text, children)
+
+    def __iter__(self):
+        return iter(self.children)
+
+    def __len__(self):
+        return len(self.children)
+
+    def __getitem__(self, index):
+        return self.children[index]
+
+    def get(self, key, default=None):
+        return self.attrib.get(key, default)
+
+    def serialize(self):
+        attrib = " ".join(k + "=" + repr(v) for k, v in sorted(self.attrib.items()))
+        kids = "".join(child.serialize() for child in self.children)
+        return "<" + self.tag + " " + attrib + ">" + repr(self.text) + kids + "</" + self.tag + ">"
+
+def iter_schema(path):
+    """yields (section, record) for every struct under <Read> and <Definition>.
+    the file is parsed incrementally and every struct is dropped from the tree
+    once it has been copied, so the whole document is never held in memory."""
+    depth = 0
+    section = None
+    for event, elem in xml.etree.ElementTree.iterparse(path, events=("start", "end")):
+        if event == "start":
+            depth += 1
+            if depth == 2: section = elem
+            continue
+        if depth == 3:
+            if section.tag in ("Read", "Definition"):
+                yield section.tag, SchemaNode.from_element(elem)
+            section.clear()
+        elif depth == 2:
+            section.clear()
+        depth -= 1
+
+class SchemaIndex(object):
+    """symbol table for the schema. built once by read_xml so that the
+    generator does dictionary lookups instead of walking the element lists."""
+    def __init__(self, elems):
+        self.elems = elems
+        # struct name -> struct node
+        self.by_name = {}
+        # struct tag -> struct node
+        self.by_tag = {}
+        # (struct name, field name) -> field node
+        self.fields = {}
+        # (struct name, field tag) -> field node
+        self.field_tags = {}
+        for node in elems:
+            self.add(node)
+
+    def add(self, node):
+        struct_name = node.attrib["name"]
+        self.by_name.setdefault(struct_name, node)
+        self.by_tag.setdefault(node.tag, node)
+        for child in node:
+            self.fields.setdefault((struct_name, child.attrib["name"]), child)
+            self.field_tags.setdefault((struct_name, child.tag), child)
+
+def get_def_node(type_str, schema):
+    return schema.by_name.get(type_str)
+
+def get_def_node_tag(type_str, schema):
+    return schema.by_tag.get(type_str)
+
+def get_field_node(field_name, parent, schema):
+    return schema.fields.get((parent.attrib["name"], field_name))
 
-def get_def_node_tag(type_str, elem_list):
-    for node in elem_list:
-        if type_str == node.tag:
-            return node
+def get_field_node_tag(field_tag, parent, schema):
+    return schema.field_tags.get((parent.attrib["name"], field_tag))
 
 def get_elem_count(elem):
     if "count" in elem.attrib:
@@ -317,14 +2299,77 @@ def get_elem_count(elem):
     else:
         return 1
 
-def get_count_node(elem, parent):
+def is_array_field(elem):
+    # fields the struct holds a pointer to an array for. integer and number
+    # fields with a count are arrays of that simple type.
+    return elem.attrib["luatype"] in ("lightuserdata", "integer", "number") and get_elem_count(elem) != 1
+
+def get_struct_layout(fields):
+    """offsets of the (c type, name, bits) fields in declaration order, the size
+    of the struct and the bytes its fields occupy, None if the size of a field
+    is unknown. bitfields have no offset, consecutive ones share a byte as long
+    as they fit in it."""
+    offsets = []
+    offset = 0
+    align = 1
+    used = 0
+    free_bits = 0
+    for c_type, name, bits in fields:
+        if bits:
+            if bits > free_bits:
+                offset += 1
+                used += 1
+                free_bits = 8
+            free_bits -= bits
+            offsets.append(None)
+            continue
+        free_bits = 0
+        if c_type.endswith("*"): size = 8
+        elif c_type in C_TYPE_SIZES: size = C_TYPE_SIZES[c_type]
+        else: return None
+        offset = (offset + size - 1) // size * size
+        offsets.append(offset)
+        offset += size
+        used += size
+        align = max(align, size)
+    return offsets, (offset + align - 1) // align * align, used
+
+def get_field_size(field):
+    # bitfields sort after the byte wide fields so they end up sharing bytes
+    c_type, name, bits = field
+    if bits: return 0
+    if c_type.endswith("*"): return 8
+    return C_TYPE_SIZES[c_type]
+
+def get_field_bits(elem):
+    # width of an integer field narrower than a byte, None for everything else
+    if elem.attrib["luatype"] != "integer" or get_elem_count(elem) != 1: return None
+    if "bits" not in elem.attrib: return SUB_BYTE_TYPES.get(elem.attrib.get("type"))
+    try:
+        bits = int(elem.attrib["bits"])
+    except ValueError:
+        bits = 0
+    if not 1 <= bits <= 7:
+        print("bits of " + elem.attrib["name"] + " has to be between 1 and 7.")
+        sys.exit(1)
+    return bits
+
+def get_struct_refs(node, schema):
+    # names of the structs the fields of a struct refer to with self:: types,
+    # conditional fields name theirs on the alternatives
+    refs = []
+    for child in node:
+        for elem in (child,) + tuple(child):
+            ref_node = get_def_node_tag(elem.get("type", "")[6:], schema)
+            if ref_node is not None and ref_node is not node and ref_node.attrib["name"] not in refs:
+                refs.append(ref_node.attrib["name"])
+    return refs
+
+def get_count_node(elem, parent, schema):
     if "count" in elem.attrib:
         count_node_name = elem.attrib["count"][6:]
     else: return None
-    for child in parent:
-        if child.tag == count_node_name:
-            return child
-    return None
+    return get_field_node_tag(count_node_name, parent, schema)
 
 # FIXME-incomplete
 def get_lua_push_func(gen_type):
@@ -339,15 +2384,20 @@ def get_lua_pop_func(gen_type):
     elif gen_type == "number": return "lua_tonumber(__ls, XXX)"
     else: return None
 
-def get_cond_node(elem, parent):
+def get_cond_node(elem, parent, schema):
     if "condition" in elem.attrib:
         cond_node_name = elem.attrib["condition"][6:]
-        for child in parent:
-            if child.tag == cond_node_name:
-                return child
+        return get_field_node_tag(cond_node_name, parent, schema)
     else:
         return None
 
+def read_text_file(path):
+    if not path: return str()
+    text_file = open(path)
+    text = text_file.read()
+    text_file.close()
+    return text
+
 def SigHandler_SIGINT(signum, frame):
     print()
     sys.exit(0)
@@ -368,19 +2418,109 @@ class Argparser(object):
         parser.add_argument("--post", type=str, help="path to source code file to add before header guard/extern c end")
         parser.add_argument("--luaheader", type=str, help="path to lua header files")
         parser.add_argument("--dbg", action="store_true", help="debug", default=False)
-        parser.add_argument("--singlefile", action="store_true", help="should all the generated code be added to a single file", default=False)
-        parser.add_argument("--makemacro", action="store_true", help="generate a makefile containing all objects in a macro to be included by another makefile", default=False)
+        parser.add_argument("--singlefile", action="store_true", help="unity build: generate the structs, tabledefs, every table and the registration function as one .c file with static per-struct functions", default=False)
+        parser.add_argument("--decoder", type=str, help="path of the header of a C decoder that maps a file in the binary format the Read section describes and fills the structs from it, the source goes next to it")
+        parser.add_argument("--makemacro", action="store_true", help="generate tablegen.mk with the generated objects, their header dependencies and a depfile to be included by another makefile", default=False)
         parser.add_argument("--anon", action="store_true", help="generate anonymous lua tables if true, global if false", default=True)
         parser.add_argument("--useuuid", action="store_true", help="use uuids to register metatables instead of the name of the metatable", default=True)
-        parser.add_argument("--outfile", type=str, help="name of the output file if signlefile is set, ignored otherwise")
+        parser.add_argument("--outfile", type=str, help="name of the output file if singlefile is set, ignored otherwise")
         parser.add_argument("--headeraggr", type=str, help="header aggregate file name")
         parser.add_argument("--lualibpath", type=str, help="where the lua module file will be placed")
         parser.add_argument("--lualibname", type=str, help="the name for the table")
         parser.add_argument("--docpath", type=str, help="where the doc file will be placed")
         parser.add_argument("--xml", type=str, help="same as --tbg but use an xml file instead")
         parser.add_argument("--tbldefs", type=str, help="path to the definitions tablegen creates")
+        parser.add_argument("--jobs", type=int, help="number of processes used to generate the per-struct sources", default=1)
+        parser.add_argument("--templates", type=str, action="append", help="directory holding name.tmpl files that override the builtin templates, can be given more than once")
+        parser.add_argument("--lazy", action="store_true", help="register a table the first time a script reads its global, requires it or one of its objects is made instead of registering every table at startup", default=False)
+        parser.add_argument("--fieldaccess", action="store_true", help="expose the fields as obj.field through generated __index/__newindex handlers, the getters become obj:get_field()", default=False)
+        parser.add_argument("--incremental", action="store_true", help="only rewrite the generated files whose inputs have changed since the last run", default=False)
+        parser.add_argument("--profile", type=str, help="write wall time, call counts and traced peak memory of every generator phase as json to this path, - for stdout")
+        parser.add_argument("--layout", action="store_true", help="order struct fields by alignment to cut padding, check the layout with _Static_assert and print a padding report. structs with keeporder=\"true\" keep their field order", default=False)
+        parser.add_argument("--bitfields", action="store_true", help="store bool, varuint1 and integer fields with a bits attribute as bitfields sharing bytes", default=False)
+        parser.add_argument("--instrument", action="store_true", help="start every generated entry point with a probe that counts calls and cycles when compiled with TABLEGEN_STATS defined", default=False)
+        parser.add_argument("--bench", type=str, help="directory to generate a benchmark driver and scripts for the bindings in, needs --headeraggr")
+        parser.add_argument("--benchlua", type=str, help="directory holding lua.h and liblua.a for the benchmark makefile", default="../lua5")
+        parser.add_argument("--benchcompare", type=str, nargs=2, metavar=("OLD", "NEW"), help="compare two benchmark results and exit")
+        parser.add_argument("--benchthreshold", type=float, help="percentage above which --benchcompare reports a regression", default=10.0)
+        parser.add_argument("--schemabench", type=str, help="directory to run the generator on synthetic schemas of every --synthstructs size in, records wall time and peak rss")
+        parser.add_argument("--synthschema", type=str, help="write a synthetic schema with the first --synthstructs size to this path and exit")
+        parser.add_argument("--synthstructs", type=str, help="comma separated struct counts of the synthetic schemas", default="100,1000,10000")
+        parser.add_argument("--synthfields", type=int, help="fields per synthetic struct", default=8)
+        parser.add_argument("--synthdepth", type=int, help="how many levels of structs the self:: references of a synthetic schema go through", default=4)
+        parser.add_argument("--synthrefs", type=int, help="percentage of synthetic fields that are self:: references", default=20)
+        parser.add_argument("--synthcounts", type=int, help="percentage of synthetic fields that are arrays with a count=self:: reference", default=10)
+        parser.add_argument("--synthconds", type=int, help="percentage of synthetic fields that are conditionals", default=5)
+        parser.add_argument("--synthseed", type=int, help="random seed for the synthetic schemas", default=0)
         self.args = parser.parse_args()
 
+class Profiler(object):
+    """wall time, call count and traced peak memory of every --profile phase.
+    phases nest and a phase is named after the path of phases it ran in, e.g.
+    emit_struct/getter. peak memory is what a phase held at most on top of
+    what was allocated when it started."""
+    def __init__(self):
+        self.phases = {}
+        self.stack = []
+        self.start = time.perf_counter()
+        tracemalloc.start()
+
+    def enter(self, name):
+        current, peak = tracemalloc.get_traced_memory()
+        # tracemalloc only keeps one peak, the enclosing phase's is carried along
+        if self.stack: self.stack[-1]["peak"] = max(self.stack[-1]["peak"], peak)
+        tracemalloc.reset_peak()
+        path = self.stack[-1]["path"] + "/" + name if self.stack else name
+        self.stack.append({"path": path, "start": time.perf_counter(), "current": current, "peak": 0, "children": 0.0})
+
+    def leave(self):
+        frame = self.stack.pop()
+        wall = time.perf_counter() - frame["start"]
+        current, peak = tracemalloc.get_traced_memory()
+        peak = max(peak, frame["peak"])
+        tracemalloc.reset_peak()
+        if self.stack:
+            self.stack[-1]["peak"] = max(self.stack[-1]["peak"], peak)
+            self.stack[-1]["children"] += wall
+        phase = self.phases.setdefault(frame["path"], {"name": frame["path"], "calls": 0, "wall_s": 0.0, "self_s": 0.0, "peak_mb": 0.0})
+        phase["calls"] += 1
+        phase["wall_s"] += wall
+        phase["self_s"] += wall - frame["children"]
+        phase["peak_mb"] = max(phase["peak_mb"], (peak - frame["current"]) / 1048576.0)
+
+    def report(self, path):
+        # ru_maxrss is in kilobytes on linux
+        report = {"version": 1, "wall_s": time.perf_counter() - self.start,
+                  "traced_peak_mb": tracemalloc.get_traced_memory()[1] / 1048576.0,
+                  "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+                  "phases": list(self.phases.values())}
+        tracemalloc.stop()
+        text = json.dumps(report, indent=1)
+        if path == "-":
+            print(text)
+            return
+        profile_file = open(path, "w")
+        profile_file.write(text + "\n")
+        profile_file.close()
+        print("%-48s %8s %10s %10s %10s" % ("phase", "calls", "wall s", "self s", "peak MB"))
+        for phase in report["phases"]:
+            print("%-48s %8d %10.3f %10.3f %10.2f" % (phase["name"], phase["calls"], phase["wall_s"], phase["self_s"], phase["peak_mb"]))
+        print("total %.3f s, peak rss %.1f MB" % (report["wall_s"], report["peak_rss_mb"]))
+
+def profiled(method):
+    """makes every call of a TbgParser method a --profile phase named after it."""
+    name = method.__name__
+    def wrapper(self, *args):
+        if self.profiler is None: return method(self, *args)
+        self.profiler.enter(name)
+        try:
+            return method(self, *args)
+        finally:
+            self.profiler.leave()
+    wrapper.__name__ = name
+    wrapper.__doc__ = method.__doc__
+    return wrapper
+
 class TbgParser(object):
     def __init__(self, argparser):
         #self.tbg_file = json.load(open(argparser.args.tbg))
@@ -389,36 +2529,39 @@ class TbgParser(object):
         print(self.time)
         self.def_elems = []
         self.read_elems = []
+        # the pre and post files go into every generated source, read them once
+        self.pre_text = read_text_file(argparser.args.pre)
+        self.post_text = read_text_file(argparser.args.post)
+        # mkstemp creates files as 0600, generated files should honour the umask
+        self.umask = os.umask(0)
+        os.umask(self.umask)
+        self.bytes_written = {}
+        self.templates = load_templates(argparser.args.templates)
+        self.profiler = Profiler() if argparser.args.profile else None
+        # in a unity build the per-struct functions are not seen outside the file
+        self.linkage = "TABLEGEN_API " if argparser.args.singlefile else ""
+        self.unity_parts = {}
+
+    def lua_includes(self):
+        if self.argparser.args.luaheader:
+            return self.templates["lua_includes"].render(luaheader=self.argparser.args.luaheader+"/")
+        else:
+            return self.templates["lua_includes"].render(luaheader="")
 
+    @profiled
     def begin(self, c_source, struct_name, h_filename, is_source):
-        c_source.write("\n")
-        c_source.write("// automatically generated by luatablegen\n")
-        c_source.write("// " + self.time + "\n")
-        for header in HEADER_LIST:
-            if self.argparser.args.luaheader:
-                c_source.write(header.replace("HHH", self.argparser.args.luaheader+"/"))
-            else:
-                c_source.write(header.replace("HHH", ""))
-        c_source.write('#include "./tabledefs.h"\n')
-        if not is_source: c_source.write(HEADER_GUARD[0].replace("XXX", struct_name))
-        if not is_source: c_source.write(EXTERN_C[0])
-        if is_source: c_source.write("#include " + '"./' +h_filename+ '"\n')
-        c_source.write("\n")
-        if self.argparser.args.pre:
-            pre_file = open(self.argparser.args.pre)
-            for line in pre_file:
-                c_source.write(line)
-            pre_file.close()
-        c_source.write("\n")
+        if is_source: template = self.templates["source_prologue"]
+        else: template = self.templates["header_prologue"]
+        c_source.write(template.render(time=self.time, lua_includes=self.lua_includes(),
+                                       struct=struct_name, header=h_filename, pre=self.pre_text))
 
+    @profiled
     def gen_struct_header_xml(self):
         self.struct_source_h = self.argparser.args.out + "/structs.h"
         self.struct_source_c = self.argparser.args.out + "/structs.c"
-        struct_source = open(self.struct_source_h, "w")
-        struct_source_c = open(get_full_path(self.argparser.args.out, "structs.c"), "w")
-        struct_source.write("// automatically generated by luatablegen\n")
+        struct_source = io.StringIO()
+        struct_source_c = io.StringIO()
         struct_source_c.write("// automatically generated by luatablegen\n")
-        struct_source.write("// " + self.time + "\n")
         struct_source_c.write("// " + self.time + "\n")
         struct_source.write("#ifndef FT_STRUCTS_H\n#define FT_STRUCTS_H\n")
         struct_source.write('#ifdef __cplusplus__\nextern "C" {\n#endif\n')
@@ -434,64 +2577,79 @@ class TbgParser(object):
             sub = self.argparser.args.structsinclude[pos+1:]
             struct_source.write('#include "' + sub + '"\n\n')
         """
-        for child in self.def_elems + self.read_elems:
-            struct_source.write("typedef struct {\n")
+        layout = self.argparser.args.layout
+        if layout: struct_source.write('#include <stddef.h>\n')
+        report = []
+        for child in self.elems:
+            fields = []
             if not "isaggregate" in child.attrib:
-                ref_type = type_resolver(child, self.def_elems + self.read_elems)
-                def_node = get_def_node(ref_type, self.def_elems + self.read_elems)
-                pointer = str()
-                if "count" in child.attrib:
-                    if child.attrib["count"] != "1":
-                        pointer = "*"
-                if def_node:
-                    struct_source.write(ref_type + pointer + "* " + child.attrib["name"] + ";\n")
-                else:
-                    struct_source.write(ref_type + pointer + " " + child.attrib["name"] + ";\n")
+                fields.append(self.struct_field(child))
             for childer in child:
-                ref_type = type_resolver(childer, self.def_elems + self.read_elems)
-                def_node = get_def_node(ref_type, self.def_elems + self.read_elems)
-                pointer = str()
-                if "count" in childer.attrib:
-                    if childer.attrib["count"] != "1":
-                        pointer = "*"
-                if def_node:
-                    struct_source.write(ref_type + pointer + "* " + childer.attrib["name"] + ";\n")
-                else:
-                    struct_source.write(ref_type + pointer + " " + childer.attrib["name"] + ";\n")
+                fields.append(self.struct_field(childer))
+            struct_layout = get_struct_layout(fields)
+            if layout and struct_layout:
+                # largest alignment first leaves no holes between the fields.
+                # the sort is stable so equal fields stay in schema order.
+                packed = sorted(fields, key=lambda field: -get_field_size(field))
+                packed_layout = get_struct_layout(packed)
+                declared_size = struct_layout[1]
+                if child.get("keeporder") != "true":
+                    fields, struct_layout = packed, packed_layout
+                report.append((child.attrib["name"], declared_size, struct_layout[1], struct_layout[1] - struct_layout[2], struct_layout[1] - packed_layout[1]))
+            struct_source.write("typedef struct {\n")
+            for c_type, name, bits in fields:
+                if bits: struct_source.write(c_type + " " + name + " : " + repr(bits) + ";\n")
+                else: struct_source.write(c_type + " " + name + ";\n")
             struct_source.write("}" + child.attrib["name"] + ";\n\n")
+            if layout and struct_layout:
+                offsets = "".join([self.templates["layout_offset"].render(struct=child.attrib["name"], field=field[1], offset=repr(offset))
+                                   for field, offset in zip(fields, struct_layout[0]) if offset is not None])
+                struct_source.write(self.templates["layout_asserts"].render(struct=child.attrib["name"], size=repr(struct_layout[1]), offsets=offsets))
+            elif layout:
+                print(child.attrib["name"] + " has fields of unknown size, its layout is left as it is.")
+        if layout: self.layout_report(report)
         struct_source.write('#ifdef __cplusplus__\n}\n#endif\n')
         struct_source.write("#endif\n")
         #struct_source.write(text.last_comment)
+        if self.argparser.args.singlefile:
+            self.unity_parts["structs"] = struct_source.getvalue()
+            return
+        self.write_output(self.struct_source_h, "// automatically generated by luatablegen\n// " + self.time + "\n" + struct_source.getvalue())
+        self.write_output(get_full_path(self.argparser.args.out, "structs.c"), struct_source_c.getvalue())
 
-    def gen_lua_table_push_def(self, node, struct_name, parent):
-        type_name = type_resolver(child, self.def_elems+self.read_elems)
-        type_ref_node = get_def_node(type_name, self.def_elems+self.read_elems)
-        count = get_elem_count(node, self.def_elems+self.read_elems)
-        #count_node = get_count_node(node, parent)
-        count_node_name = str()
-        if count_node: count_node_name = count_node.attrib["name"]
-        if count == -1:
-            count_node_name = node.attrib["count"][6:]
-        if count == 1:
-            pointer = ""
-        else:
-            pointer += "*"
-        yyy = node.atttrib["name"]
-        if type_ref_node:
-            pointer += "*"
-            xxx = type_ref_node.attrib["name"]
-            zzz = "push_" + type_ref_node.attrib["name"]
-            return LUA_PUSH_TABLE.replace("XXX", xxx+pointer).replace("YYY", yyy).replace("ZZZ", zzz)
-        else:
-            xxx = node.attrib["name"]
-            zzz = "lua_push" + node.attrib["luatype"]
-            return LUA_PUSH_TABLE_SIMPLE_TYPE.replace("XXX", xxx+pointer).replace("YYY", yyy).replace("ZZZ", zzz)
+    def struct_field(self, node):
+        # (c type, name, bits) of a field. arrays are pointers to their
+        # elements, other structs are held by pointer. bits is None unless the
+        # field is a bitfield.
+        ref_type = type_resolver(node, self.schema)
+        pointer = str()
+        if "count" in node.attrib:
+            if node.attrib["count"] != "1":
+                pointer = "*"
+        if get_def_node(ref_type, self.schema): pointer += "*"
+        bits = self.field_bits(node)
+        # byte wide storage units keep every bitfield inside one byte
+        if bits: ref_type = "int8_t" if ref_type.startswith("int") else "uint8_t"
+        return ref_type + pointer, node.attrib["name"], bits
+
+    def field_bits(self, node):
+        if not self.argparser.args.bitfields or "isaggregate" in node.attrib: return None
+        return get_field_bits(node)
+
+    def layout_report(self, report):
+        print("%-32s %10s %10s %10s %10s" % ("struct", "declared", "size", "padding", "savable"))
+        for row in report:
+            print("%-32s %10d %10d %10d %10d" % row)
+        declared = sum([row[1] for row in report])
+        size = sum([row[2] for row in report])
+        print("%d structs, %d bytes as declared, %d bytes laid out, %d bytes of padding left, %d more savable with keeporder off" %
+              (len(report), declared, size, sum([row[3] for row in report]), sum([row[4] for row in report])))
 
     def gen_lua_table_push_call(self, node, arg_pos, parent):
-        type_name = type_resolver(node, self.def_elems+self.read_elems)
-        type_ref_node = get_def_node(type_name, self.def_elems+self.read_elems)
+        type_name = type_resolver(node, self.schema)
+        type_ref_node = get_def_node(type_name, self.schema)
         count = get_elem_count(node)
-        count_node = get_count_node(node, parent)
+        count_node = get_count_node(node, parent, self.schema)
         count_node_name = str()
         if count_node != None:
             count_node_name = count_node.attrib["name"]
@@ -510,16 +2668,15 @@ class TbgParser(object):
             zzz = "lua_push" + node.attrib["luatype"]
         dummy = str()
         if count == 1:
-            dummy = "\tpush_" + type_resolver(node, self.elems) +"(__ls, dummy->"+node.attrib["name"]+");\n"
+            dummy = "\tpush_" + type_resolver(node, self.schema) +"(__ls, dummy->"+node.attrib["name"]+");\n"
         elif count > 1:
-            dummy = LUA_PUSH_TABLE_CALL.replace("XXX", xxx+pointer).replace("YYY", yyy).replace("WWW", repr(arg_pos)).replace("ZZZ", count)
+            dummy = self.templates["pushluatable_call"].render(array_type=xxx+pointer, name=yyy, arg=repr(arg_pos), count=repr(count))
         else:
-            dummy = LUA_PUSH_TABLE_CALL.replace("XXX", xxx+pointer).replace("YYY", yyy).replace("WWW", repr(arg_pos)).replace("ZZZ", count_node_name)
-        return [type_resolver(node, self.elems) + pointer + node.attrib["name"], dummy]
+            dummy = self.templates["pushluatable_call"].render(array_type=xxx+pointer, name=yyy, arg=repr(arg_pos), count=count_node_name)
+        return [type_resolver(node, self.schema) + pointer + node.attrib["name"], dummy]
 
     def gen_luato_generic(self, struct_name, field_name, arg_pos):
-        parent = get_def_node(struct_name, self.elems)
-        child = get_def_node(field_name, self.elems)
+        parent = get_def_node(struct_name, self.schema)
         return "check_" + struct_name + "(__ls," + repr(arg_pos) + ");\n"
 
     def struct(self, c_source, field_names, field_types, struct_name):
@@ -529,79 +2686,57 @@ class TbgParser(object):
         c_source.write("}" +struct_name+ ";\n")
         c_source.write("\n")
 
+    @profiled
     def convert(self, c_source, struct_name):
-        for line in CONVERT:
-            c_source.write(line.replace("XXX", struct_name))
-        c_source.write("\n")
+        c_source.write(self.templates["convert"].render(struct=struct_name))
 
+    @profiled
     def check(self, c_source, struct_name):
-        node = get_def_node(struct_name, self.elems)
-        has_conditional = False
-        for elem in node:
-            if "conditional" in elem.attrib:
-                has_conditional = True
-        if has_conditional == True:
-            c_source.write('static XXX* check_XXX(lua_State* __ls, int index) {\n'.replace("XXX", struct_name))
-            c_source.write('\tXXX* dummy;\n'.replace("XXX", struct_name))
-            c_source.write('dummy = lua_touserdata(__ls, index);\n'.replace("XXX", struct_name))
-            c_source.write('\tif (dummy == NULL) printf("XXX:bad user data type.\\n");\n'.replace("XXX", struct_name))
-            c_source.write('\treturn dummy;\n}\n')
-            return
-        for line in CHECK:
-            c_source.write(line.replace("XXX", struct_name))
-        c_source.write("\n")
+        c_source.write(self.templates["check"].render(struct=struct_name))
 
+    @profiled
     def push_self(self, c_source, struct_name):
-        for line in PUSH_SELF:
-            c_source.write(line.replace("XXX", struct_name))
-        c_source.write("\n")
+        owned = self.owned_fields(struct_name)
+        if owned:
+            c_source.write(self.templates["owned"].render(struct=struct_name))
+            size = " + " + repr(len(owned))
+            init = "\tfor (int i = 0; i < " + repr(len(owned)) + "; ++i) ((uint8_t*)(dummy + 1))[i] = 0;\n"
+        else:
+            size = ""
+            init = ""
+        c_source.write(self.templates["push_self"].render(struct=struct_name, linkage=self.linkage, owned=size, init=init,
+                                                          metatable=self.metatable(struct_name, struct_name)))
+
+    def metatable(self, name, struct_name):
+        # push_ and wrap_ are called from other tables too, with --lazy the
+        # table of the struct may not be registered yet
+        if self.argparser.args.lazy: return self.templates["lazy_metatable"].render(name=name, struct=struct_name)
+        return self.templates["get_metatable"].render(name=name)
+
+    def probe(self, name):
+        if not self.argparser.args.instrument: return str()
+        return self.templates["stats_probe"].render(name=name)
 
+    def owned_fields(self, struct_name):
+        # pointer fields whose memory the setters allocate. everything else a
+        # struct points to belongs to lua (and is anchored) or to the c side.
+        parent = get_def_node(struct_name, self.schema)
+        return [child.attrib["name"] for child in parent if is_array_field(child)]
+
+    @profiled
     def read_xml(self):
-        tree = xml.etree.ElementTree.parse(self.argparser.args.xml)
-        root = tree.getroot()
-        read_tree = xml.etree.ElementTree.Element("read")
-        def_tree = xml.etree.ElementTree.Element("def")
-        for child in root:
-            if child.tag == "Read":
-                read_tree = child
-            if child.tag == "Definition":
-                def_tree = child
-        for child in read_tree:
-            self.read_elems.append(child)
-        for child in def_tree:
-            self.def_elems.append(child)
-        read_iter = read_tree.iter(tag=None)
-        def_iter = def_tree.iter(tag=None)
-        self.read_iter = read_iter
-        self.def_iter = def_iter
-        self.struct_names = []
-        self.lua_types = []
-        lua_type = []
-        self.field_names = []
-        field_name = []
-        self.field_types = []
-        field_type = []
-        for node in self.read_elems+self.def_elems:
-            self.struct_names.append(node.attrib["name"])
-            for child in node:
-                field_name.append(child.attrib["name"])
-                field_type.append(child.attrib["type"])
-                lua_type.append(child.attrib["luatype"])
-            self.field_types.append(field_type)
-            field_type = []
-            self.field_names.append(field_name)
-            field_name = []
-            self.lua_types.append(lua_type)
-            lua_type = []
+        for section, node in iter_schema(self.argparser.args.xml):
+            if section == "Read": self.read_elems.append(node)
+            else: self.def_elems.append(node)
         self.elems = self.def_elems + self.read_elems
+        self.schema = SchemaIndex(self.elems)
 
+    @profiled
     def push_args(self, c_source, struct_name, field_names, lua_types):
         dummy = str()
-        c_source.write(PUSH_ARGS[0].replace("XXX", struct_name))
-        c_source.write("if (_st == NULL) return 0;\n")
-        c_source.write("\tlua_checkstack(__ls, " + repr(len(field_names)) + ");\n")
+        body = io.StringIO()
         if not field_names:
-            orig_node = get_def_node(struct_name, self.elems)
+            orig_node = get_def_node(struct_name, self.schema)
             lua_type = orig_node.attrib["luatype"]
             field_name = orig_node.attrib["name"]
             if lua_type == "integer": dummy = "\tlua_pushinteger(__ls, _st->"+field_name+");\n"
@@ -609,7 +2744,7 @@ class TbgParser(object):
             elif lua_type == "string": dummy = "\tlua_pushstring(__ls, _st->"+field_name+");\n"
             elif lua_type == "boolean": dummy = "\tlua_pushboolean(__ls, _st->"+field_name+");\n"
             else: print("badf lua type")
-            c_source.write(dummy)
+            body.write(dummy)
         for field_name, lua_type in zip(field_names, lua_types):
             if lua_type == "integer": dummy = "\tlua_pushinteger(__ls, _st->"+field_name+");\n"
             elif lua_type == "lightuserdata": dummy = "\tlua_pushlightuserdata(__ls, _st->"+field_name+");\n"
@@ -617,95 +2752,88 @@ class TbgParser(object):
             elif lua_type == "string": dummy = "\tlua_pushstring(__ls, _st->"+field_name+");\n"
             elif lua_type == "boolean": dummy = "\tlua_pushboolean(__ls, _st->"+field_name+");\n"
             elif lua_type == "table":
-                parent = get_def_node(struct_name, self.elems)
-                child = get_def_node(field_name, self.elems)
+                parent = get_def_node(struct_name, self.schema)
+                child = get_def_node(field_name, self.schema)
                 count_node_name = str()
                 if not child:
-                    for kid in parent:
-                        if kid.attrib["name"] == field_name: child = kid
+                    child = get_field_node(field_name, parent, self.schema)
                 count = get_elem_count(child)
-                count_node = get_count_node(child, parent)
+                count_node = get_count_node(child, parent, self.schema)
                 #print("parent:" + parent.attrib["name"])
                 #print("child:" + child.attrib["name"])
                 #if count_node != None: print("count node:" + count_node.attrib["name"])
                 if count_node != None: count_node_name = count_node.attrib["name"]
                 if count == 1:
-                    dummy = "\tpush_" + type_resolver(child, self.elems) +"(__ls, _st->"+field_name+");\n"
+                    dummy = "\tpush_" + type_resolver(child, self.schema) +"(__ls, _st->"+field_name+");\n"
                 elif count > 1:
-                    dummy = "\tpushluatable_" + type_resolver(child, self.elems) +"(__ls, _st->"+field_name+", _st->"+count+");\n"
+                    dummy = "\tpushluatable_" + type_resolver(child, self.schema) +"(__ls, _st->"+field_name+", _st->"+count+");\n"
                 else:
-                    dummy = "\tpushluatable_" + type_resolver(child, self.elems) +"(__ls, _st->"+field_name+", _st->"+count_node_name+");\n"
+                    dummy = "\tpushluatable_" + type_resolver(child, self.schema) +"(__ls, _st->"+field_name+", _st->"+count_node_name+");\n"
             elif lua_type == "conditional":
-                parent = get_def_node(struct_name, self.elems)
-                child = get_def_node(field_name, self.elems)
+                parent = get_def_node(struct_name, self.schema)
+                child = get_def_node(field_name, self.schema)
                 if not child:
-                    for kid in parent:
-                        if kid.attrib["name"] == field_name: child = kid
-                cond_node = get_def_node_tag(child.attrib["condition"][6:], [child for child in parent])
+                    child = get_field_node(field_name, parent, self.schema)
+                cond_node = get_field_node_tag(child.attrib["condition"][6:], parent, self.schema)
                 for childer in child:
-                    c_source.write("if (_st->" + cond_node.attrib["name"] + "==" + childer.text + ")\n")
-                    if childer.attrib["luatype"] == "integer": c_source.write("lua_pushinteger(__ls, _st->" + child.attrib["name"] + ");\n")
-                    elif childer.attrib["luatype"] == "number":c_source.write("lua_pushnumber(__ls, _st->" + child.attrib["name"] + ");\n")
-                    elif childer.attrib["luatype"] == "string":c_source.write("lua_pushstring(__ls, _st->" + child.attrib["name"] + ");\n")
+                    body.write("if (_st->" + cond_node.attrib["name"] + "==" + childer.text + ")\n")
+                    if childer.attrib["luatype"] == "integer": body.write("lua_pushinteger(__ls, _st->" + child.attrib["name"] + ");\n")
+                    elif childer.attrib["luatype"] == "number":body.write("lua_pushnumber(__ls, _st->" + child.attrib["name"] + ");\n")
+                    elif childer.attrib["luatype"] == "string":body.write("lua_pushstring(__ls, _st->" + child.attrib["name"] + ");\n")
                     elif childer.attrib["luatype"] == "lightuserdata":
                         count = get_elem_count(childer)
+                        # new_ takes struct references as raw pointers too, push_ makes an empty object
                         if count == 1:
-                            ref_type_node = get_def_node_tag(childer.attrib["type"][6:], self.elems)
-                            if ref_type_node != None:
-                                c_source.write("push_" + ref_type_node.attrib["name"] + "(__ls, _st->" + child.attrib["name"] + ");\n")
-                            else:
-                                c_source.write("lua_pushlightuserdata(__ls, _st->" + child.attrib["name"] + ");\n")
+                            body.write("lua_pushlightuserdata(__ls, _st->" + child.attrib["name"] + ");\n")
                         # FIXME
                     else: pass
             else:
                 print("bad lua_type entry in the json file")
                 sys.exit(1)
-            c_source.write(dummy)
+            body.write(dummy)
             dummy = str()
-        if not field_names:
-            c_source.write(PUSH_ARGS[2].replace("NNN", "1"))
-        else:
-            c_source.write(PUSH_ARGS[2].replace("NNN", repr(len(field_names))))
-        c_source.write("\n")
+        if not field_names: count = "1"
+        else: count = repr(len(field_names))
+        c_source.write(self.templates["push_args"].render(struct=struct_name, linkage=self.linkage, probe=self.probe(struct_name + "_push_args"), stack=repr(len(field_names)),
+                                                          body=body.getvalue(), count=count))
 
+    @profiled
     def new(self, c_source, struct_name, field_types, field_names, lua_types):
         dummy = str()
         rev_counter = -len(field_types)
-        c_source.write(NEW[0].replace("XXX", struct_name))
-        if not field_names:
-            c_source.write("\tlua_checkstack(__ls, 1);\n")
-        else:
-            c_source.write("\tlua_checkstack(__ls, " + repr(len(field_names)) + ");\n")
+        locals_source = io.StringIO()
+        anchors = io.StringIO()
+        assignments = io.StringIO()
+        if not field_names: stack = "1"
+        else: stack = repr(len(field_names))
         if not field_names:
-            orig_node = get_def_node(struct_name, self.elems)
+            orig_node = get_def_node(struct_name, self.schema)
             lua_type = orig_node.attrib["luatype"]
             field_name = orig_node.attrib["name"]
             field_type = orig_node.attrib["type"]
             if lua_type == "integer": dummy = "\t"+simple_type_resovler(field_type) +" "+field_name +"_s"+" = "+"luaL_optinteger(__ls,-1,0);\n"
             elif lua_type == "string":dummy = "\t"+simple_type_resovler(field_type) +" "+field_name+" = "+"lua_tostring(__ls,-1,0);\n"
-            c_source.write(dummy)
+            locals_source.write(dummy)
         for lua_type, field_name, field_type in zip(lua_types, field_names, field_types):
-            parent = get_def_node(struct_name, self.elems)
-            child = get_def_node(field_name, self.elems)
-            for kid in parent:
-                if kid.attrib["name"] == field_name: child = kid
+            parent = get_def_node(struct_name, self.schema)
+            child = get_field_node(field_name, parent, self.schema)
             if lua_type == "integer": dummy = "\t"+simple_type_resovler(field_type) +" "+field_name+" = "+"luaL_optinteger(__ls,"+repr(rev_counter)+",0);\n"
             elif lua_type == "lightuserdata":
-                parent_node = get_def_node(struct_name, self.elems)
-                self_node = get_def_node(field_name, parent_node)
+                parent_node = get_def_node(struct_name, self.schema)
+                self_node = get_field_node(field_name, parent_node, self.schema)
                 count = get_elem_count(self_node)
                 if field_type.find("self::") == 0:
                     ptr = ""
                     if count != 1: ptr = "*"
-                    child_node = get_def_node_tag(field_type[6:], self.elems)
-                    dummy = "\t"+child_node.attrib["name"] + ptr +"* "+field_name+" = "+"lua_touserdata(__ls,"+repr(rev_counter)+");\n"
+                    child_node = get_def_node_tag(field_type[6:], self.schema)
+                    dummy = "\t"+child_node.attrib["name"] + ptr +"* "+field_name+" = "+"tablegen_toobject(__ls,"+repr(rev_counter)+");\n"
                 else:
                     ptr = str()
                     if count != 1: ptr = "*"
-                    if type_resolver(child, self.elems) != field_type:
-                        dummy = "\t"+type_resolver(child, self.elems) + ptr + " "+field_name+" = "+"lua_touserdata(__ls,"+repr(rev_counter)+");\n"
+                    if type_resolver(child, self.schema) != field_type:
+                        dummy = "\t"+type_resolver(child, self.schema) + ptr + " "+field_name+" = "+"tablegen_toobject(__ls,"+repr(rev_counter)+");\n"
                     else:
-                        dummy = "\t"+field_type+" "+field_name+" = "+"lua_touserdata(__ls,"+repr(rev_counter)+");\n"
+                        dummy = "\t"+field_type+" "+field_name+" = "+"tablegen_toobject(__ls,"+repr(rev_counter)+");\n"
             elif lua_type == "number": pass
             elif lua_type == "string":dummy = "\t"+simple_type_resovler(field_type) +" "+field_name+" = "+"lua_tostring(__ls,"+repr(rev_counter)+");\n"
             elif lua_type == "boolean": pass
@@ -718,7 +2846,7 @@ class TbgParser(object):
                 for kind in child:
                     #print(kind.tag)
                     #print(child.attrib["condition"][6:])
-                    cond_node = get_def_node_tag(child.attrib["condition"][6:], parent)
+                    cond_node = get_field_node_tag(child.attrib["condition"][6:], parent, self.schema)
                     lua_eq_type = get_eq_lua_type(kind.attrib["type"])
                     push = str()
                     #if lua_eq_type == "integer": push = child.attrib["name"]+"=luaL_optinteger(__ls,"+repr(rev_counter)+",0);\n"
@@ -727,54 +2855,49 @@ class TbgParser(object):
                     #elif lua_eq_type == "lightuserdata":push = child.attrib["name"]+"=lua_touserdata(__ls,"+repr(rev_counter)+");\n"
                     #elif lua_eq_type == None:push = child.attrib["name"]+"=lua_touserdata(__ls,"+repr(rev_counter)+");\n"
                     #else: print("this was not supposed to happen...")
-                    push = child.attrib["name"]+"=lua_touserdata(__ls,"+repr(rev_counter)+");\n"
+                    push = child.attrib["name"]+"=tablegen_toobject(__ls,"+repr(rev_counter)+");\n"
                     dummy += "if (" + cond_node.attrib["name"] + " ==" + kind.text+ ") {"+push+"}\n"
                 #dummy = "void* " + child.attrib["name"] + "=" + self.gen_luato_generic(struct_name, field_name, rev_counter)
             else:
                 print("bad lua_type entry in the json file")
                 sys.exit(1)
+            # the new struct points into these userdata, it has to keep them alive.
+            # push_ has put the struct on top so the arguments are one slot lower.
+            if lua_type in ("lightuserdata", "conditional", "string"):
+                anchors.write("\ttablegen_anchor(__ls, -1, \"" + field_name + "\", " + repr(rev_counter - 1) + ");\n")
             rev_counter += 1
-            c_source.write(dummy)
+            locals_source.write(dummy)
             dummy = str()
-        if not field_names:
-            c_source.write("lua_pop(__ls,1);\n")
-        else:
-            c_source.write("lua_pop(__ls,"+repr(len(field_types))+");\n")
-        c_source.write(NEW[2].replace("XXX", struct_name))
+        if not field_names: count = "1"
+        else: count = repr(len(field_types))
         for field_name in field_names:
-            c_source.write("\tdummy->" + field_name + " = " + field_name + ";\n")
+            assignments.write("\tdummy->" + field_name + " = " + field_name + ";\n")
         if not field_names:
-            orig_node = get_def_node(struct_name, self.elems)
+            orig_node = get_def_node(struct_name, self.schema)
             lua_type = orig_node.attrib["luatype"]
             field_name = orig_node.attrib["name"]
             field_type = orig_node.attrib["type"]
-            c_source.write("\tdummy->" + field_name + " = " + field_name + "_s"  + ";\n")
-        c_source.write(NEW[3].replace("XXX", struct_name))
-        c_source.write("\n")
+            assignments.write("\tdummy->" + field_name + " = " + field_name + "_s"  + ";\n")
+        c_source.write(self.templates["new"].render(struct=struct_name, linkage=self.linkage, probe=self.probe("new_" + struct_name), stack=stack, locals=locals_source.getvalue(),
+                                                    count=count, anchors=anchors.getvalue(), assignments=assignments.getvalue()))
 
+    @profiled
     def getter(self, c_source, struct_name, field_names, field_types, lua_types):
         dummy = str()
         for field_name, lua_type, field_type in zip(field_names, lua_types, field_types):
-            c_source.write(GETTER_GEN[0].replace("XXX", struct_name).replace("YYY", field_name))
-            c_source.write(GETTER_GEN[1].replace("XXX", struct_name))
-            c_source.write(GETTER_GEN[2])
-            parent = get_def_node(struct_name, self.elems)
-            #child = get_def_node(field_name, self.elems)
-            for kid in parent:
-                if field_name == kid.attrib["name"]: child = kid
+            parent = get_def_node(struct_name, self.schema)
+            #child = get_def_node(field_name, self.schema)
+            child = get_field_node(field_name, parent, self.schema)
             count = get_elem_count(child)
-            count_node = get_count_node(child, parent)
+            count_node = get_count_node(child, parent, self.schema)
             count_node_name = str()
             if count_node != None: count_node_name = count_node.attrib["name"]
-            ref_node_type = get_def_node_tag(child.attrib["type"][6:], self.elems)
-            if not child:
-                for kid in parent:
-                    if kid.attrib["name"] == field_name: child = kid
+            ref_node_type = get_def_node_tag(child.attrib["type"][6:], self.schema)
+            if is_array_field(child): lua_type = "lightuserdata"
             if lua_type == "integer": dummy = "\tlua_pushinteger(__ls, dummy->"+field_name+");\n"
             elif lua_type == "lightuserdata":
                 if count == 1:
-                    dummy = "lua_pushlightuserdata(__ls, dummy->"+child.attrib["name"]+");\n"
-                    dummy += "lua_gettable(__ls, LUA_REGISTRYINDEX);\n"
+                    dummy = "tablegen_cache_get(__ls, dummy->"+child.attrib["name"]+");\n"
                     #dummy += 'luaL_getmetatable(__ls, "'+ref_node_type.attrib["name"]+'");\n'
                     #dummy += "lua_setmetatable(__ls, -2);\n"
                     #dummy = ref_node_type.attrib["name"]+ "_push_args(__ls, dummy->"+field_name+");\nnew_" + ref_node_type.attrib["name"] + "(__ls);\n"
@@ -783,34 +2906,34 @@ class TbgParser(object):
                     count_replacer = str()
                     if count > 1: count_replacer = repr(count)
                     else:
-                        count_replacer = count_node_name
-                    dummy = "lua_checkstack(__ls, 3);\nlua_newtable(__ls);\n"
-                    dummy += "for (uint64_t i = 0; i < dummy->" + count_replacer + " ; ++i) {\nlua_pushinteger(__ls, i+1);\n"
-                    if ref_node_type != None:
-                        dummy += "if (dummy->" +field_name+ "[i] != NULL) {\n"
-                        dummy += "lua_pushlightuserdata(__ls, dummy->"+field_name+"[i]);\n"
-                        dummy += "lua_gettable(__ls, LUA_REGISTRYINDEX);\n"
-                        #dummy += 'luaL_getmetatable(__ls,"'+ref_node_type.attrib["name"]+'");\n'
-                        #dummy += "lua_setmetatable(__ls, -2);\n"
-                        dummy += "} else {\nlua_pop(__ls, 1);\n continue;\n}"
+                        count_replacer = "dummy->" + count_node_name
+                    if ref_node_type != None: kind = "TABLEGEN_OBJECT"
+                    else: kind = VIEW_KINDS.get(field_type)
+                    if kind != None:
+                        c_source.write(self.templates["view_resolve"].render(struct=struct_name, field=field_name, count=count_replacer))
+                        dummy = "\ttablegen_push_view(__ls, 1, view_" + struct_name + "_" + field_name + ", " + kind + ", \"" + field_name + "[]\");\n"
                     else:
+                        # an unset array has no elements whatever its count field says
+                        dummy = "uint64_t length = dummy->" + field_name + " != NULL ? " + count_replacer + " : 0;\n"
+                        dummy += "lua_checkstack(__ls, 3);\nlua_createtable(__ls, length > INT_MAX ? 0 : (int)length, 0);\n"
+                        dummy += "for (uint64_t i = 0; i < length; ++i) {\n"
                         eq_lua_type = get_eq_lua_type(field_type)
                         dummy += "lua_push"+eq_lua_type+"(__ls, dummy->"+field_name+"[i]);\n"
-                    dummy += "lua_settable(__ls, -3);\n}\n"
+                        dummy += "lua_rawseti(__ls, -2, i + 1);\n}\n"
             elif lua_type == "number": dummy = "\tlua_pushnumber(__ls, dummy->"+field_name+");\n"
             elif lua_type == "string": dummy = "\tlua_pushstring(__ls, dummy->"+field_name+");\n"
             elif lua_type == "boolean": dummy = "\tlua_pushboolean(__ls, dummy->"+field_name+");\n"
             elif lua_type == "table":
                 if count == 1:
-                    dummy = "\tpush_" + type_resolver(child, self.elems) +"(__ls, dummy->"+field_name+");\n"
+                    dummy = "\tpush_" + type_resolver(child, self.schema) +"(__ls, dummy->"+field_name+");\n"
                 elif count > 1:
-                    dummy = "\tpushluatable_" + type_resolver(child, self.elems) +"(__ls, dummy->"+field_name+", dummy->"+count+");\n"
+                    dummy = "\tpushluatable_" + type_resolver(child, self.schema) +"(__ls, dummy->"+field_name+", dummy->"+count+");\n"
                 else:
-                    dummy = "\tpushluatable_" + type_resolver(child, self.elems) +"(__ls, dummy->"+field_name+", dummy->"+count_node_name+");\n"
+                    dummy = "\tpushluatable_" + type_resolver(child, self.schema) +"(__ls, dummy->"+field_name+", dummy->"+count_node_name+");\n"
             elif lua_type == "conditional":
                 #FIXME-wont work properly for counts greater than 1
                 for kind in child:
-                    cond_node = get_def_node_tag(child.attrib["condition"][6:], parent)
+                    cond_node = get_field_node_tag(child.attrib["condition"][6:], parent, self.schema)
                     lua_eq_type = get_eq_lua_type(kind.attrib["type"])
                     push = str()
                     if lua_eq_type == "integer": push = "lua_pushinteger(__ls, dummy->"+child.attrib["name"]+");\n"
@@ -818,12 +2941,11 @@ class TbgParser(object):
                     elif lua_eq_type == "string": push = "lua_pushstring(__ls, dummy->"+child.attrib["name"]+");\n"
                     elif lua_eq_type == "lightuserdata": push = ""
                     elif lua_eq_type == None:
-                        type_node = get_def_node_tag(kind.attrib["type"][6:], self.elems)
+                        type_node = get_def_node_tag(kind.attrib["type"][6:], self.schema)
                         #print(kind.attrib["type"])
                         #push = type_node.attrib["name"]+"_push_args(__ls, dummy->"+child.attrib["name"]+");\n"
                         #push += "new_" + type_node.attrib["name"] + "(__ls);\n"
-                        push = "lua_pushlightuserdata(__ls, dummy->"+child.attrib["name"]+");\n"
-                        push += "lua_gettable(__ls, LUA_REGISTRYINDEX);\n"
+                        push = "tablegen_cache_get(__ls, dummy->"+child.attrib["name"]+");\n"
                         #push += 'luaL_getmetatable(__ls, "'+type_node.attrib["name"]+'");\n'
                         #push += "lua_setmetatable(__ls, -2);\n"
                     else: print("this was not supposed to happen...")
@@ -831,21 +2953,41 @@ class TbgParser(object):
             else:
                 print("bad lua_type entry in the json file")
                 sys.exit(1)
-            c_source.write(dummy)
+            # views only need the struct checked, not read
+            receiver = struct_name + "* dummy = " if "dummy" in dummy else str()
+            c_source.write(self.templates["getter"].render(struct=struct_name, field=field_name, body=dummy, receiver=receiver,
+                                                           probe=self.probe("getter_" + struct_name + "_" + field_name)))
             dummy = str()
-            c_source.write(GETTER_GEN[3])
         c_source.write("\n")
 
+    @profiled
     def setter(self, c_source, struct_name, field_names, field_types, lua_types):
         dummy = str()
+        owned = self.owned_fields(struct_name)
+        # count field -> the arrays it counts, they are resized when it is set
+        counted = {}
+        parent = get_def_node(struct_name, self.schema)
+        for node in parent:
+            if not is_array_field(node): continue
+            count_node = get_count_node(node, parent, self.schema)
+            if count_node is not None: counted.setdefault(count_node.attrib["name"], []).append(node.attrib["name"])
+        for count_name, arrays in counted.items():
+            body = "".join([self.templates["resize_array"].render(index=repr(owned.index(array)), field=array, count=count_name) for array in arrays])
+            c_source.write(self.templates["resize"].render(struct=struct_name, count=count_name, body=body))
         for field_name, lua_type in zip(field_names, lua_types):
-            parent = get_def_node(struct_name, self.elems)
-            node = get_def_node(field_name, parent)
-            type_node = get_def_node_tag(node.attrib["type"][6:], self.elems)
+            parent = get_def_node(struct_name, self.schema)
+            node = get_field_node(field_name, parent, self.schema)
+            type_node = get_def_node_tag(node.attrib["type"][6:], self.schema)
             count = get_elem_count(node)
-            c_source.write(SETTER_GEN[0].replace("XXX", struct_name).replace("YYY", field_name))
-            c_source.write(SETTER_GEN[1].replace("XXX", struct_name))
-            if lua_type == "integer": dummy = "\tdummy->" + field_name + " = " + "luaL_checkinteger(__ls, 2);\n"
+            if is_array_field(node): lua_type = "lightuserdata"
+            bits = self.field_bits(node)
+            # a bitfield keeps the low bits like a wider field keeps the low bytes
+            if lua_type == "integer" and field_name in counted:
+                value = "luaL_checkinteger(__ls, 2)"
+                if bits: value += " & " + hex((1 << bits) - 1)
+                dummy = "\tresize_" + struct_name + "_" + field_name + "(__ls, dummy, " + value + ", -1);\n"
+            elif lua_type == "integer" and bits: dummy = "\tdummy->" + field_name + " = " + "luaL_checkinteger(__ls, 2) & " + hex((1 << bits) - 1) + ";\n"
+            elif lua_type == "integer": dummy = "\tdummy->" + field_name + " = " + "luaL_checkinteger(__ls, 2);\n"
             elif lua_type == "lightuserdata":
                 if type_node != None:
                     type_replacement = type_node.attrib["name"]
@@ -855,25 +2997,65 @@ class TbgParser(object):
                 if count == 1:
                     #dummy += "free(dummy->" + field_name + ");\n"
                     #dummy += "dummy->" +field_name+ "=calloc(sizeof(" +type_replacement+ "),1);\n"
-                    dummy += "dummy->" + field_name + "= luaL_checkudata(__ls, -1,\""+type_replacement+"\");\n"
+                    dummy += "dummy->" + field_name + "= tablegen_checkobject(__ls, -1,\""+type_replacement+"\");\n"
+                    dummy += "tablegen_anchor(__ls, 1, \"" + field_name + "\", -1);\n"
                     dummy += "lua_pop(__ls, 1);\n"
                 else:
-                    dummy = "if (!lua_checkstack(__ls, 3)) {printf(\"error\"\n);return 0;}\n"
-                    dummy += "int table_length = lua_rawlen(__ls, 2);\nfree(dummy->"+field_name+");\n"
-                    #dummy += "dummy->" +field_name+ "=calloc(sizeof(" +type_replacement+ ")*table_length,1);\n"
-                    dummy += "dummy->" +field_name+ "=lua_newuserdata(__ls, sizeof(" +type_replacement+ ")*table_length);\n"
-                    dummy += "for (int i = 1; i <= table_length; ++i) {\n lua_rawgeti(__ls, 2, i);\n"
+                    flag = "owned_" + struct_name + "(__ls, 1)[" + repr(owned.index(field_name)) + "]"
+                    kind = VIEW_KINDS.get(node.attrib["type"])
+                    # the count field follows the new length once the new array is
+                    # in place. a fixed count is what views read, never allocate less.
+                    count_node = get_count_node(node, parent, self.schema)
+                    size = "XXX"
+                    resize = str()
+                    if count_node is not None:
+                        resize = "resize_" + struct_name + "_" + count_node.attrib["name"] + "(__ls, dummy, XXX, " + repr(owned.index(field_name)) + ");\n"
+                    elif count > 1:
+                        size = "XXX > " + repr(count) + " ? XXX : " + repr(count)
+                    if type_node == None and kind not in (None, "TABLEGEN_STRING"):
+                        # views and byte strings of the same element type are
+                        # copied in one go instead of element by element
+                        dummy = "uint64_t buffer_length;\n"
+                        dummy += "const void* buffer = tablegen_buffer(__ls, 2, " + kind + ", &buffer_length);\n"
+                        dummy += "if (buffer != NULL) {\n"
+                        dummy += type_replacement + "* items = calloc(" + size.replace("XXX", "buffer_length") + ", sizeof(" + type_replacement + "));\n"
+                        dummy += "if (buffer_length) memcpy(items, buffer, buffer_length * sizeof(" + type_replacement + "));\n"
+                        dummy += "if (" + flag + ") free(dummy->" + field_name + ");\n"
+                        dummy += "dummy->" + field_name + " = items;\n"
+                        dummy += flag + " = 1;\n"
+                        dummy += resize.replace("XXX", "buffer_length")
+                        dummy += "lua_settop(__ls, 1);\nreturn 1;\n}\n"
+                    dummy += "luaL_checktype(__ls, 2, LUA_TTABLE);\n"
+                    dummy += "if (!lua_checkstack(__ls, 3)) {printf(\"error\"\n);return 0;}\n"
+                    dummy += "int table_length = lua_rawlen(__ls, 2);\n"
+                    # only free what a previous call to this setter allocated
+                    dummy += "if (" + flag + ") free(dummy->" + field_name + ");\n"
+                    dummy += "dummy->" +field_name+ "=calloc(" + size.replace("XXX", "table_length") + ", sizeof(" +type_replacement+ "));\n"
+                    dummy += flag + " = 1;\n"
+                    dummy += resize.replace("XXX", "table_length")
                     real_type = node.attrib["type"]
                     real_type_string = lua_type_resolver(real_type)
+                    # the elements are anchored one by one under field[], the same
+                    # slots array views store into
+                    anchor = "tablegen_anchor_element(__ls, 1, \"" + field_name + "[]\", i-1, -1);\n"
+                    if real_type_string in ("lightuserdata", "string"):
+                        dummy += "lua_pushnil(__ls);\ntablegen_anchor(__ls, 1, \"" + field_name + "[]\", -1);\nlua_pop(__ls, 1);\n"
+                    dummy += "for (int i = 1; i <= table_length; ++i) {\n lua_rawgeti(__ls, 2, i);\n"
                     if real_type_string == "lightuserdata":
-                        dummy += "dummy->" + field_name + "[i-1] = luaL_checkudata(__ls , -1, \""+type_replacement+"\");\n"
+                        dummy += "dummy->" + field_name + "[i-1] = tablegen_checkobject(__ls , -1, \""+type_replacement+"\");\n"
+                        dummy += anchor
                     elif real_type_string == "integer":
                         dummy += "dummy->" + field_name + "[i-1] = luaL_checkinteger(__ls , -1);\n"
+                    elif real_type_string == "number":
+                        dummy += "dummy->" + field_name + "[i-1] = luaL_checknumber(__ls , -1);\n"
                     elif real_type_string == "string":
                         dummy += "dummy->" + field_name + "[i-1] = luaL_checkstring(__ls , -1);\n"
+                        dummy += anchor
                     dummy += "lua_pop(__ls, 1);\n}\n"
             elif lua_type == "number": dummy ="\tdummy->" + field_name + " = " + "luaL_checknumber(__ls, 2);\n"
-            elif lua_type == "string": dummy ="\tdummy->" + field_name + " = " + "luaL_checkstring(__ls, 2);\n"
+            elif lua_type == "string":
+                dummy ="\tdummy->" + field_name + " = " + "luaL_checkstring(__ls, 2);\n"
+                dummy += "\ttablegen_anchor(__ls, 1, \"" + field_name + "\", 2);\n"
             elif lua_type == "boolean": pass
             elif lua_type == "table": dummy = "\t;\n"
             elif lua_type == "conditional":
@@ -881,26 +3063,27 @@ class TbgParser(object):
                     type_replacement = type_node.attrib["name"]
                 else:
                     type_replacement = simple_type_resovler(node.attrib["type"])
-                cond_node = get_cond_node(node, parent)
+                cond_node = get_cond_node(node, parent, self.schema)
                 if count == 1:
                     #-FIXME i should really do something about memory management.this is getting out of hand...
                     #dummy += "free(dummy->" + field_name + ");\n"
                     for con_child in node:
-                        child_def_node = get_def_node(con_child.attrib["type"][6:], self.elems)
+                        child_def_node = get_def_node(con_child.attrib["type"][6:], self.schema)
                         dummy += "if (dummy->"+cond_node.attrib["name"]+" == "+con_child.text+"){"
                         if child_def_node:
                             #dummy += "dummy->" +field_name+ "=calloc(sizeof(" +child_def_node.attrib["name"]+ "),1);\n"
-                            dummy += "dummy->" + field_name + "= luaL_checkudata(__ls, -1,\""+child_def_node.attrib["name"]+"\");}\n"
+                            dummy += "dummy->" + field_name + "= tablegen_checkobject(__ls, -1,\""+child_def_node.attrib["name"]+"\");}\n"
                         else:
-                            con_child_type_node = get_def_node_tag(con_child.attrib["type"][6:], self.elems)
+                            con_child_type_node = get_def_node_tag(con_child.attrib["type"][6:], self.schema)
                             if con_child_type_node: # for user-defined structs
                                 #dummy += "dummy->" +field_name+ "=calloc(sizeof(" +con_child_type_node.attrib["name"]+ "),1);\n"
-                                dummy += "dummy->" + field_name + "= luaL_checkudata(__ls, -1,\""+con_child_type_node.attrib["name"]+"\");}\n"
+                                dummy += "dummy->" + field_name + "= tablegen_checkobject(__ls, -1,\""+con_child_type_node.attrib["name"]+"\");}\n"
                             else: #for simple types
                                 real_type_string = lua_type_resolver(con_child.attrib["type"])
                                 #dummy += "dummy->" +field_name+ "=calloc(sizeof(" +simple_type_resovler(con_child.attrib["type"])+ "),1);\n"
                                 lua_push_func_str = get_lua_pop_func(real_type_string)
                                 dummy += "dummy->" + field_name + "="+ lua_push_func_str.replace("XXX", "-1")+";}\n"
+                    dummy += "tablegen_anchor(__ls, 1, \"" + field_name + "\", -1);\n"
                     #dummy += "lua_pop(__ls, 1);\n"
                 # FIXME- not implemented for count greater than one
                 else:
@@ -908,89 +3091,431 @@ class TbgParser(object):
                     dummy += "int table_length = lua_rawlen(__ls, 2);\n"
                     #dummy += "free(dummy->"+field_name+");\n"
                     #dummy += "dummy->" +field_name+ "=calloc(sizeof(" +type_replacement+ ")*table_length,1);\n"
-                    dummy += "for (int i = 1; i <= table_length; ++i) {\n lua_rawgeti(__ls, 2, i);\n"
                     real_type = node.attrib["type"]
                     real_type_string = lua_type_resolver(real_type)
+                    # the elements are anchored one by one under field[], the same
+                    # slots array views store into
+                    anchor = "tablegen_anchor_element(__ls, 1, \"" + field_name + "[]\", i-1, -1);\n"
+                    if real_type_string in ("lightuserdata", "string"):
+                        dummy += "lua_pushnil(__ls);\ntablegen_anchor(__ls, 1, \"" + field_name + "[]\", -1);\nlua_pop(__ls, 1);\n"
+                    dummy += "for (int i = 1; i <= table_length; ++i) {\n lua_rawgeti(__ls, 2, i);\n"
                     if real_type_string == "lightuserdata":
-                        dummy += "dummy->" + field_name + "[i-1] = luaL_checkudata(__ls , -1, \""+type_replacement+"\");\n"
+                        dummy += "dummy->" + field_name + "[i-1] = tablegen_checkobject(__ls , -1, \""+type_replacement+"\");\n"
+                        dummy += anchor
                     elif real_type_string == "integer":
                         dummy += "dummy->" + field_name + "[i-1] = luaL_checkinteger(__ls , -1);\n"
                     elif real_type_string == "string":
                         dummy += "dummy->" + field_name + "[i-1] = luaL_checkstring(__ls , -1);\n"
+                        dummy += anchor
                     dummy += "lua_pop(__ls, 1);\n}\n"
             else:
                 print("bad lua_type entry in the json file")
                 sys.exit(1)
-            c_source.write(dummy)
+            c_source.write(self.templates["setter"].render(struct=struct_name, field=field_name, body=dummy,
+                                                           probe=self.probe("setter_" + struct_name + "_" + field_name)))
             dummy = str()
-            c_source.write(SETTER_GEN[2])
-            c_source.write(SETTER_GEN[3])
         c_source.write("\n")
 
-    def gc(self):
-        dummy = str()
-        for field_name, lua_type in zip(field_names, lua_types):
-            parent = get_def_node(struct_name, self.elems)
-            node = get_def_node(field_name, parent)
-            type_node = get_def_node_tag(node.attrib["type"][6:], self.elems)
-            count = get_elem_count(node)
-            if lua_type == "integer": pass
-            elif lua_type == "lightuserdata": pass
-            elif lua_type == "number": pass
-            elif lua_type == "string": pass
-            elif lua_type == "boolean": pass
-            elif lua_type == "table": pass
-            elif lua_type == "conditional": pass
-            c_source.write(dummy)
-            dummy = str()
-        c_source.write("\n")
+    @profiled
+    def gc(self, c_source, struct_name):
+        owned = self.owned_fields(struct_name)
+        if not owned: return
+        body = str()
+        for index, field_name in enumerate(owned):
+            flag = "owned_" + struct_name + "(__ls, 1)[" + repr(index) + "]"
+            body += "\tif (" + flag + ") {free(dummy->" + field_name + "); dummy->" + field_name + " = NULL; " + flag + " = 0;}\n"
+        c_source.write(self.templates["gc"].render(struct=struct_name, body=body))
 
     def tostring(self):
         pass
 
+    def pack_scalar(self, node, value):
+        # statement writing an integer or floating point value of node's type
+        c_type = simple_type_resovler(node.attrib["type"])
+        encoding = node.get("encoding")
+        if c_type == "float": return "tablegen_pack_float(b, " + value + ");\n"
+        if c_type == "double": return "tablegen_pack_double(b, " + value + ");\n"
+        if encoding == "leb128u": return "tablegen_pack_uleb(b, (uint64_t)" + value + ");\n"
+        if encoding == "leb128s": return "tablegen_pack_sleb(b, (int64_t)" + value + ");\n"
+        return "tablegen_pack_fixed(b, (uint64_t)" + value + ", " + repr(C_TYPE_SIZES.get(c_type, 8)) + ");\n"
+
+    def unpack_scalar(self, node):
+        # expression reading what pack_scalar wrote
+        c_type = simple_type_resovler(node.attrib["type"])
+        encoding = node.get("encoding")
+        if c_type == "float": return "tablegen_unpack_float(r)"
+        if c_type == "double": return "tablegen_unpack_double(r)"
+        if encoding == "leb128u": return "tablegen_unpack_uleb(r)"
+        if encoding == "leb128s": return "tablegen_unpack_sleb(r)"
+        return "tablegen_unpack_fixed(r, " + repr(C_TYPE_SIZES.get(c_type, 8)) + ")"
+
+    @profiled
+    def pack(self, c_source, struct_name):
+        parent = get_def_node(struct_name, self.schema)
+        owned = self.owned_fields(struct_name)
+        # a struct that is not an aggregate is its own single field
+        fields = list(parent) if "isaggregate" in parent.attrib else [parent]
+        pack = io.StringIO()
+        unpack = io.StringIO()
+        # an array's length is packed with it, apart from the field counting it.
+        # views trust the count, so the two have to agree once everything is read.
+        lengths = io.StringIO()
+        checks = io.StringIO()
+        for node in fields:
+            field_name = node.attrib["name"]
+            lua_type = node.attrib["luatype"]
+            type_node = get_def_node_tag(node.get("type", "")[6:], self.schema)
+            count = get_elem_count(node)
+            if lua_type == "conditional":
+                cond_node = get_cond_node(node, parent, self.schema)
+                for option in node:
+                    option_node = get_def_node_tag(option.get("type", "")[6:], self.schema)
+                    pack.write("\tif (_st->" + cond_node.attrib["name"] + " == " + option.text + ") {\n")
+                    unpack.write("\tif (dummy->" + cond_node.attrib["name"] + " == " + option.text + ") {\n")
+                    if option_node is not None:
+                        option_struct = option_node.attrib["name"]
+                        pack.write("\t\tif (tablegen_pack_present(b, _st->" + field_name + ", depth)) pack_" + option_struct +
+                                   "_body(b, (" + option_struct + "*)_st->" + field_name + ", depth + 1);\n")
+                        unpack.write("\t\tif (tablegen_unpack_present(r, depth)) {\n")
+                        unpack.write("\t\t\tdummy->" + field_name + " = push_" + option_struct + "(__ls);\n")
+                        unpack.write("\t\t\tunpack_" + option_struct + "_body(__ls, r, lua_gettop(__ls), depth + 1);\n")
+                        unpack.write("\t\t\ttablegen_anchor(__ls, self, \"" + field_name + "\", -1);\n")
+                        unpack.write("\t\t\tlua_pop(__ls, 1);\n\t\t}\n")
+                    else:
+                        # plain values are kept in the pointer itself
+                        pack.write("\t\t" + self.pack_scalar(option, "(uintptr_t)_st->" + field_name))
+                        unpack.write("\t\tdummy->" + field_name + " = (void*)(uintptr_t)" + self.unpack_scalar(option) + ";\n")
+                    pack.write("\t}\n")
+                    unpack.write("\t}\n")
+            elif is_array_field(node):
+                if count > 1: length = repr(count)
+                else:
+                    count_node = get_count_node(node, parent, self.schema)
+                    if count_node is None: continue
+                    length = "_st->" + count_node.attrib["name"]
+                lengths.write("\tuint64_t " + field_name + "_length = 0;\n")
+                checks.write("\tif (" + field_name + "_length != 0 && " + field_name + "_length != (uint64_t)" + length.replace("_st->", "dummy->") + ")\n")
+                checks.write("\t\tluaL_error(__ls, \"packed " + struct_name + " has %d " + field_name + " where its count says %d\", (int)" + field_name + "_length, (int)" +
+                             length.replace("_st->", "dummy->") + ");\n")
+                if type_node is not None: element_type = type_node.attrib["name"] + "*"
+                else: element_type = simple_type_resovler(node.attrib["type"])
+                element_lua_type = "lightuserdata" if type_node is not None else lua_type_resolver(node.attrib["type"])
+                pack.write("\t{\n\tuint64_t length = _st->" + field_name + " != NULL ? (uint64_t)" + length + " : 0;\n")
+                pack.write("\ttablegen_pack_uleb(b, length);\n")
+                pack.write("\tfor (uint64_t i = 0; i < length; ++i) ")
+                unpack.write("\t{\n\tuint64_t length;\n")
+                unpack.write("\tdummy->" + field_name + " = tablegen_unpack_array(r, &length, sizeof(" + element_type + "));\n")
+                unpack.write("\towned[" + repr(owned.index(field_name)) + "] = dummy->" + field_name + " != NULL;\n")
+                unpack.write("\t" + field_name + "_length = length;\n")
+                unpack.write("\tfor (uint64_t i = 0; i < length; ++i) ")
+                if type_node is not None:
+                    element_struct = type_node.attrib["name"]
+                    pack.write("if (tablegen_pack_present(b, _st->" + field_name + "[i], depth)) pack_" + element_struct +
+                               "_body(b, _st->" + field_name + "[i], depth + 1);\n")
+                    unpack.write("if (tablegen_unpack_present(r, depth)) {\n")
+                    unpack.write("\t\tdummy->" + field_name + "[i] = push_" + element_struct + "(__ls);\n")
+                    unpack.write("\t\tunpack_" + element_struct + "_body(__ls, r, lua_gettop(__ls), depth + 1);\n")
+                    unpack.write("\t\ttablegen_anchor_element(__ls, self, \"" + field_name + "[]\", i, -1);\n")
+                    unpack.write("\t\tlua_pop(__ls, 1);\n\t}\n")
+                elif element_lua_type == "string":
+                    pack.write("tablegen_pack_string(b, _st->" + field_name + "[i]);\n")
+                    unpack.write("dummy->" + field_name + "[i] = tablegen_unpack_string(r, self, \"" + field_name + "[]\", i);\n")
+                else:
+                    pack.write(self.pack_scalar(node, "_st->" + field_name + "[i]"))
+                    unpack.write("dummy->" + field_name + "[i] = " + self.unpack_scalar(node) + ";\n")
+                pack.write("\t}\n")
+                unpack.write("\t}\n")
+            elif type_node is not None and count == 1:
+                ref_struct = type_node.attrib["name"]
+                pack.write("\tif (tablegen_pack_present(b, _st->" + field_name + ", depth)) pack_" + ref_struct + "_body(b, _st->" + field_name + ", depth + 1);\n")
+                unpack.write("\tif (tablegen_unpack_present(r, depth)) {\n")
+                unpack.write("\t\tdummy->" + field_name + " = push_" + ref_struct + "(__ls);\n")
+                unpack.write("\t\tunpack_" + ref_struct + "_body(__ls, r, lua_gettop(__ls), depth + 1);\n")
+                unpack.write("\t\ttablegen_anchor(__ls, self, \"" + field_name + "\", -1);\n")
+                unpack.write("\t\tlua_pop(__ls, 1);\n\t}\n")
+            elif lua_type == "string":
+                pack.write("\ttablegen_pack_string(b, _st->" + field_name + ");\n")
+                unpack.write("\tdummy->" + field_name + " = tablegen_unpack_string(r, self, \"" + field_name + "\", -1);\n")
+            elif lua_type in ("integer", "number"):
+                pack.write("\t" + self.pack_scalar(node, "_st->" + field_name))
+                unpack.write("\tdummy->" + field_name + " = " + self.unpack_scalar(node) + ";\n")
+            # tables and booleans have no c representation of their own yet
+        refs = "".join([self.templates["pack_ref_decl"].render(struct=ref, linkage=self.linkage) for ref in get_struct_refs(parent, self.schema)])
+        c_source.write(self.templates["pack"].render(struct=struct_name, linkage=self.linkage, refs=refs, pack=pack.getvalue(), unpack=lengths.getvalue() + unpack.getvalue() + checks.getvalue(),
+                                                     probe=self.probe("pack_" + struct_name), probe_unpack=self.probe("unpack_" + struct_name)))
+
+    def decode_scalar(self, node):
+        # expression reading a value of node's type the way the schema encodes it
+        c_type = simple_type_resovler(node.attrib["type"])
+        encoding = node.get("encoding")
+        if c_type == "float": return "tablegen_decode_float(d)"
+        if c_type == "double": return "tablegen_decode_double(d)"
+        if encoding == "leb128u": return "tablegen_decode_uleb(d)"
+        if encoding == "leb128s": return "tablegen_decode_sleb(d)"
+        return "tablegen_decode_fixed(d, " + repr(C_TYPE_SIZES.get(c_type, 8)) + ")"
+
+    def decode_string(self, node, parent):
+        # a string without a size runs up to and including its delimiter, a nul
+        # unless the schema names another byte. nul delimited strings point into
+        # the input, everything else is copied and terminated.
+        size = node.get("size")
+        if size is None: return "(char*)tablegen_decode_delimited(d, 0)"
+        if size.find("self::") == 0:
+            size_node = get_field_node_tag(size[6:], parent, self.schema)
+            if size_node is None: return None
+            return "tablegen_decode_string(d, _st->" + size_node.attrib["name"] + ")"
+        try:
+            length = int(size)
+        except ValueError:
+            return None
+        if length < 0:
+            delimiter = int(node.get("delimiter", "0"))
+            if delimiter == 0: return "(char*)tablegen_decode_delimited(d, 0)"
+            return "tablegen_decode_delimited_string(d, " + repr(delimiter) + ")"
+        return "tablegen_decode_string(d, " + repr(length) + ")"
+
+    def decoder_struct(self, struct_name):
+        parent = get_def_node(struct_name, self.schema)
+        # a struct that is not an aggregate is its own single field
+        fields = list(parent) if "isaggregate" in parent.attrib else [parent]
+        body = io.StringIO()
+        for node in fields:
+            field_name = node.attrib["name"]
+            lua_type = node.attrib["luatype"]
+            type_node = get_def_node_tag(node.get("type", "")[6:], self.schema)
+            count = get_elem_count(node)
+            if lua_type == "conditional":
+                cond_node = get_cond_node(node, parent, self.schema)
+                if cond_node is None: continue
+                keyword = "if"
+                for option in node:
+                    if not (option.text or "").strip(): continue
+                    option_node = get_def_node_tag(option.get("type", "")[6:], self.schema)
+                    body.write("\t" + keyword + " (_st->" + cond_node.attrib["name"] + " == " + option.text.strip() + ") ")
+                    # plain values are kept in the pointer itself
+                    if option_node is not None: body.write("_st->" + field_name + " = decode_" + option_node.attrib["name"] + "(d, depth + 1);\n")
+                    else: body.write("_st->" + field_name + " = (void*)(uintptr_t)" + self.decode_scalar(option) + ";\n")
+                    keyword = "else if"
+                if keyword != "if":
+                    body.write("\telse tablegen_decode_fail(d, \"" + cond_node.attrib["name"] + " names no alternative of " + field_name + "\");\n")
+            elif is_array_field(node):
+                if count > 1: length = repr(count)
+                else:
+                    count_node = get_count_node(node, parent, self.schema)
+                    if count_node is None: continue
+                    length = "_st->" + count_node.attrib["name"]
+                if type_node is None:
+                    element_type = simple_type_resovler(node.attrib["type"])
+                    # bytes are the same in the input as in the struct
+                    if C_TYPE_SIZES.get(element_type) == 1 and node.get("encoding") is None:
+                        body.write("\t_st->" + field_name + " = (" + element_type + "*)tablegen_decode_bytes(d, " + length + ");\n")
+                        continue
+                else: element_type = type_node.attrib["name"] + "*"
+                body.write("\t{\n\tuint64_t length = " + length + ";\n")
+                body.write("\t_st->" + field_name + " = tablegen_decode_array(d, &length, sizeof(" + element_type + "));\n")
+                body.write("\tfor (uint64_t i = 0; i < length && d->error == NULL; ++i) _st->" + field_name + "[i] = ")
+                if type_node is not None: body.write("decode_" + type_node.attrib["name"] + "(d, depth + 1);\n")
+                elif element_type == "char*": body.write("(char*)tablegen_decode_delimited(d, 0);\n")
+                else: body.write(self.decode_scalar(node) + ";\n")
+                body.write("\t}\n")
+            elif type_node is not None and count == 1:
+                body.write("\t_st->" + field_name + " = decode_" + type_node.attrib["name"] + "(d, depth + 1);\n")
+            elif lua_type == "string":
+                value = self.decode_string(node, parent)
+                if value is not None: body.write("\t_st->" + field_name + " = " + value + ";\n")
+            elif lua_type in ("integer", "number"):
+                body.write("\t_st->" + field_name + " = " + self.decode_scalar(node) + ";\n")
+            # tables and booleans have no c representation of their own yet
+        return self.templates["decoder_struct"].render(struct=struct_name, name=self.argparser.args.name, body=body.getvalue())
+
+    def decoder_structs(self):
+        # the structs the <Read> elements reach through self:: types, in schema order
+        reached = set()
+        pending = [node.attrib["name"] for node in self.read_elems]
+        while pending:
+            struct_name = pending.pop()
+            if struct_name in reached: continue
+            reached.add(struct_name)
+            pending += get_struct_refs(get_def_node(struct_name, self.schema), self.schema)
+        return [node.attrib["name"] for node in self.elems if node.attrib["name"] in reached]
+
+    def decoder_append(self, node):
+        return self.templates["decoder_append"].render(field=node.tag.lower(), struct=node.attrib["name"])
+
+    @profiled
+    def gen_decoder(self):
+        args = self.argparser.args
+        # runs of unordered elements are decoded in whatever order they come
+        # in. unorderedbegin and unorderedend split them where the schema says.
+        groups = []
+        for node in self.read_elems:
+            unordered = node.get("unordered") == "true"
+            if unordered and groups and groups[-1][0] and node.get("unorderedbegin") != "true" and groups[-1][1][-1].get("unorderedend") != "true":
+                groups[-1][1].append(node)
+            else:
+                groups.append((unordered, [node]))
+        fields = io.StringIO()
+        body = io.StringIO()
+        for index, (unordered, nodes) in enumerate(groups):
+            for node in nodes:
+                if node.get("count") == "*":
+                    fields.write(node.attrib["name"] + "** " + node.tag.lower() + ";\nuint64_t " + node.tag.lower() + "_count;\n")
+                else:
+                    fields.write(node.attrib["name"] + "* " + node.tag.lower() + ";\n")
+            if not unordered:
+                node = nodes[0]
+                if node.get("count") == "*":
+                    body.write("\twhile (d->pos < d->length && d->error == NULL) {\n" + self.decoder_append(node) + "\t}\n")
+                else:
+                    body.write("\t_st->" + node.tag.lower() + " = decode_" + node.attrib["name"] + "(d, 0);\n")
+                continue
+            cases = io.StringIO()
+            ids = set()
+            id_node = None
+            for node in nodes:
+                # the first field with a value in the schema tells the elements apart
+                discriminators = [child for child in node if (child.text or "").strip()]
+                if not discriminators:
+                    print(node.attrib["name"] + " is unordered but has no field holding its id.")
+                    sys.exit(1)
+                id_value = discriminators[0].text.strip()
+                if id_value in ids:
+                    print(node.attrib["name"] + " has the same id as another unordered element: " + id_value)
+                    sys.exit(1)
+                ids.add(id_value)
+                if id_node is None: id_node = discriminators[0]
+                if node.get("count") == "*":
+                    cases.write(self.templates["decoder_case_list"].render(id=id_value, append=self.decoder_append(node)))
+                else:
+                    cases.write(self.templates["decoder_case"].render(id=id_value, field=node.tag.lower(), tag=node.tag, struct=node.attrib["name"]))
+            # an id the group does not know ends it when something follows
+            if index == len(groups) - 1:
+                default = "\t\t\ttablegen_decode_fail(d, \"no element with this id\");\n\t\t\tbreak;\n"
+                label = str()
+            else:
+                default = "\t\t\tgoto group_end_" + repr(index) + ";\n"
+                label = "group_end_" + repr(index) + ":;\n"
+            body.write(self.templates["decoder_group"].render(id=self.decode_scalar(id_node), cases=cases.getvalue(), default=default, label=label))
+        struct_names = self.decoder_structs()
+        decls = "".join([self.templates["decoder_struct_decl"].render(struct=struct_name, name=args.name) for struct_name in struct_names])
+        functions = "".join([self.decoder_struct(struct_name) for struct_name in struct_names])
+        header_path = args.decoder
+        # a unity build has no structs.h, the structs go into the decoder's header
+        if args.singlefile: structs = self.unity_parts["structs"]
+        else: structs = self.templates["include"].render(path=os.path.relpath(self.struct_source_h, os.path.dirname(os.path.abspath(header_path))))
+        self.write_output(header_path, self.templates["decoder_header"].render(time=self.time, name=args.name, structs=structs, fields=fields.getvalue()))
+        self.write_output(os.path.splitext(header_path)[0] + ".c",
+                          self.templates["decoder_source"].render(time=self.time, name=args.name, header=os.path.basename(header_path), decls=decls,
+                                                                  functions=functions, body=body.getvalue()))
+
+    @profiled
+    def array(self, c_source, struct_name, field_names):
+        owned = self.owned_fields(struct_name)
+        setters = "".join("\t\"set_" + field_name + "\",\n" for field_name in field_names)
+        gc = str()
+        gc_entry = str()
+        # the ownership bytes follow the items, or the header when the items are wrapped
+        owned_items = "NULL"
+        owned_block = "NULL"
+        wrap_check = str()
+        if owned:
+            owned_items = "(uint8_t*)(dummy->items + length)"
+            owned_block = "(uint8_t*)(dummy + 1)"
+            wrap_check = "\tif (length > (SIZE_MAX - sizeof(" + struct_name + "_array)) / " + repr(len(owned)) + ") luaL_error(__ls, \"array too large\");\n"
+            body = str()
+            for index, field_name in enumerate(owned):
+                body += "\t\tif (owned[" + repr(index) + "]) free(dummy->" + field_name + ");\n"
+            gc = self.templates["array_gc"].render(struct=struct_name, owned=repr(len(owned)), body=body)
+            gc_entry = self.templates["method_entry"].render(name="__gc", func="array_gc_" + struct_name)
+        c_source.write(self.templates["array"].render(struct=struct_name, linkage=self.linkage, owned=repr(len(owned)), setters=setters,
+                                                      owned_items=owned_items, owned_block=owned_block, wrap_check=wrap_check, gc=gc, gc_entry=gc_entry, metatable=self.metatable(struct_name + "_array", struct_name)))
+
+    @profiled
     def register_table_methods(self, c_source, struct_name, field_names):
-        c_source.write(REGISTER_TABLE_METHODS[0].replace("XXX", struct_name))
-        c_source.write('\t{"new", ' + "new_" + struct_name + "},\n")
+        entry = self.templates["method_entry"]
+        entries = [entry.render(name="new", func="new_" + struct_name)]
+        entries.append(entry.render(name="new_array", func="new_array_" + struct_name))
+        entries.append(entry.render(name="pack", func="pack_" + struct_name))
+        entries.append(entry.render(name="unpack", func="unpack_" + struct_name))
         for field_name in field_names:
-            c_source.write("\t{" + '"set_' + field_name + '"' + ", " + "setter_"+struct_name +"_"+ field_name + "},\n")
+            entries.append(entry.render(name="set_" + field_name, func="setter_" + struct_name + "_" + field_name))
         for field_name in field_names:
-            c_source.write("\t{" + '"' + field_name + '", ' + "getter_"+struct_name+"_"+field_name+"},\n")
-        c_source.write(REGISTER_TABLE_METHODS[1])
-        c_source.write("\n")
+            entries.append(entry.render(name=self.getter_method(field_name), func="getter_" + struct_name + "_" + field_name))
+        c_source.write(self.templates["methods"].render(struct=struct_name, entries="".join(entries)))
 
-    def register_table_meta(self, c_source, struct_name):
-        c_source.write(REGISTER_META[0].replace("XXX", struct_name))
-        c_source.write(REGISTER_META[1])
-        c_source.write("\n")
+    def getter_method(self, field_name):
+        # obj.field is the value with --fieldaccess, so the getter needs a name
+        # of its own for obj:getter() to still reach it
+        if self.argparser.args.fieldaccess: return "get_" + field_name
+        return field_name
 
+    def field_dispatch(self, field_names, action):
+        # switch on the key length, then on its first byte. only the few names
+        # left in a bucket are compared in full.
+        buckets = {}
+        for field_name in field_names:
+            buckets.setdefault(len(field_name), {}).setdefault(field_name[0], []).append(field_name)
+        dispatch = "\t\tswitch (length) {\n"
+        for length in sorted(buckets):
+            dispatch += "\t\tcase " + repr(length) + ":\n\t\t\tswitch (key[0]) {\n"
+            for first in sorted(buckets[length]):
+                dispatch += "\t\t\tcase '" + first + "':\n"
+                for field_name in buckets[length][first]:
+                    dispatch += "\t\t\t\tif (memcmp(key, \"" + field_name + "\", " + repr(length) + ") == 0) " + action(field_name) + "\n"
+                dispatch += "\t\t\t\tbreak;\n"
+            dispatch += "\t\t\t}\n\t\t\tbreak;\n"
+        dispatch += "\t\t}\n"
+        return dispatch
+
+    @profiled
+    def field_access(self, c_source, struct_name, field_names):
+        if not self.argparser.args.fieldaccess or not field_names: return
+        getter = lambda field_name: "return getter_" + struct_name + "_" + field_name + "(__ls);"
+        setter = lambda field_name: "{lua_remove(__ls, 2); setter_" + struct_name + "_" + field_name + "(__ls); return 0;}"
+        c_source.write(self.templates["index"].render(struct=struct_name, dispatch=self.field_dispatch(field_names, getter)))
+        c_source.write(self.templates["newindex"].render(struct=struct_name, dispatch=self.field_dispatch(field_names, setter)))
+
+    @profiled
+    def register_table_meta(self, c_source, struct_name, field_names):
+        entries = str()
+        if self.owned_fields(struct_name):
+            entries = self.templates["method_entry"].render(name="__gc", func="gc_" + struct_name)
+        if self.argparser.args.fieldaccess and field_names:
+            entries += self.templates["method_entry"].render(name="__index", func="index_" + struct_name)
+            entries += self.templates["method_entry"].render(name="__newindex", func="newindex_" + struct_name)
+        c_source.write(self.templates["meta"].render(struct=struct_name, entries=entries))
+
+    @profiled
     def register_table(self, c_source, struct_name, length):
         # if anon tables were selected
+        metatables = self.templates["register_metatable"].render(struct=struct_name, index="1")
+        metatables += self.templates["register_metatable"].render(struct=struct_name, index="2")
+        metatables += self.templates["register_ref_metatable"].render(struct=struct_name)
         if self.argparser.args.anon:
-            for line in TABLE_REGISTER:
-                c_source.write(line.replace("XXX", struct_name))
+            c_source.write(self.templates["table_register"].render(struct=struct_name, linkage=self.linkage, metatables=metatables))
         # if global tables were selected
         else:
-            for line in TABLE_REGISTER_G:
-                c_source.write(line.replace("XXX", struct_name))
+            c_source.write(self.templates["table_register_global"].render(struct=struct_name, linkage=self.linkage, metatables=metatables))
+        if self.argparser.args.lazy:
+            c_source.write(self.templates["lazy_loader"].render(struct=struct_name, linkage=self.linkage))
 
+    @profiled
     def end(self, c_source, is_source):
+        post = str()
         if self.argparser.args.post:
-            c_source.write("\n")
-            post_file = open(self.argparser.args.post)
-            for line in post_file:
-                c_source.write(line)
-            post_file.clsoe()
-        c_source.write("\n")
-        if not is_source: c_source.write(EXTERN_C[1])
-        if not is_source: c_source.write(HEADER_GUARD[1])
-        c_source.write("\n")
+            post = "\n" + self.post_text
+        if is_source: template = self.templates["source_epilogue"]
+        else: template = self.templates["header_epilogue"]
+        c_source.write(template.render(post=post))
 
+    @profiled
     def docgen_md(self, d_source, struct_name, field_names, field_types, lua_types):
         d_source.write("## " + "__"  + struct_name + "__"  + ":\n")
         d_source.write("\n")
         d_source.write("### " + "_" + "getter fields" + "_" + ":\n")
         for field_name,lua_type in zip(field_names, lua_types):
-            d_source.write(struct_name + ":" + field_name + "()" + " -- ")
+            if self.argparser.args.fieldaccess: d_source.write(struct_name + "." + field_name + ", ")
+            d_source.write(struct_name + ":" + self.getter_method(field_name) + "()" + " -- ")
             if lua_type == "lightuserdata":
                 d_source.write("return type: " + field_name + "_t" + "<br/>" + "\n")
             else:
@@ -998,6 +3523,7 @@ class TbgParser(object):
         d_source.write("\n")
         d_source.write("### " + "_" + "setter fields" + "_" + ":\n")
         for field_name,lua_type in zip(field_names, lua_types):
+            if self.argparser.args.fieldaccess: d_source.write(struct_name + "." + field_name + " = v, ")
             d_source.write(struct_name + ":set_" + field_name + "()" + " -- ")
             if lua_type == "lightuserdata":
                 d_source.write("arg type: " + field_name + "_t" + "<br/>" + "\n")
@@ -1007,52 +3533,54 @@ class TbgParser(object):
         d_source.write("### " + "_" + "constructors" + "_" + ":\n")
         d_source.write(struct_name + ":new() -- needs all the args<br/>\n")
         d_source.write(struct_name + "() -- lazy constructor<br/>\n")
+        d_source.write(struct_name + ".new_array(n [, init]) -- n structs in one block<br/>\n")
+        d_source.write(struct_name + ".unpack(str [, offset]) -- a struct from " + struct_name + ":pack(), and the offset after it<br/>\n")
         d_source.write("\n")
         d_source.write("\n")
 
+    @profiled
     def luagen(self, l_source, struct_name, field_names, field_types, lua_types):
-        l_source.write(LUA_SETMETA_NEW[0].replace("XXX", struct_name))
         arg_list_str = str()
         for i in range(0, len(field_names)):
             arg_list_str += ", arg" + repr(i)
-        l_source.write(LUA_SETMETA_NEW[1].replace("AAA", arg_list_str))
-        l_source.write(LUA_SETMETA_NEW[2].replace("AAA", arg_list_str[2:]))
-        l_source.write(LUA_SETMETA_NEW[3])
-        arg_list_str = str()
+        if self.argparser.args.lazy: template = self.templates["lua_onload_constructor"]
+        else: template = self.templates["lua_lazy_constructor"]
+        l_source.write(template.render(struct=struct_name, params=arg_list_str, args=arg_list_str[2:]))
         l_source.write("\n")
 
+    @profiled
     def gen_table_def(self):
-        tbl_source = open(self.argparser.args.tbldefs + "/tabledefs.c", "w")
-        tbl_header = open(self.argparser.args.tbldefs + "/tabledefs.h", "w")
-        tbl_source.write("// automatically generated by luatablegen\n")
-        tbl_header.write("// automatically generated by luatablegen\n")
-        tbl_source.write("//" + self.time + "\n")
-        tbl_header.write("//" + self.time + "\n")
-        for header in HEADER_LIST[0:4]:
-            if self.argparser.args.luaheader:
-                tbl_source.write(header.replace("HHH", self.argparser.args.luaheader+"/"))
-                tbl_header.write(header.replace("HHH", self.argparser.args.luaheader+"/"))
-            else:
-                tbl_source.write(header.replace("HHH", ""))
-                tbl_header.write(header.replace("HHH", ""))
-        tbl_source.write('#include "./structs.h"\n')
-        tbl_header.write('#include "./structs.h"\n')
-        tbl_tag_list = []
-        simple_table_list = []
+        tbl_source = io.StringIO()
+        tbl_header = io.StringIO()
+        tbl_source.write(self.templates["object_cache"].render())
+        tbl_source.write(self.templates["array_view"].render())
+        tbl_source.write(self.templates["pack_runtime"].render())
+        tbl_header.write("#ifndef TABLEGEN_TABLEDEFS_H\n#define TABLEGEN_TABLEDEFS_H\n")
+        tbl_header.write(self.templates["object_cache_decl"].render())
+        tbl_header.write(self.templates["array_view_decl"].render())
+        tbl_header.write(self.templates["pack_runtime_decl"].render())
+        if self.argparser.args.instrument:
+            tbl_source.write(self.templates["stats"].render())
+            tbl_header.write(self.templates["stats_decl"].render())
+        if self.argparser.args.lazy:
+            tbl_source.write(self.templates["lazy_runtime"].render())
+            tbl_header.write(self.templates["lazy_runtime_decl"].render())
+        tbl_tag_set = set()
+        simple_table_set = set()
         for elem in self.elems:
             for node in elem:
                 count_replacement = ""
-                type_name = type_resolver(node, self.def_elems+self.read_elems)
-                type_ref_node = get_def_node(type_name, self.def_elems+self.read_elems)
+                type_name = type_resolver(node, self.schema)
+                type_ref_node = get_def_node(type_name, self.schema)
                 # if node has attribute aggregate
-                if type_ref_node and type_ref_node.tag not in tbl_tag_list:
-                    tbl_tag_list.append(type_ref_node.tag)
+                if type_ref_node and type_ref_node.tag not in tbl_tag_set:
+                    tbl_tag_set.add(type_ref_node.tag)
                     count = get_elem_count(node)
                     pointer = ""
                     if count == -1:
-                        for node2 in elem:
-                            if node2.tag == node.attrib["count"][6:]:
-                                count_replacement = node2.attrib["name"]
+                        count_node = get_count_node(node, elem, self.schema)
+                        if count_node is not None:
+                            count_replacement = count_node.attrib["name"]
                     if count == 1:
                         pointer = "*"
                     else:
@@ -1066,134 +3594,581 @@ class TbgParser(object):
                         xxx = node.attrib["name"]
                         zzz = "lua_push" + node.attrib["luatype"]
                     #if pointer == "*": continue
-                    tbl_source.write(LUA_PUSH_TABLE.replace("XXX", xxx+pointer).replace("YYY", xxx).replace("WWW", xxx))
-                    tbl_header.write(LUA_PUSH_TABLE_SIG.replace("XXX", xxx+pointer).replace("YYY", xxx))
+                    tbl_source.write(self.templates["pushluatable"].render(array_type=xxx+pointer, name=xxx, struct=xxx, probe=self.probe("pushluatable_" + xxx)))
+                    tbl_header.write(self.templates["pushluatable_decl"].render(array_type=xxx+pointer, name=xxx))
                 # if node is simple type
-                else:
+                elif not type_ref_node:
                     count = get_elem_count(node)
                     simple_type = simple_type_resovler(node.attrib["type"])
-                    if count != 1 and simple_type not in simple_table_list:
-                        simple_table_list.append(simple_type)
+                    if count != 1 and simple_type not in simple_table_set:
+                        simple_table_set.add(simple_type)
                         yyy = node.attrib["name"]
                         xxx = simple_type_resovler(node.attrib["type"])
                         # lightuserdata types are being handled elsewhere
                         if simple_type == "lightuserdata": continue
                         lua_type = lua_type_resolver(node.attrib["type"])
-                        tbl_source.write(LUA_PUSH_TABLE_SIMPLE_TYPE.replace("YYY", xxx).replace("XXX", simple_type+"*").replace("ZZZ", lua_type))
-                        tbl_header.write(LUA_PUSH_TABLE_SIMPLE_TYPE_SIG.replace("YYY", xxx).replace("XXX", simple_type+"*"))
+                        tbl_source.write(self.templates["pushluatable_simple"].render(array_type=simple_type+"*", name=xxx, lua_type=lua_type,
+                                                                                      probe=self.probe("pushluatable_" + xxx)))
+                        tbl_header.write(self.templates["pushluatable_decl"].render(array_type=simple_type+"*", name=xxx))
+        tbl_header.write("#endif\n")
+        if self.argparser.args.singlefile:
+            self.unity_parts["tabledefs"] = tbl_source.getvalue()
+            self.unity_parts["tabledefs_decl"] = tbl_header.getvalue()
+            return
+        prologue = self.templates["tabledefs_prologue"].render(time=self.time, lua_includes=self.lua_includes())
+        include = self.templates["include"].render(path="./tabledefs.h")
+        self.write_output(self.argparser.args.tbldefs + "/tabledefs.c", prologue + include + tbl_source.getvalue())
+        self.write_output(self.argparser.args.tbldefs + "/tabledefs.h", prologue + tbl_header.getvalue())
+
+    @profiled
+    def load_manifest(self):
+        self.manifest = {"structs": {}, "files": {}}
+        self.new_manifest = {"version": MANIFEST_VERSION, "structs": {}, "files": {}}
+        if not self.argparser.args.incremental: return
+        self.manifest_path = get_full_path(self.argparser.args.out, MANIFEST_FILE_NAME)
+        if not os.path.exists(self.manifest_path): return
+        manifest_file = open(self.manifest_path)
+        try:
+            manifest = json.load(manifest_file)
+        except ValueError:
+            manifest = {}
+        manifest_file.close()
+        if manifest.get("version") == MANIFEST_VERSION:
+            self.manifest = manifest
+
+    @profiled
+    def save_manifest(self):
+        if not self.argparser.args.incremental: return
+        manifest_file = open(self.manifest_path, "w")
+        json.dump(self.new_manifest, manifest_file, indent=1, sort_keys=True)
+        manifest_file.close()
+
+    def input_hash(self):
+        # everything besides its own subtree that ends up in a struct's sources:
+        # the generator itself, the options, the pre/post files and the
+        # name of every struct since fields refer to other structs by tag.
+        digest = hashlib.sha1()
+        generator = open(os.path.abspath(__file__), "rb")
+        digest.update(generator.read())
+        generator.close()
+        args = self.argparser.args
+        digest.update(repr([args.luaheader, args.anon, args.singlefile, args.fieldaccess, args.instrument, args.layout, args.bitfields, args.lazy]).encode())
+        for name in sorted(self.templates):
+            digest.update(self.templates[name].text.encode())
+        for path in [args.pre, args.post]:
+            if path:
+                extra_file = open(path, "rb")
+                digest.update(extra_file.read())
+                extra_file.close()
+            digest.update(b"\0")
+        for node in self.elems:
+            digest.update((node.tag + ":" + node.attrib["name"] + "\n").encode())
+        return digest.hexdigest()
+
+    def struct_hash(self, node):
+        digest = hashlib.sha1(self.input_key.encode())
+        digest.update(node.serialize().encode())
+        return digest.hexdigest()
+
+    @profiled
+    def write_output(self, path, text):
+        # the timestamp is left out of the content hash, otherwise no file would
+        # ever compare equal to the previous run's.
+        key = hashlib.sha1(text.replace(self.time, "").encode()).hexdigest()
+        self.new_manifest["files"][path] = key
+        if self.argparser.args.incremental and self.manifest["files"].get(path) == key and os.path.exists(path):
+            return False
+        # the whole file goes out in one write to a temporary next to it which
+        # is then renamed over the target, so nobody ever sees a partial file.
+        fd, temp_path = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".", suffix=".tmp", dir=os.path.dirname(path) or ".")
+        try:
+            out_file = os.fdopen(fd, "w")
+            out_file.write(text)
+            out_file.close()
+            os.chmod(temp_path, 0o666 & ~self.umask)
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self.bytes_written[path] = os.path.getsize(path)
+        return True
+
+    def bench_value(self, node, parent):
+        # a lua expression the setter of the field accepts, None if there is none
+        lua_type = node.attrib["luatype"]
+        type_node = get_def_node_tag(node.attrib["type"][6:], self.schema)
+        if is_array_field(node):
+            if type_node != None: return "list(make." + type_node.attrib["name"] + ", 16)"
+            if lua_type_resolver(node.attrib["type"]) == "number": return "list(function(i) return i + 0.5 end, 16)"
+            if lua_type_resolver(node.attrib["type"]) == "integer": return "list(function(i) return i end, 16)"
+            return None
+        if lua_type == "integer": return "1"
+        if lua_type == "number": return "1.5"
+        if lua_type == "string": return "\"bench\""
+        if lua_type == "boolean": return "true"
+        if lua_type == "lightuserdata" and type_node != None: return "make." + type_node.attrib["name"] + "()"
+        # conditionals depend on another field and table fields have no setter
+        return None
+
+    @profiled
+    def gen_bench(self, jobs):
+        args = self.argparser.args
+        if not args.headeraggr:
+            print("--bench needs --headeraggr.")
+            sys.exit(1)
+        bench_dir = args.bench
+        os.makedirs(bench_dir, exist_ok=True)
+        push_args = io.StringIO()
+        registrations = io.StringIO()
+        constructors = io.StringIO()
+        for struct_name, field_names, field_types, lua_types, h_filename in jobs:
+            push_args.write(self.templates["bench_push_args"].render(struct=struct_name))
+            registrations.write(self.templates["bench_push_args_reg"].render(struct=struct_name))
+            node = get_def_node(struct_name, self.schema)
+            # array fields start out empty, everything else gets a plain value
+            if field_names: new_args = [self.bench_value(child, node) if not is_array_field(child) and child.attrib["luatype"] != "lightuserdata" else None for child in node]
+            else: new_args = [self.bench_value(node, node)]
+            constructors.write(self.templates["bench_constructor"].render(struct=struct_name, args=", ".join([arg or "nil" for arg in new_args])))
+            populate = io.StringIO()
+            cases = io.StringIO()
+            counts = set()
+            for child in node:
+                field_name = child.attrib["name"]
+                value = self.bench_value(child, node)
+                if value != None:
+                    populate.write("    pcall(T.set_" + field_name + ", obj, " + value + ")\n")
+                if is_array_field(child):
+                    count_node = get_count_node(child, node, self.schema)
+                    if count_node != None: counts.add(count_node.attrib["name"])
+            for child in node:
+                if child.attrib["name"] in counts:
+                    populate.write("    pcall(T.set_" + child.attrib["name"] + ", obj, 16)\n")
+            for child in node:
+                field_name = child.attrib["name"]
+                if child.attrib["luatype"] == "table": continue
+                cases.write(self.templates["bench_getter"].render(struct=struct_name, getter=self.getter_method(field_name)))
+                if is_array_field(child):
+                    cases.write(self.templates["bench_view"].render(struct=struct_name, getter=self.getter_method(field_name)))
+                value = self.bench_value(child, node)
+                if value != None:
+                    label = "16" if is_array_field(child) else child.attrib["luatype"]
+                    cases.write(self.templates["bench_setter"].render(struct=struct_name, field=field_name, label=label, value=value))
+            self.write_output(os.path.join(bench_dir, "bench_" + struct_name + ".lua"),
+                              self.templates["bench_struct"].render(time=self.time, struct=struct_name, populate=populate.getvalue(), cases=cases.getvalue()))
+        # the driver includes a unity build whole to reach its static functions
+        if args.singlefile: header = os.path.relpath(args.outfile, bench_dir)
+        else: header = os.path.relpath(args.headeraggr, bench_dir)
+        self.write_output(os.path.join(bench_dir, "bench_main.c"),
+                          self.templates["bench_driver"].render(time=self.time, header=header, name=args.name, push_args=push_args.getvalue(),
+                                                                registrations=registrations.getvalue()))
+        scripts = ", ".join(["\"" + job[0] + "\"" for job in jobs])
+        self.write_output(os.path.join(bench_dir, "bench.lua"),
+                          self.templates["bench_runner"].render(time=self.time, constructors=constructors.getvalue(), scripts=scripts))
+        if args.singlefile:
+            sources = []
+        else:
+            sources = [get_full_path(args.out, job[0] + "_tablegen.c") for job in jobs]
+            sources += [args.tbldefs + "/tabledefs.c", args.headeraggr.replace(".h", ".c")]
+        sources = " ".join([os.path.relpath(path, bench_dir) for path in sources])
+        self.write_output(os.path.join(bench_dir, "makefile"),
+                          self.templates["bench_makefile"].render(time=self.time, lua_dir=args.benchlua, sources=sources))
+
+    def make_path(self, path):
+        # generated files are named relative to the directory tablegen.mk is in
+        return "$(TABLEGEN_DIR_" + self.argparser.args.name + ")/" + os.path.relpath(path, self.argparser.args.out)
+
+    def make_rule(self, target, prerequisites):
+        return self.templates["make_rule"].render(target=self.make_path(target),
+                                                  prerequisites="".join([" \\\n\t" + self.make_path(path) for path in prerequisites]))
+
+    @profiled
+    def gen_makemacro(self, jobs):
+        args = self.argparser.args
+        out = args.out
+        objects = []
+        rules = io.StringIO()
+        if args.singlefile:
+            objects.append(os.path.splitext(args.outfile)[0] + ".o")
+            rules.write(self.make_rule(objects[-1], [args.outfile]))
+        else:
+            structs_h = get_full_path(out, "structs.h")
+            tabledefs_h = args.tbldefs + "/tabledefs.h"
+            # a table calls the push_ and new_ functions of the structs it refers to
+            for struct_name, field_names, field_types, lua_types, h_filename in jobs:
+                node = get_def_node(struct_name, self.schema)
+                refs = [get_full_path(out, ref + "_tablegen.h") for ref in get_struct_refs(node, self.schema)]
+                objects.append(get_full_path(out, struct_name + "_tablegen.o"))
+                rules.write(self.make_rule(objects[-1], [get_full_path(out, struct_name + "_tablegen.c"), get_full_path(out, h_filename),
+                                                         tabledefs_h, structs_h] + refs))
+            objects.append(args.tbldefs + "/tabledefs.o")
+            rules.write(self.make_rule(objects[-1], [args.tbldefs + "/tabledefs.c", tabledefs_h, structs_h]))
+            objects.append(get_full_path(out, "structs.o"))
+            rules.write(self.make_rule(objects[-1], [get_full_path(out, "structs.c"), structs_h]))
+            if args.headeraggr:
+                objects.append(args.headeraggr.replace(".h", ".o"))
+                rules.write(self.make_rule(objects[-1], [args.headeraggr.replace(".h", ".c"), args.headeraggr] +
+                                           [get_full_path(out, job[4]) for job in jobs]))
+        if args.decoder:
+            objects.append(os.path.splitext(args.decoder)[0] + ".o")
+            structs = [] if args.singlefile else [get_full_path(out, "structs.h")]
+            rules.write(self.make_rule(objects[-1], [os.path.splitext(args.decoder)[0] + ".c", args.decoder] + structs))
+        mk_path = get_full_path(out, "tablegen.mk")
+        depfile = get_full_path(out, "tablegen.d")
+        self.write_output(mk_path, self.templates["make_macro"].render(time=self.time, name=args.name, depfile=self.make_path(depfile),
+                                                                        objects="".join([" \\\n\t" + self.make_path(path) for path in objects]),
+                                                                        rules=rules.getvalue()))
+        # everything generated depends on the schema, the pre and post text,
+        # the template overrides and the generator itself
+        inputs = [args.xml, args.pre, args.post]
+        for template_dir in args.templates or []:
+            inputs += [os.path.join(template_dir, name + TEMPLATE_SUFFIX) for name in DEFAULT_TEMPLATES]
+        inputs = [os.path.abspath(path) for path in inputs if path and os.path.exists(path)] + [os.path.abspath(__file__)]
+        outputs = [path for path in self.new_manifest["files"] if path != depfile]
+        depend = self.templates["make_rule"].render(target=" \\\n".join([self.make_path(path) for path in outputs]),
+                                                    prerequisites="".join([" \\\n\t" + path for path in inputs]))
+        self.write_output(depfile, depend)
+
+    def report_writes(self):
+        total = 0
+        for path, size in self.bytes_written.items():
+            print(path + ": " + repr(size) + " bytes")
+            total += size
+        print("wrote " + repr(len(self.bytes_written)) + " files, " + repr(total) + " bytes")
+
+    def registrations(self, table_reg_list):
+        if self.argparser.args.anon: register_call = self.templates["register_call"]
+        else: register_call = self.templates["register_call_global"]
+        # with --lazy only the loaders are installed, the tables register themselves
+        if self.argparser.args.lazy:
+            loaders = "".join([self.templates["lazy_loader_entry"].render(struct=struct_name) for struct_name in table_reg_list])
+            registrations = self.templates["lazy_registrations"].render(loaders=loaders)
+        else:
+            registrations = "".join([register_call.render(struct=struct_name) for struct_name in table_reg_list])
+        if self.argparser.args.instrument: registrations += self.templates["register_stats"].render()
+        return registrations
+
+    @profiled
+    def gen_unity(self, tables, decls, table_reg_list):
+        unity = io.StringIO()
+        unity.write(self.templates["unity_prologue"].render(time=self.time, lua_includes=self.lua_includes(), structs=self.unity_parts["structs"],
+                                                            tabledefs_decl=self.unity_parts["tabledefs_decl"], pre=self.pre_text, decls=decls,
+                                                            tabledefs=self.unity_parts["tabledefs"]))
+        unity.write(tables)
+        unity.write(self.templates["unity_register"].render(name=self.argparser.args.name, registrations=self.registrations(table_reg_list)))
+        self.end(unity, True)
+        self.write_output(self.argparser.args.outfile, unity.getvalue())
+
+    @profiled
+    def gen_aggregate(self, header_aggr_list, table_reg_list):
+        # the registration function of a unity build is in the single file
+        if self.argparser.args.singlefile:
+            self.write_output(self.argparser.args.headeraggr, self.templates["aggregate_header"].render(time=self.time, includes=self.lua_includes(),
+                                                                                                     name=self.argparser.args.name))
+            return
+        name = self.argparser.args.headeraggr
+        dummy = name[name.rfind("/"):]
+        include = self.templates["include"]
+        includes = "".join([include.render(path=item) for item in header_aggr_list])
+        registrations = self.registrations(table_reg_list)
+        aggr_header = io.StringIO()
+        aggr_header_h = io.StringIO()
+        aggr_header.write(self.templates["aggregate_source"].render(time=self.time, includes=includes, header=dummy,
+                                                                    name=self.argparser.args.name, registrations=registrations))
+        aggr_header_h.write(self.templates["aggregate_header"].render(time=self.time, includes=includes, name=self.argparser.args.name))
+        self.write_output(self.argparser.args.headeraggr.replace(".h", ".c"), aggr_header.getvalue())
+        self.write_output(self.argparser.args.headeraggr, aggr_header_h.getvalue())
+
+    @profiled
+    def emit_struct(self, struct_name, field_names, field_types, lua_types, h_filename):
+        c_source = io.StringIO()
+        h_source = io.StringIO()
+        # a unity build gets the bare functions and their declarations, the
+        # includes and the pre and post text are written once for the whole file
+        unity = self.argparser.args.singlefile
+        # source file
+        if not unity: self.begin(c_source, struct_name, h_filename, True)
+        self.convert(c_source, struct_name)
+        self.check(c_source, struct_name)
+        self.push_self(c_source, struct_name)
+        self.push_args(c_source, struct_name, field_names, lua_types)
+        self.new(c_source, struct_name, field_types, field_names, lua_types)
+        self.getter(c_source, struct_name, field_names, field_types, lua_types)
+        self.setter(c_source, struct_name, field_names, field_types, lua_types)
+        self.gc(c_source, struct_name)
+        self.field_access(c_source, struct_name, field_names)
+        self.array(c_source, struct_name, field_names)
+        self.pack(c_source, struct_name)
+        self.register_table_methods(c_source, struct_name, field_names)
+        self.register_table_meta(c_source, struct_name, field_names)
+        self.register_table(c_source, struct_name, len(self.elems))
+        if not unity: self.end(c_source, True)
+        # header file
+        if not unity: self.begin(h_source, struct_name, h_filename, False)
+        getters = [self.templates["getter_decl"].render(struct=struct_name, field=field_name) for field_name in field_names]
+        setters = [self.templates["setter_decl"].render(struct=struct_name, field=field_name) for field_name in field_names]
+        if self.argparser.args.lazy: loader_decl = self.templates["lazy_loader_decl"].render(struct=struct_name, linkage=self.linkage)
+        else: loader_decl = str()
+        h_source.write(self.templates["header_decls"].render(struct=struct_name, linkage=self.linkage, getters="".join(getters), setters="".join(setters),
+                                                             loader_decl=loader_decl))
+        if not unity: self.end(h_source, False)
+        return c_source.getvalue(), h_source.getvalue()
 
     def run(self):
         header_aggr_list = []
         table_reg_list = []
+        if self.argparser.args.singlefile and not self.argparser.args.outfile:
+            print("--singlefile needs --outfile.")
+            sys.exit(1)
         self.read_xml()
+        self.load_manifest()
+        if self.argparser.args.incremental:
+            self.input_key = self.input_hash()
         self.gen_table_def()
 
         self.gen_struct_header_xml()
         if self.argparser.args.singlefile:
-            c_source = open(self.argparser.args.outfile, "w")
+            c_source = io.StringIO()
+            decls = io.StringIO()
         if self.argparser.args.docpath:
-            d_source = open(self.argparser.args.docpath, "w")
+            d_source = io.StringIO()
             d_source.write("The lazy constructors are inside wasm.lua.\n")
             d_source.write("```lua\nlocal wasm = require(\"wasm\")\n```\n")
+            d_source.write("Array getters return views over the struct's memory: `#v`, `v[i]`, `v:sub(i, j)` and `v:bytes(i, j)`.\n")
+            d_source.write("Array setters take a table, a view of the same type or a string of raw elements.\n")
         if self.argparser.args.lualibpath:
-            l_source = open(self.argparser.args.lualibpath, "w")
-            l_source.write("-- automatically generated by luatablegen\n")
-            l_source.write("-- " + self.time + "\n")
-            l_source.write(LUA_LIB[0].replace("XXX", self.argparser.args.lualibname))
+            l_source = io.StringIO()
+            l_source.write(self.templates["lua_module_prologue"].render(time=self.time, name=self.argparser.args.lualibname))
+            if self.argparser.args.lazy: l_source.write(self.templates["lua_onload_prologue"].render())
         #for k, v in self.tbg_file.items():
-        for struct_name, field_names, field_types, lua_types in zip(self.struct_names, self.field_names, self.field_types, self.lua_types):
+        jobs = []
+        for node in self.read_elems + self.def_elems:
+            struct_name = node.attrib["name"]
+            field_names = [child.attrib["name"] for child in node]
+            field_types = [child.attrib["type"] for child in node]
+            lua_types = [child.attrib["luatype"] for child in node]
+            h_filename = struct_name + "_tablegen.h"
+            jobs.append((struct_name, field_names, field_types, lua_types, h_filename))
+        # in incremental mode structs whose inputs did not change are neither
+        # rendered nor written
+        stale = [True] * len(jobs)
+        if self.argparser.args.incremental and not self.argparser.args.singlefile:
+            for i, job in enumerate(jobs):
+                struct_name, h_filename = job[0], job[4]
+                key = self.struct_hash(get_def_node(struct_name, self.schema))
+                self.new_manifest["structs"][struct_name] = key
+                paths = [get_full_path(self.argparser.args.out, struct_name + "_tablegen.c"),
+                         get_full_path(self.argparser.args.out, h_filename)]
+                if self.manifest["structs"].get(struct_name) == key and all(os.path.exists(path) for path in paths):
+                    stale[i] = False
+                    for path in paths:
+                        if path in self.manifest["files"]:
+                            self.new_manifest["files"][path] = self.manifest["files"][path]
+        stale_jobs = [job for job, is_stale in zip(jobs, stale) if is_stale]
+        # per-struct phases are only seen when the structs are emitted here
+        if self.argparser.args.jobs > 1 and self.profiler is not None:
+            print("--profile emits the structs in this process, --jobs is ignored.")
+        if self.argparser.args.jobs > 1 and stale_jobs and self.profiler is None:
+            pool = multiprocessing.Pool(self.argparser.args.jobs, init_emit_worker, (self,))
+            chunksize = max(1, len(stale_jobs) // (self.argparser.args.jobs * 4))
+            rendered = pool.imap(emit_struct_worker, stale_jobs, chunksize)
+        else:
+            pool = None
+            rendered = (self.emit_struct(*job) for job in stale_jobs)
+        # the results come back in schema order no matter which worker rendered them
+        for job, is_stale in zip(jobs, stale):
+            struct_name, field_names, field_types, lua_types, h_filename = job
             if not self.argparser.args.singlefile:
-                c_filename = struct_name + "_tablegen.c"
-                h_filename = struct_name + "_tablegen.h"
-                if self.argparser.args.out[-1] == "/":
-                    c_source = open(self.argparser.args.out + c_filename, "w")
-                    header_aggr_list.append("./" + h_filename)
-                    h_source = open(self.argparser.args.out + h_filename, "w")
+                header_aggr_list.append("./" + h_filename)
+            if is_stale:
+                c_text, h_text = next(rendered)
+                if not self.argparser.args.singlefile:
+                    c_filename = struct_name + "_tablegen.c"
+                    self.write_output(get_full_path(self.argparser.args.out, c_filename), c_text)
+                    self.write_output(get_full_path(self.argparser.args.out, h_filename), h_text)
                 else:
-                    c_source = open(self.argparser.args.out + "/" + c_filename, "w")
-                    header_aggr_list.append("./" + h_filename)
-                    h_source = open(self.argparser.args.out + "/" + h_filename, "w")
-            # source file
-            self.begin(c_source, struct_name, h_filename, True)
-            self.convert(c_source, struct_name)
-            self.check(c_source, struct_name)
-            self.push_self(c_source, struct_name)
-            self.push_args(c_source, struct_name, field_names, lua_types)
-            self.new(c_source, struct_name, field_types, field_names, lua_types)
-            self.getter(c_source, struct_name, field_names, field_types, lua_types)
-            self.setter(c_source, struct_name, field_names, field_types, lua_types)
-            self.register_table_methods(c_source, struct_name, field_names)
-            self.register_table_meta(c_source, struct_name)
-            self.register_table(c_source, struct_name, len(self.struct_names))
-            self.end(c_source, True)
-            if not self.argparser.args.singlefile: c_source.close()
-            # header file
-            self.begin(h_source, struct_name, h_filename, False)
-            h_source.write(CONVERT[0].replace("XXX", struct_name).replace(" {\n", ";\n"))
-            h_source.write(CHECK[0].replace("XXX", struct_name).replace(" {\n", ";\n"))
-            h_source.write(PUSH_SELF[0].replace("XXX", struct_name).replace(" {\n", ";\n"))
-            h_source.write(PUSH_ARGS[0].replace("XXX", struct_name).replace(" {\n", ";\n"))
-            h_source.write(NEW[0].replace("XXX", struct_name).replace(" {\n", ";\n"))
-            for field_name, lua_type in zip(field_names, lua_types):
-                h_source.write(GETTER_GEN[0].replace("XXX", struct_name).replace("YYY", field_name).replace(" {\n", ";\n"))
-            for field_name, lua_type in zip(field_names, lua_types):
-                h_source.write(SETTER_GEN[0].replace("XXX", struct_name).replace("YYY", field_name).replace(" {\n", ";\n"))
-            table_reg_list.append(struct_name + '_register(__ls,"'+struct_name+'");\n')
-            h_source.write(TABLE_REGISTER[0].replace("XXX", struct_name).replace(" {\n", ";\n"))
-            self.end(h_source, False)
+                    c_source.write(c_text)
+                    decls.write(h_text)
+            table_reg_list.append(struct_name)
             # docs
             if self.argparser.args.docpath:
                 self.docgen_md(d_source, struct_name, field_names, field_types, lua_types)
             if self.argparser.args.lualibpath:
                 self.luagen(l_source, struct_name, field_names, field_types, lua_types)
+        if pool:
+            pool.close()
+            pool.join()
         # header aggregate
         if self.argparser.args.headeraggr:
-            name = self.argparser.args.headeraggr
-            dummy = name[name.rfind("/"):]
-            aggr_header = open(self.argparser.args.headeraggr.replace(".h", ".c"), "w")
-            aggr_header_h = open(self.argparser.args.headeraggr, "w")
-            aggr_header.write("// automatically generated by luatablegen\n")
-            aggr_header_h.write("// automatically generated by luatablegen\n")
-            aggr_header.write("// " + self.time + "\n")
-            aggr_header_h.write("// " + self.time + "\n")
-            aggr_header_h.write(HEADER_GUARD[0].replace("XXX", "WASM_TABLES_AGGR"))
-            aggr_header_h.write(EXTERN_C[0])
-            aggr_header.write("\n")
-            for item in header_aggr_list:
-                aggr_header.write("#include " + '"' + item + '"\n')
-                aggr_header_h.write("#include " + '"' + item + '"\n')
-            aggr_header.write("#include " + '".' + dummy + '"\n')
-            aggr_header.write("\n")
-            aggr_header.write("#pragma weak reg_tablegen_tables_"+self.argparser.args.name + "\n")
-            aggr_header.write("void reg_tablegen_tables_"+self.argparser.args.name+"(lua_State* __ls) {\n")
-            aggr_header_h.write("void reg_tablegen_tables_"+self.argparser.args.name+"(lua_State* __ls);\n")
-            for func_sig in table_reg_list:
-                aggr_header.write("\t" + func_sig)
-                if self.argparser.args.anon:
-                    pass
-                else:
-                    aggr_header.write("\t" + "lua_pop(__ls, 1);\n")
-            aggr_header.write("}\n")
-            aggr_header_h.write(EXTERN_C[1])
-            aggr_header_h.write(HEADER_GUARD[1])
-            aggr_header.write("\n")
-        if self.argparser.args.makemacro:
-            if self.argparser.args.out[-1] == "/":
-                m_source = open(self.argparser.args.out + "tablegen.mk", "w")
-            else:
-                m_source = open(self.argparser.args.out + "/" + "tablegen.mk", "w")
+            self.gen_aggregate(header_aggr_list, table_reg_list)
+        if self.argparser.args.singlefile:
+            self.gen_unity(c_source.getvalue(), decls.getvalue(), table_reg_list)
         # generate lua module
         #self.luagen()
         if self.argparser.args.docpath:
             d_source.write("_automatically generated by luatablegen._<br/>\n")
             d_source.write("_" + self.time + "_")
+            self.write_output(self.argparser.args.docpath, d_source.getvalue())
         if self.argparser.args.lualibpath:
             #l_source = open(self.argparser.args.lualibpath, "w")
-            l_source.write(LUA_LIB[1].replace("XXX", self.argparser.args.lualibname))
+            if self.argparser.args.lazy: l_source.write(self.templates["lua_onload_epilogue"].render())
+            l_source.write(self.templates["lua_module_epilogue"].render(name=self.argparser.args.lualibname))
+            self.write_output(self.argparser.args.lualibpath, l_source.getvalue())
+        if self.argparser.args.bench:
+            self.gen_bench(jobs)
+        if self.argparser.args.decoder:
+            self.gen_decoder()
+        if self.argparser.args.makemacro:
+            self.gen_makemacro(jobs)
+        self.save_manifest()
+        self.report_writes()
+        if self.profiler is not None:
+            self.profiler.report(self.argparser.args.profile)
+
+# per-struct emission on a process pool. the parser is handed to every worker
+# once through the pool initializer instead of being sent along with each job.
+emit_worker_parser = None
+
+def init_emit_worker(parser):
+    global emit_worker_parser
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    emit_worker_parser = parser
+
+def emit_struct_worker(job):
+    return emit_worker_parser.emit_struct(*job)
+
+def bench_compare(old_path, new_path, threshold):
+    """prints the change of every benchmark between two bench.lua runs and
+    returns the number of them that got slower or allocate more by more than
+    threshold percent."""
+    runs = []
+    for path in [old_path, new_path]:
+        bench_file = open(path)
+        runs.append(dict((result["name"], result) for result in json.load(bench_file)["results"]))
+        bench_file.close()
+    old, new = runs
+    regressions = 0
+    print("%-56s %12s %12s %8s %14s" % ("benchmark", "old ns/op", "new ns/op", "change", "allocs/op"))
+    for name in sorted(set(old) | set(new)):
+        if name not in old or name not in new:
+            print("%-56s %s" % (name, "only in " + (old_path if name in old else new_path)))
+            continue
+        before, after = old[name], new[name]
+        if "error" in before or "error" in after:
+            print("%-56s %s" % (name, after.get("error") or "fixed: " + before["error"]))
+            continue
+        change = (after["ns_per_op"] - before["ns_per_op"]) * 100.0 / max(before["ns_per_op"], 1e-9)
+        allocs = "%.2f -> %.2f" % (before["allocs_per_op"], after["allocs_per_op"])
+        note = str()
+        if change > threshold:
+            note = "  slower"
+        if after["allocs_per_op"] > before["allocs_per_op"] * (1 + threshold / 100.0) + 0.005:
+            note += "  allocates more"
+        if note: regressions += 1
+        print("%-56s %12.1f %12.1f %+7.1f%% %14s%s" % (name, before["ns_per_op"], after["ns_per_op"], change, allocs, note))
+    print(repr(regressions) + " regressions above " + repr(threshold) + "%")
+    return regressions
+
+SYNTH_TYPES = ["uint8", "uint16", "uint32", "uint64", "int32", "string"]
+
+def synth_schema(path, structs, args):
+    """writes a schema with the given number of structs, shaped by the --synth
+    options. structs are split into --synthdepth levels and only reference
+    structs on the next level, so reference chains are at most that deep.
+    structs.h has no forward declarations, so the definitions are written
+    deepest level first."""
+    rand = random.Random(args.synthseed)
+    depth = max(1, min(args.synthdepth, structs))
+    levels = [[] for i in range(depth)]
+    for i in range(structs):
+        levels[i * depth // structs].append(i)
+    out = io.StringIO()
+    out.write("<?xml version=\"1.0\" encoding=\"UTF-8\"?>\n<FT>\n")
+    # the first level is what gets read, the rest are definitions
+    for level in [0] + list(range(depth - 1, 0, -1)):
+        section = levels[level]
+        if level == 0: out.write("  <Read>\n")
+        elif level == depth - 1: out.write("  <Definition>\n")
+        targets = levels[level + 1] if level + 1 < depth else []
+        for i in section:
+            out.write("    <S%d name=\"s%d_t\" isaggregate=\"true\" luatype=\"lightuserdata\">\n" % (i, i))
+            out.write("      <Count name=\"count\" type=\"uint32\" count=\"1\" luatype=\"integer\"/>\n")
+            out.write("      <Kind name=\"kind\" type=\"uint8\" count=\"1\" luatype=\"integer\"/>\n")
+            for j in range(args.synthfields):
+                roll = rand.randrange(100)
+                field = "      <F%d name=\"f%d\" " % (j, j)
+                if roll < args.synthrefs and targets:
+                    out.write(field + "type=\"self::S%d\" count=\"1\" luatype=\"lightuserdata\"/>\n" % rand.choice(targets))
+                elif roll < args.synthrefs + args.synthcounts:
+                    if targets and rand.randrange(2): field_type = "self::S%d" % rand.choice(targets)
+                    else: field_type = rand.choice(SYNTH_TYPES[:-1])
+                    out.write(field + "type=\"%s\" count=\"self::Count\" luatype=\"lightuserdata\"/>\n" % field_type)
+                elif roll < args.synthrefs + args.synthcounts + args.synthconds:
+                    out.write(field + "conditional=\"true\" condition=\"self::Kind\" type=\"FT::conditional\" luatype=\"conditional\">\n")
+                    out.write("        <condition0 name=\"f%d\" type=\"uint32\" luatype=\"lightuserdata\">0</condition0>\n" % j)
+                    for k, target in enumerate(rand.sample(targets, min(2, len(targets)))):
+                        out.write("        <condition%d name=\"f%d\" type=\"self::S%d\" luatype=\"lightuserdata\">%d</condition%d>\n" % (k + 1, j, target, k + 1, k + 1))
+                    out.write("      </F%d>\n" % j)
+                else:
+                    field_type = rand.choice(SYNTH_TYPES)
+                    out.write(field + "type=\"%s\" count=\"1\" luatype=\"%s\"/>\n" % (field_type, lua_type_resolver(field_type)))
+            out.write("    </S%d>\n" % i)
+        if level == 0: out.write("  </Read>\n")
+    if depth > 1: out.write("  </Definition>\n")
+    out.write("</FT>\n")
+    schema_file = open(path, "w")
+    schema_file.write(out.getvalue())
+    schema_file.close()
+
+def schema_bench(args):
+    """runs the whole generator on a synthetic schema of every size in a child
+    process of its own, so that the peak rss wait4 reports is that run's."""
+    sizes = [int(size) for size in args.synthstructs.split(",")]
+    os.makedirs(args.schemabench, exist_ok=True)
+    results = []
+    print("%8s %8s %10s %12s %12s %12s" % ("structs", "fields", "wall s", "peak rss MB", "output MB", "us/struct"))
+    for size in sizes:
+        schema = os.path.join(args.schemabench, "schema_" + repr(size) + ".xml")
+        out = os.path.join(args.schemabench, "out_" + repr(size))
+        os.makedirs(out, exist_ok=True)
+        synth_schema(schema, size, args)
+        command = [sys.executable, os.path.abspath(__file__), "--xml", schema, "--out", out, "--tbldefs", out,
+                   "--headeraggr", os.path.join(out, "synth_tables.h"), "--docpath", os.path.join(out, "synth.md"),
+                   "--lualibpath", os.path.join(out, "synth.lua"), "--name", "synth", "--lualibname", "synth",
+                   "--jobs", repr(args.jobs)]
+        if args.fieldaccess: command.append("--fieldaccess")
+        start = time.perf_counter()
+        child = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+        pid, status, usage = os.wait4(child.pid, 0)
+        wall = time.perf_counter() - start
+        child.returncode = os.waitstatus_to_exitcode(status)
+        if child.returncode != 0:
+            print("the generator failed on " + schema + ".")
+            sys.exit(1)
+        output = sum(os.path.getsize(os.path.join(out, name)) for name in os.listdir(out))
+        # ru_maxrss is in kilobytes on linux
+        result = {"structs": size, "fields": size * (args.synthfields + 2), "wall_s": wall,
+                  "peak_rss_mb": usage.ru_maxrss / 1024.0, "output_mb": output / 1048576.0}
+        results.append(result)
+        print("%8d %8d %10.3f %12.1f %12.1f %12.1f" % (size, result["fields"], wall, result["peak_rss_mb"],
+                                                        result["output_mb"], wall * 1e6 / size))
+    options = dict((key, getattr(args, key)) for key in ["synthfields", "synthdepth", "synthrefs", "synthcounts",
+                                                         "synthconds", "synthseed", "jobs", "fieldaccess"])
+    result_file = open(os.path.join(args.schemabench, "schemabench.json"), "w")
+    json.dump({"version": 1, "options": options, "results": results}, result_file, indent=1, sort_keys=True)
+    result_file.close()
 
 # write code here
 def premain(argparser):
     signal.signal(signal.SIGINT, SigHandler_SIGINT)
+    if argparser.args.benchcompare:
+        old_path, new_path = argparser.args.benchcompare
+        sys.exit(1 if bench_compare(old_path, new_path, argparser.args.benchthreshold) else 0)
+    if argparser.args.synthschema:
+        synth_schema(argparser.args.synthschema, int(argparser.args.synthstructs.split(",")[0]), argparser.args)
+        return
+    if argparser.args.schemabench:
+        schema_bench(argparser.args)
+        return
     #here
     parser = TbgParser(argparser)
     parser.run()